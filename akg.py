@@ -4,8 +4,20 @@ import time
 import sys
 import os
 import uuid
+import pickle
+import tempfile
+import hashlib
+import codecs
+import csv
+import io
+import importlib.util
+from collections import Counter
+from array import array
 from rdflib import Graph, Namespace
 import logging
+from functools import lru_cache
+from typing import Iterable
+import pandas as pd
 
 # the possible column names of (genes, log fold changes, p-values) used in headers in the imported data files
 # most preferred match given first.
@@ -130,15 +142,326 @@ def get_gene_id(gene_name) -> str:
     #print(f"HGNC ID not found for {gene_name}")
     return ''
 
+def file_hash(file_path:str) -> str:
+    """
+    Hash of the content of a file, to detect when it has changed
+    Returns:
+        the SHA-256 digest of the file, in hex
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def deterministic_row_uuid(dataset_uuid:str, row_index:int) -> str:
+    """
+    The UUID for a row of a dataset, when create_rdf_triples is run with --deterministic: derived from the 
+    dataset's UUID and the row number, so the same data gives the same row URIs on every run.
+    Because the row label is 'row <row_index>', this also maps a row URI back to its label without the
+    row_uri_labels.json file.
+    """
+    return str(uuid.uuid5(uuid.UUID(dataset_uuid), f'row {row_index}'))
+
+# the delimiters a data file may have, in order of preference when they fit it equally well (see sniff_csv)
+CSV_DELIMITERS = ('\t', ',', ';')
+# the number of bytes at the start of a data file that sniff_csv looks at
+SNIFF_SAMPLE_SIZE = 64*1024
+# the byte order marks that identify an encoding
+CSV_BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+# the encoding and delimiter of the csv files that the programs write out (pandas' to_csv defaults)
+WRITTEN_ENCODING = 'utf-8'
+WRITTEN_DELIMITER = ','
+# the formats the split_, expdata_ and clean_ tables can be written in, see write_table
+INTERMEDIATE_FORMATS = ('csv', 'parquet')
+
+def sniff_csv(file_path:str, skip_rows:int=0, sample_size:int=SNIFF_SAMPLE_SIZE) -> tuple[str,str]:
+    """
+    Settle the encoding and delimiter of a csv, tsv or txt data file from a sample at its start, rather than by 
+    parsing the whole file with each possibility in turn.
+    The encoding is given by a byte order mark if there is one, otherwise it is utf-8 if the sample is valid utf-8, 
+    otherwise latin1, which reads any file.
+    The delimiter is the one of CSV_DELIMITERS that splits the most lines of the sample (after skip_rows) into the same 
+    number of fields, more than one, and then the one that gives the most fields. If none of them splits the lines,
+    it is the first of CSV_DELIMITERS.
+    Returns:
+        the encoding and the delimiter
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(sample_size)
+        complete = not f.read(1)
+    encoding = None
+    for bom, bom_encoding in CSV_BOMS:
+        if sample.startswith(bom):
+            encoding = bom_encoding
+            break
+    if encoding is None:
+        try:
+            # not final, so that a character cut off at the end of the sample isn't an error
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=complete)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = 'latin1'
+    text = codecs.getincrementaldecoder(encoding)(errors='replace').decode(sample, final=complete)
+    lines = text.splitlines(keepends=True)
+    if not complete:
+        # the last line may be cut off
+        lines = lines[:-1]
+    lines = lines[skip_rows:]
+
+    best = None
+    best_score = (0, 1)
+    for delimiter in CSV_DELIMITERS:
+        counts = Counter(len(fields) for fields in csv.reader(io.StringIO(''.join(lines)), delimiter=delimiter) if fields)
+        if not counts:
+            continue
+        n_fields, n_lines = counts.most_common(1)[0]
+        if n_fields > 1 and (n_lines, n_fields) > best_score:
+            best, best_score = delimiter, (n_lines, n_fields)
+    return encoding, best if best is not None else CSV_DELIMITERS[0]
+
+def read_csv_data(file_path:str, encoding:str='', delimiter:str='', skip_rows:int=0, **kwargs) -> tuple[pd.DataFrame,str,str]:
+    """
+    Read a csv, tsv or txt data file with pandas' C parser, in one pass, with the given encoding and delimiter (as 
+    recorded in the tracking file), or those found by sniff_csv if not given. If utf-8 turns out to be wrong past the 
+    part that sniff_csv looked at, the file is read again as latin1.
+    Other keyword arguments are passed to pd.read_csv.
+    Returns:
+        the dataframe, and the encoding and delimiter it was read with
+    """
+    if not encoding or not delimiter:
+        sniffed_encoding, sniffed_delimiter = sniff_csv(file_path, skip_rows)
+        encoding = encoding or sniffed_encoding
+        delimiter = delimiter or sniffed_delimiter
+    try:
+        df = pd.read_csv(file_path, delimiter=delimiter, encoding=encoding, skiprows=skip_rows, **kwargs)
+    except UnicodeDecodeError:
+        if encoding not in ('utf-8', 'utf-8-sig'):
+            raise
+        logging.info(f"{file_path} is not {encoding} throughout, reading it as latin1")
+        encoding = 'latin1'
+        df = pd.read_csv(file_path, delimiter=delimiter, encoding=encoding, skiprows=skip_rows, **kwargs)
+    return df, encoding, delimiter
+
+def test_sniff_csv(tmp_path):
+    """
+    The delimiter that fits the lines best is found, after any lines to skip, and the encoding from a BOM or the content
+    """
+    tsv = tmp_path / 'table.txt'
+    tsv.write_text('a note, with commas; and a semicolon\ngene\tlog2fc\tpval\nSHANK3\t1,5\t0.01\nCHD8\t-2\t0.2\n')
+    assert sniff_csv(str(tsv), skip_rows=1) == ('utf-8', '\t')
+    semicolons = tmp_path / 'table.csv'
+    semicolons.write_bytes(codecs.BOM_UTF8 + 'gene;lfc;pval\nSHANK3;1,5;0,01\nCHD8;-2;0,2\n'.encode('utf-8'))
+    assert sniff_csv(str(semicolons)) == ('utf-8-sig', ';')
+    latin = tmp_path / 'latin.csv'
+    latin.write_bytes('gene,lfc,pval\nSHANK3,1.5,0.01\nCD\xb5,2,0.5\n'.encode('latin1'))
+    assert sniff_csv(str(latin)) == ('latin1', ',')
+    df, encoding, delimiter = read_csv_data(str(latin))
+    assert list(df['gene']) == ['SHANK3', 'CD\xb5'] and (encoding, delimiter) == ('latin1', ',')
+    # not utf-8 only after the sample
+    late = tmp_path / 'late.csv'
+    late.write_bytes(b'gene,lfc\n' + b'SHANK3,1.5\n' * 100 + b'CD\xb5,2\n')
+    assert sniff_csv(str(late), sample_size=100) == ('utf-8', ',')
+    df, encoding, _ = read_csv_data(str(late), delimiter=',', encoding='utf-8')
+    assert len(df) == 101 and encoding == 'latin1'
+
+def parquet_available()->bool:
+    """
+    Whether pyarrow (pip install pyarrow), which pandas uses to read and write Parquet files, is installed
+    """
+    return importlib.util.find_spec('pyarrow') is not None
+
+def is_parquet(file_path:str)->bool:
+    """
+    Whether file_path is a Parquet table (see write_table), rather than a csv file
+    """
+    return file_path.lower().endswith('.parquet')
+
+def table_extension(intermediate_format:str)->str:
+    """
+    The extension of the split_, expdata_ and clean_ files written in intermediate_format, one of INTERMEDIATE_FORMATS
+    """
+    return f'.{intermediate_format}'
+
+def written_with(file_name:str)->tuple[str,str]:
+    """
+    The encoding and delimiter to record in the tracking file for a table written by write_table: none for Parquet
+    """
+    return ('', '') if is_parquet(file_name) else (WRITTEN_ENCODING, WRITTEN_DELIMITER)
+
+def unique_column_names(names:Iterable)->list[str]:
+    """
+    The column names as text, with any repeat given a suffix as pd.read_csv does (gene, gene.1, gene.2 ...), because
+    a Parquet file can't have two columns with the same name
+    """
+    seen = set()
+    unique = []
+    for name in names:
+        name = str(name)
+        candidate = name
+        count = 0
+        while candidate in seen:
+            count += 1
+            candidate = f'{name}.{count}'
+        seen.add(candidate)
+        unique.append(candidate)
+    return unique
+
+def write_table(df:pd.DataFrame, file_path:str):
+    """
+    Write a split_, expdata_ or clean_ table to file_path, as csv, or as Parquet if it ends .parquet. In a Parquet file
+    each column keeps its type, except that a column of mixed types (numbers with some text, or gene names that a 
+    spreadsheet has made into dates) is written as text, as it is in a csv file.
+    """
+    if not is_parquet(file_path):
+        df.to_csv(file_path, index=False)
+        return
+    df = df.copy(deep=False)
+    df.columns = unique_column_names(df.columns)
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True) not in ('string', 'empty', 'integer', 'floating', 'boolean'):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    df.to_parquet(file_path, index=False)
+
+def parquet_head(file_path:str, rows:int)->pd.DataFrame:
+    """
+    The first rows of a Parquet table, reading no more of it than needed: with rows 0, just its header
+    """
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(file_path)
+    batch = next(parquet_file.iter_batches(batch_size=max(rows, 1)), None) if rows else None
+    if batch is None:
+        return parquet_file.schema_arrow.empty_table().to_pandas()
+    return batch.to_pandas().head(rows)
+
+def read_table(file_path:str, encoding:str='', delimiter:str='', skip_rows:int=0, **kwargs) -> tuple[pd.DataFrame,str,str]:
+    """
+    Read a table written by write_table, or any csv, tsv or txt data file, as read_csv_data does (which is given the 
+    other keyword arguments). skip_rows lines are skipped before the header line: in a Parquet file the header is the 
+    first line, so the header becomes row skip_rows - 1 of the table, and the columns after it are made numbers where
+    they can be, as they would be in a csv file. nrows limits the rows read after the header, from either.
+    Returns:
+        the dataframe, and the encoding and delimiter it was read with (none for a Parquet file)
+    """
+    if not is_parquet(file_path):
+        return read_csv_data(file_path, encoding, delimiter, skip_rows, **kwargs)
+    nrows = kwargs.get('nrows')
+    df = pd.read_parquet(file_path) if nrows is None else parquet_head(file_path, skip_rows + nrows)
+    if skip_rows:
+        header = ['' if pd.isna(value) else str(value) for value in df.iloc[skip_rows - 1]]
+        df = df.iloc[skip_rows:].reset_index(drop=True)
+        df.columns = unique_column_names(header)
+        for col in df.columns:
+            try:
+                df[col] = pd.to_numeric(df[col])
+            except (ValueError, TypeError):
+                pass
+    return df, '', ''
+
+def _csv_head(file_path:str, encoding:str, delimiter:str, skip_rows:int, rows:int)->list[list[str]]:
+    """
+    The header line and the first rows of a csv file, split with the csv module, passing over blank lines as pandas does
+    """
+    records = []
+    with open(file_path, 'r', encoding=encoding, newline='') as f:
+        for _ in range(skip_rows):
+            f.readline()
+        for record in csv.reader(f, delimiter=delimiter):
+            if record:
+                records.append(record)
+                if len(records) > rows:
+                    break
+    return records
+
+def read_table_head(file_path:str, rows:int=0, encoding:str='', delimiter:str='', skip_rows:int=0) -> tuple[pd.DataFrame,str,str]:
+    """
+    The header and the first rows of a table, as read_table reads them, for a quick look at many files (see
+    standard_check). A csv file's lines are split with the csv module, without setting up pandas' parser, and the values
+    are left as text; as in pandas, a blank header is named 'Unnamed: <column>', and repeats are made unique.
+    Returns:
+        the dataframe, and the encoding and delimiter it was read with (none for a Parquet file)
+    """
+    if is_parquet(file_path):
+        return read_table(file_path, skip_rows=skip_rows, nrows=rows)
+    if not encoding or not delimiter:
+        sniffed_encoding, sniffed_delimiter = sniff_csv(file_path, skip_rows)
+        encoding = encoding or sniffed_encoding
+        delimiter = delimiter or sniffed_delimiter
+    try:
+        records = _csv_head(file_path, encoding, delimiter, skip_rows, rows)
+    except UnicodeDecodeError:
+        if encoding not in ('utf-8', 'utf-8-sig'):
+            raise
+        encoding = 'latin1'
+        records = _csv_head(file_path, encoding, delimiter, skip_rows, rows)
+    if not records:
+        raise pd.errors.EmptyDataError(f"No columns to parse from {file_path}")
+    header = unique_column_names(name if name else f'Unnamed: {col}' for col, name in enumerate(records[0]))
+    # short rows are filled out, and long ones left out, as pandas does with on_bad_lines='warn'
+    data = [record + [None] * (len(header) - len(record)) for record in records[1:] if len(record) <= len(header)]
+    return pd.DataFrame(data, columns=header, dtype=object), encoding, delimiter
+
+def test_read_table_head(tmp_path):
+    """
+    The same header as pandas gives, and the first rows as text
+    """
+    table = tmp_path / 'split_a.csv'
+    table.write_text('a note\n\ngene,lfc,,lfc,pval\nSHANK3,1.5,x,2,0.01\nCHD8,-2\nNRXN1,0.5,y,1,0.2\n')
+    head, encoding, delimiter = read_table_head(str(table), rows=2, skip_rows=1)
+    whole, _, _ = read_csv_data(str(table), skip_rows=1)
+    assert list(head.columns) == list(whole.columns) == ['gene', 'lfc', 'Unnamed: 2', 'lfc.1', 'pval']
+    assert list(head['lfc']) == ['1.5', '-2'] and head['pval'][1] is None and (encoding, delimiter) == ('utf-8', ',')
+    assert read_table_head(str(table), skip_rows=2)[0].empty
+
+def test_parquet_table(tmp_path):
+    """
+    A Parquet table keeps its column types, apart from a mixed one, and can have lines skipped before the header
+    """
+    pytest.importorskip('pyarrow')
+    df = pd.DataFrame([['a note', None, None], ['gene', 'lfc', 'pval'], ['SHANK3', 1.5, 0.01], ['CHD8', -2, 'NA']], columns=['x', 'x', 'y'])
+    path = str(tmp_path / 'split_a.parquet')
+    write_table(df, path)
+    table, encoding, delimiter = read_table(path)
+    assert list(table.columns) == ['x', 'x.1', 'y'] and (encoding, delimiter) == ('', '')
+    assert pd.isna(table['y'][0]) and list(table['y'][1:]) == ['pval', '0.01', 'NA']
+    skipped, _, _ = read_table(path, skip_rows=2)
+    assert list(skipped.columns) == ['gene', 'lfc', 'pval']
+    assert list(skipped['lfc']) == [1.5, -2] and list(skipped['pval']) == ['0.01', 'NA']
+    header, _, _ = read_table(path, skip_rows=2, nrows=0)
+    assert list(header.columns) == ['gene', 'lfc', 'pval'] and header.empty
+    numbers = pd.DataFrame({'gene': ['SHANK3', 'CHD8'], 'lfc': [1.5, float('nan')], 'count': [3, 4]})
+    write_table(numbers, path)
+    assert read_table(path)[0].dtypes.to_dict() == numbers.dtypes.to_dict()
+
+def output_file_name(stub:str, output_dir:str, file_path:str, taken:set|None=None, extension:str='.csv') -> str:
+    """
+    The name of a file to write in output_dir, stub.csv (or other extension), unless that is already there (or in taken,
+    the names given to files that haven't been written yet), in which case the name of the input file, file_path, is 
+    added to it
+    """
+    new_filename = stub + extension
+    if os.path.exists(os.path.join(output_dir, new_filename)) or (taken is not None and new_filename in taken):
+        original_filename = os.path.splitext(os.path.basename(file_path))[0]
+        new_filename = f"{stub}_{original_filename}{extension}"
+    if taken is not None:
+        taken.add(new_filename)
+    return new_filename
+
 class FilenameUUIDMap:
     """
     store persistent UUIDs for filenames
     Example:
         my_map = FilenameUUIDMap()
         uuid = my_map.get_uuid('example.txt')
+    A new UUID is derived from the file name, so that a data file gets the same one however it is processed: by one 
+    process or several (create_rdf_triples.py and pipeline.py --jobs), or by a run that starts on an empty map.
+    With persist False, as in a process working alongside others, the map file isn't written: the new UUIDs are kept in 
+    'new' for the main process to merge.
     """
-    def __init__(self, filename='filename_uuid_map.json'):
+    def __init__(self, filename='filename_uuid_map.json', persist:bool=True):
         self.filename = filename
+        self.persist = persist
+        self.new = {}
         self.map = {}
         try:
             with open(self.filename, 'r') as f:
@@ -159,10 +482,23 @@ class FilenameUUIDMap:
         Get the UUID for a given filename, or create a new one if it doesn't exist.
         """
         if filename not in self.map:
-            self.map[filename] = str(uuid.uuid4())
-            self.update_reverse_map
-            self.save()
+            self.map[filename] = str(uuid.uuid5(uuid.NAMESPACE_URL, filename))
+            if self.persist:
+                self.save()
+            else:
+                self.new[filename] = self.map[filename]
+            self.update_reverse_map()
         return self.map[filename]
+
+    def merge(self, entries:dict):
+        """
+        Add the UUIDs made by another process (see persist), keeping those already here
+        """
+        added = {filename: file_uuid for filename, file_uuid in entries.items() if filename not in self.map}
+        if added:
+            self.map.update(added)
+            self.update_reverse_map()
+            self.save()
     def get_filename_from_uuid(self, uuid):
         """
         Get the filename for a given UUID.
@@ -176,6 +512,63 @@ class FilenameUUIDMap:
         with open(self.filename, 'w') as f:
             json.dump(self.map, f)
 
+def _strip_gene_name(gene_name:str) -> str:
+    """
+    Remove 'hp_', a short '_' variant suffix and any '.' version suffix from a gene name, to help the matching process
+    """
+    if gene_name.startswith('hp_'):
+        gene_name = gene_name[3:]
+    if '_' in gene_name[-5:]:
+        gene_name = gene_name[:gene_name.rfind('_', len(gene_name) - 5)]    
+    if '.' in gene_name:
+        gene_name = gene_name.split('.')[0]
+    return gene_name
+
+# increment this when the content or layout of the GeneIdStore index changes, so that old index files are rebuilt
+GENE_ID_INDEX_VERSION = 2
+GENE_ID_INDEX_SUFFIX = '.index.pkl'
+# length of the substrings used to index the lines of gene_ids.txt for the substring search in GeneIdStore.get_gene_id
+GENE_ID_NGRAM = 3
+
+def _gene_id_source_signature(*file_paths:str) -> tuple:
+    """
+    Identify the versions of the files that a GeneIdStore index is built from, by modification time and size.
+    A missing file is recorded as such (the HGNC file is optional).
+    """
+    signature = []
+    for file_path in file_paths:
+        try:
+            st = os.stat(file_path)
+            signature.append((os.path.abspath(file_path), st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append((os.path.abspath(file_path), None, None))
+    return tuple(signature)
+
+def gene_id_source_files(source:str="gene_ids.txt", hgnc_file:str="hgnc_complete_set.json") -> tuple[str,str]:
+    """
+    The paths of the files that a GeneIdStore made with these arguments is built from: source is relative to the 
+    location of this file (akg.py)
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, source), hgnc_file
+
+def files_hash(*file_paths:str) -> str:
+    """
+    Hash of the content of some files together, such as those a GeneIdStore is built from, to detect when any has changed.
+    The files are only read again when their modification time or size changes. A missing file hashes as empty.
+    """
+    return _files_hash(_gene_id_source_signature(*file_paths))
+
+@lru_cache(maxsize=16)
+def _files_hash(signature:tuple) -> str:
+    """
+    files_hash, for the signature of the files, so that it can be remembered
+    """
+    digest = hashlib.sha256()
+    for file_path, mtime, size in signature:
+        digest.update(f"{file_hash(file_path) if mtime is not None else ''}|".encode('utf-8'))
+    return digest.hexdigest()
+
 class GeneIdStore:
     """
     Store of gene IDs in multiple formats. For searching.
@@ -186,8 +579,50 @@ class GeneIdStore:
     "Ensembl gene ENSG00000183941 is no longer in the database but it has been mapped to 1 deprecated identifier."
     One optimisation of the graph might be simply to apply strict criteria for inclusion - i.e., must have a valid HGNC ID. This might make it 
     more sparse. At the moment the graph includes these with their ensembl IDs.
+
+    The lookup tables are compiled into an index file alongside gene_ids.txt the first time they are built, and 
+    reloaded from there while gene_ids.txt and the HGNC file are unchanged (same modification time and size).
     """
-    def __init__(self, source:str="gene_ids.txt", hgnc_file:str="hgnc_complete_set.json"):
+    # the attributes saved in the compiled index file
+    _INDEX_FIELDS = ('_ens', '_oth', '_lines', '_ngrams', '_ensembl_to_hgnc', '_symbol_to_hgnc', '_hgnc_to_symbol', '_ETH')
+
+    def __init__(self, source:str="gene_ids.txt", hgnc_file:str="hgnc_complete_set.json", index_file:str|None=None, use_index:bool=True):
+        """
+        Parameters:
+            source:str          the gene_ids.txt lookup file, relative to the location of this file (akg.py)
+            hgnc_file:str       the complete HGNC dataset in JSON format
+            index_file:str      the compiled index of the two files above. Defaults to <source>.index.pkl, alongside source
+            use_index:bool      set False to always parse the source files and leave the index untouched
+        """
+        # Assume the file is in the same location as this file (akg.py)
+        full_path, hgnc_file = gene_id_source_files(source, hgnc_file)
+        # the files the lookup tables are built from, see files_hash
+        self.source_files = (full_path, hgnc_file)
+        if index_file is None:
+            index_file = full_path + GENE_ID_INDEX_SUFFIX
+        self.index_file = index_file
+        # set True if the lookup tables came from the compiled index rather than the source files
+        self.from_index = False
+        # results of the substring search, including misses (as ''), which are common and otherwise the most expensive
+        self._substring_cache:dict[str,str] = {}
+
+        # parsing the HGNC JSON takes seconds, and this class is created once per data file in create_rdf_triples,
+        # so reuse the compiled index if it was built from the same versions of the source files
+        signature = _gene_id_source_signature(full_path, hgnc_file)
+        if use_index and self._load_index(index_file, signature):
+            self.from_index = True
+        else:
+            self._build(full_path, hgnc_file)
+            if use_index:
+                self._save_index(index_file, signature)
+        logging.info(f'ensemble_id to hgnc dict has {len(self._ens)} entries')
+        logging.info(f'symbol to hgnc dict has {len(self._symbol_to_hgnc)} entries')
+        logging.info(f'other_id to hgnc dict has {len(self._oth)} entries')
+
+    def _build(self, full_path:str, hgnc_file:str):
+        """
+        Build the lookup tables from the source files
+        """
         # create a dict for lookup of ensemble IDs, mapping back to HGNC IDs.
         # create a separate one for other types
         # this is an optimisation
@@ -196,9 +631,6 @@ class GeneIdStore:
 
         self._setup_hgnc_mapping(hgnc_file)
 
-        # Assume the file is in the same location as this file (akg.py)
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        full_path = os.path.join(script_dir, source)
         with open(full_path, 'r') as file:
             next(file)  
             lines = file.readlines()
@@ -220,9 +652,65 @@ class GeneIdStore:
                         else:
                             if id not in self._oth:
                                 self._oth[id] = hgnc_ID
-        logging.info(f'ensemble_id to hgnc dict has {len(self._ens)} entries')
-        logging.info(f'symbol to hgnc dict has {len(self._symbol_to_hgnc)} entries')
-        logging.info(f'other_id to hgnc dict has {len(self._oth)} entries')
+        self._build_ngram_index()
+
+    def _build_ngram_index(self):
+        """
+        Index every line of gene_ids.txt by the n-grams (substrings of length GENE_ID_NGRAM) it contains.
+        Any line that contains a search string contains all of its n-grams, so the lines listed under the 
+        search string's rarest n-gram are the only candidates that need checking. Line numbers are added in 
+        file order, so each list is sorted and the first confirmed candidate is the first match in the file.
+        """
+        self._ngrams:dict[str,array] = {}
+        for line_number, line in enumerate(self._lines):
+            for ngram in {line[i:i + GENE_ID_NGRAM] for i in range(len(line) - GENE_ID_NGRAM + 1)}:
+                postings = self._ngrams.get(ngram)
+                if postings is None:
+                    postings = self._ngrams[ngram] = array('I')
+                postings.append(line_number)
+        logging.info(f'gene_ids n-gram index has {len(self._ngrams)} entries')
+
+    def _load_index(self, index_file:str, signature:tuple) -> bool:
+        """
+        Load the lookup tables from the compiled index file, if it matches the signature of the source files
+        Returns:
+            True if the lookup tables were loaded
+        """
+        try:
+            with open(index_file, 'rb') as f:
+                index = pickle.load(f)
+        except FileNotFoundError:
+            logging.info(f"No gene ID index {index_file}, building it")
+            return False
+        except Exception as e:
+            logging.warning(f"Gene ID index {index_file} could not be read, rebuilding it: {str(e)}")
+            return False
+        if index.get('version') != GENE_ID_INDEX_VERSION or index.get('signature') != signature:
+            logging.info(f"Gene ID index {index_file} is out of date, rebuilding it")
+            return False
+        for field in GeneIdStore._INDEX_FIELDS:
+            setattr(self, field, index[field])
+        logging.info(f"Gene ID index loaded from {index_file}")
+        return True
+
+    def _save_index(self, index_file:str, signature:tuple):
+        """
+        Write the lookup tables to the compiled index file. Written to a temporary file first and then 
+        moved into place, so that a concurrent reader never sees a partly written index.
+        """
+        index = {field: getattr(self, field) for field in GeneIdStore._INDEX_FIELDS}
+        index['version'] = GENE_ID_INDEX_VERSION
+        index['signature'] = signature
+        index_dir = os.path.dirname(os.path.abspath(index_file))
+        try:
+            fd, tmp_name = tempfile.mkstemp(dir=index_dir, prefix='.gene_index_')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, index_file)
+            logging.info(f"Gene ID index written to {index_file}")
+        except OSError as e:
+            # not fatal, the next run will just rebuild it
+            logging.warning(f"Gene ID index {index_file} could not be written: {str(e)}")
 
     def get_hgnc_symbol(self, hgnc_id: str) -> str:
         return self._hgnc_to_symbol.get(hgnc_id, "")
@@ -231,14 +719,56 @@ class GeneIdStore:
 
         # Remove 'hp_' and variant info to help matching process
         whole_gene_name = gene_name
-        if gene_name.startswith('hp_'):
-            gene_name = gene_name[3:]
-        if '_' in gene_name[-5:]:
-            gene_name = gene_name[:gene_name.rfind('_', len(gene_name) - 5)]    
-        if '.' in gene_name:
-            gene_name = gene_name.split('.')[0]
-
-        u_gene_name = gene_name.upper()
+        gene_name = _strip_gene_name(gene_name)
+        return self._lookup(whole_gene_name, gene_name, gene_name.upper())
+
+    def resolve_many(self, names:Iterable[str]|pd.Series) -> list[str]|pd.Series:
+        """
+        Look up the HGNC IDs for a whole column of gene names at once. Each result is the same as get_gene_id would give
+        for that name, but the name preparation is done as pandas string operations over the column, and each distinct 
+        name is only looked up once: expression tables repeat the same identifiers heavily.
+
+        Parameters:
+            names:  the gene names. Values that are not strings (e.g. NaN for a blank cell) give ''
+        Returns:
+            the HGNC IDs (or '' where not found), as a list in the same order as names, 
+            or as a Series with the same index if names is a Series
+        """
+        series = names if isinstance(names, pd.Series) else pd.Series(list(names), dtype=object)
+        is_str = series.map(lambda name: isinstance(name, str))
+        codes, uniques = pd.factorize(series.where(is_str, None), use_na_sentinel=True)
+        whole = pd.Series(uniques, dtype=object)
+
+        # the same steps as _strip_gene_name, applied to the whole column
+        stripped = whole.where(~whole.str.startswith('hp_'), whole.str[3:])
+        has_variant = stripped.str[-5:].str.contains('_', regex=False)
+        short = stripped.str.len() < 5
+        # with at least 5 characters, the '_' found in the last 5 is the last one in the name
+        stripped = stripped.where(~has_variant, stripped.str.replace(r'_[^_]*$', '', regex=True))
+        # shorter names are rare, and str.rfind behaves differently for them, so leave them to _strip_gene_name
+        if (has_variant & short).any():
+            stripped[has_variant & short] = whole[has_variant & short].map(_strip_gene_name)
+        stripped = stripped.str.split('.', n=1, regex=False).str[0]
+        upper = stripped.str.upper()
+
+        unique_ids = [self._lookup(w, g, u) for w, g, u in zip(whole, stripped, upper)]
+        # codes of -1 mark the values that were not strings
+        unique_ids.append('')
+        resolved = [unique_ids[code] for code in codes]
+        if isinstance(names, pd.Series):
+            return pd.Series(resolved, index=names.index, dtype=object)
+        return resolved
+
+    def _lookup(self, whole_gene_name:str, gene_name:str, u_gene_name:str) -> str:
+        """
+        Find the HGNC ID for a gene name that has been prepared by _strip_gene_name
+        Parameters:
+            whole_gene_name:    the gene name as given
+            gene_name:          the gene name after _strip_gene_name
+            u_gene_name:        gene_name in upper case
+        Returns:
+            the HGNC ID, or '' if not found
+        """
         if u_gene_name.startswith('ENS'):
             if self._ETH:
                 # in theory this should be fastest
@@ -274,16 +804,50 @@ class GeneIdStore:
             logging.debug(f"HGNC ID found for other ID {u_gene_name}")
             return direct_lookup
 
-        for line in self._lines:
-            if u_gene_name in line: # .upper():
-                logging.debug(f"{gene_name} HGNC ID found by brute-force search")
-                return line.split('\t')[0]
-            if u_gene_name.split('.')[0] in line: # .upper():
-                logging.debug(f"{gene_name} HGNC ID found by brute-force search, first component only")
-                return line.split('\t')[0]
+        substring_lookup = self._substring_search(u_gene_name)
+        if substring_lookup:
+            logging.debug(f"{gene_name} HGNC ID found by substring search")
+            return substring_lookup
         # for optimisation, really useful to know what is not found
         logging.debug(f"HGNC ID not found for {gene_name}")
         return ''
+
+    def _substring_search(self, u_gene_name:str) -> str:
+        """
+        Find the first line of gene_ids.txt containing u_gene_name anywhere in it, and return the HGNC ID at the 
+        start of that line. This gives the same result as checking every line in turn (the original brute-force search)
+        but only checks the lines that contain the rarest n-gram of u_gene_name.
+        (u_gene_name has already had any '.' suffix removed, so there is no need to search for its first component separately.)
+
+        Returns:
+            the HGNC ID, or '' if not found
+        """
+        cached = self._substring_cache.get(u_gene_name)
+        if cached is not None:
+            return cached
+
+        if len(u_gene_name) < GENE_ID_NGRAM:
+            # too short to be indexed: check every line
+            candidates = range(len(self._lines))
+        else:
+            candidates = None
+            for i in range(len(u_gene_name) - GENE_ID_NGRAM + 1):
+                postings = self._ngrams.get(u_gene_name[i:i + GENE_ID_NGRAM])
+                if postings is None:
+                    # this n-gram is in no line, so neither is u_gene_name
+                    candidates = ()
+                    break
+                if candidates is None or len(postings) < len(candidates):
+                    candidates = postings
+
+        result = ''
+        for line_number in candidates:
+            line = self._lines[line_number]
+            if u_gene_name in line:
+                result = line.split('\t')[0]
+                break
+        self._substring_cache[u_gene_name] = result
+        return result
     
     def _setup_hgnc_mapping(self, hgnc_file:str):
         """
@@ -428,6 +992,127 @@ def test_original_get_gene_id():
 def test_create_GIDS():
     mygids = GeneIdStore()
 
+def _write_test_gene_sources(folder:str) -> tuple[str,str]:
+    """
+    Write a small gene_ids.txt and HGNC JSON file into folder for testing GeneIdStore without the full downloads
+    Returns:
+        the paths of the two files
+    """
+    gene_ids = os.path.join(folder, 'gene_ids.txt')
+    with open(gene_ids, 'w') as f:
+        f.write('HGNC ID\tApproved symbol\tEnsembl gene ID\n')
+        f.write('HGNC:5\tA1BG\tENSG00000121410\n')
+        f.write('HGNC:4733\tH2AC6\tENSG00000180573\tHIST1H2AC\n')
+    hgnc_file = os.path.join(folder, 'hgnc_complete_set.json')
+    with open(hgnc_file, 'w') as f:
+        json.dump({'response': {'docs': [{'hgnc_id': 'HGNC:4733', 'symbol': 'H2AC6', 'prev_symbol': ['HIST1H2AC'], 
+                                          'alias_symbol': ['H2AFL'], 'ensembl_gene_id': 'ENSG00000180573'}]}}, f)
+    return gene_ids, hgnc_file
+
+def test_gene_id_index():
+    """
+    The compiled index is written on first use, reused while the sources are unchanged, and rebuilt when they change
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        gene_ids, hgnc_file = _write_test_gene_sources(scratch_dir)
+
+        built = GeneIdStore(gene_ids, hgnc_file)
+        assert not built.from_index
+        assert os.path.exists(gene_ids + GENE_ID_INDEX_SUFFIX)
+
+        loaded = GeneIdStore(gene_ids, hgnc_file)
+        assert loaded.from_index
+        for name in ['A1BG', 'ENSG00000180573', 'H2AFL', 'hp_HIST1H2AC', 'GO:0006952']:
+            assert loaded.get_gene_id(name) == built.get_gene_id(name)
+        assert loaded.get_hgnc_symbol('HGNC:4733') == 'H2AC6'
+
+        with open(gene_ids, 'a') as f:
+            f.write('HGNC:7\tA2M\tENSG00000175899\n')
+        rebuilt = GeneIdStore(gene_ids, hgnc_file)
+        assert not rebuilt.from_index
+        assert rebuilt.get_gene_id('ENSG00000175899') == 'HGNC:7'
+
+def test_files_hash():
+    """
+    The hash of the gene ID sources changes with the content of either file, and a missing file is allowed
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        gene_ids, hgnc_file = _write_test_gene_sources(scratch_dir)
+        assert GeneIdStore(gene_ids, hgnc_file, use_index=False).source_files == (gene_ids, hgnc_file)
+        before = files_hash(gene_ids, hgnc_file)
+        assert files_hash(gene_ids, hgnc_file) == before
+        with open(hgnc_file, 'a') as f:
+            f.write('\n')
+        after = files_hash(gene_ids, hgnc_file)
+        assert after != before
+        os.remove(hgnc_file)
+        assert files_hash(gene_ids, hgnc_file) not in (before, after)
+
+def test_substring_search():
+    """
+    The indexed substring search must give the same first match as checking every line in turn
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        gene_ids, hgnc_file = _write_test_gene_sources(scratch_dir)
+        mygids = GeneIdStore(gene_ids, hgnc_file, use_index=False)
+
+        for name in ['', 'A', 'H2', '1BG', '0001', 'ENSG', 'G\tE', 'HIST1H2AC', 'HIST1H2ACX', 'GO:0006952', 'HGNC:4733']:
+            expected = ''
+            for line in mygids._lines:
+                if name in line:
+                    expected = line.split('\t')[0]
+                    break
+            assert mygids._substring_search(name) == expected
+            # and again, from the cache
+            assert mygids._substring_search(name) == expected
+        assert mygids._substring_search('ENSG') == 'HGNC:5'
+        assert mygids._substring_search('GO:0006952') == ''
+
+def test_deterministic_row_uuid():
+    dataset_uuid = str(uuid.uuid4())
+    r0 = deterministic_row_uuid(dataset_uuid, 0)
+    assert r0 == deterministic_row_uuid(dataset_uuid, 0)
+    assert r0 != deterministic_row_uuid(dataset_uuid, 1)
+    assert r0 != deterministic_row_uuid(str(uuid.uuid4()), 0)
+    assert uuid.UUID(r0).version == 5
+
+def test_filename_uuid_map():
+    """
+    A new file name gets the same UUID from a map that is saved and from one whose new entries are merged later,
+    and a UUID already in the map is kept
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        map_file = os.path.join(scratch_dir, 'filename_uuid_map.json')
+        saved = FilenameUUIDMap(map_file)
+        saved.map['clean_old'] = str(uuid.uuid4())
+        dataset_uuid = saved.get_uuid('clean_a')
+        worker = FilenameUUIDMap(map_file, persist=False)
+        assert worker.get_uuid('clean_a') == dataset_uuid
+        assert worker.get_uuid('clean_b') == worker.new['clean_b']
+        saved.merge(worker.new)
+        reloaded = FilenameUUIDMap(map_file)
+        assert reloaded.get_uuid('clean_b') == worker.new['clean_b']
+        assert reloaded.get_uuid('clean_old') == saved.map['clean_old']
+        assert reloaded.get_filename_from_uuid(dataset_uuid) == 'clean_a'
+
+def test_resolve_many():
+    """
+    resolve_many must give the same results as get_gene_id, name by name
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        gene_ids, hgnc_file = _write_test_gene_sources(scratch_dir)
+        mygids = GeneIdStore(gene_ids, hgnc_file, use_index=False)
+
+        names = ['A1BG', 'a1bg', 'hp_A1BG', 'A1BG_1', 'A1BG_12345', 'a_b', '_AB', 'AB_', 'ENSG00000121410.5', 'H2AFL',
+                 'hist1h2ac', 'GO:0006952', 'A1BG', 'ENSG00000180573', 'ensg00000180573', '']
+        expected = [mygids.get_gene_id(name) for name in names]
+        assert mygids.resolve_many(names) == expected
+
+        series = pd.Series(names + [float('nan')], index=range(100, 100 + len(names) + 1))
+        resolved = mygids.resolve_many(series)
+        assert list(resolved.index) == list(series.index)
+        assert list(resolved) == expected + ['']
+
 def test_new_get_gene_id():
     not_found = 'GO:0006952'
 
@@ -0,0 +1,137 @@
+"""compares the spreadsheet reading engines available to data_split (see data_split.excel_engine) on synthetic workbooks, and on any other spreadsheets given"""
+import os
+import time
+import argparse
+import importlib.util
+import numpy as np
+import pandas as pd
+import xlrd
+from data_split import read_tables, calamine_available
+
+# an .xls sheet has at most 65536 rows
+XLS_MAX_ROWS = 65536
+
+def synthetic_table(rows:int, cols:int, rng:np.random.Generator)->pd.DataFrame:
+    """
+    A table like a supplementary data table: a gene name column, then columns of numbers (some missing) and of text
+    """
+    data = {'Gene Symbol': [f'GENE{i}' for i in rng.integers(0, 20000, rows)]}
+    for col in range(1, cols):
+        if col % 4 == 3:
+            data[f'note {col}'] = rng.choice(['up', 'down', 'n/a', ''], rows)
+        else:
+            values = rng.normal(size=rows)
+            values[rng.random(rows) < 0.05] = np.nan
+            data[f'log2FoldChange {col}' if col == 1 else f'value {col}'] = values
+    return pd.DataFrame(data)
+
+def write_xls(path:str, tables:list[pd.DataFrame]):
+    """
+    Write the tables to an older-style .xls file, one per sheet, with xlwt. Missing values are left as empty cells.
+    """
+    import xlwt
+    wb = xlwt.Workbook()
+    for number, df in enumerate(tables):
+        ws = wb.add_sheet(f'Sheet{number + 1}')
+        for col, name in enumerate(df.columns):
+            ws.write(0, col, name)
+        for row, values in enumerate(df.itertuples(index=False), start=1):
+            for col, value in enumerate(values):
+                if not (isinstance(value, float) and np.isnan(value)):
+                    ws.write(row, col, value)
+    wb.save(path)
+
+def make_workbooks(output_dir:str, rows:int)->list[str]:
+    """
+    Write the synthetic workbooks into output_dir, unless they are there already: one with many sheets, one long sheet
+    and one wide sheet, each with about 'rows' rows in all, and if xlwt is installed, an .xls file with 'rows' rows
+    split over as few sheets as will hold them
+    Returns:
+        their paths
+    """
+    rng = np.random.default_rng(0)
+    shapes = {'many_sheets': (40, rows // 40, 6), 'long': (1, rows, 6), 'wide': (1, rows // 10, 60)}
+    paths = []
+    for name, (sheets, sheet_rows, cols) in shapes.items():
+        path = os.path.join(output_dir, f'{name}_{rows}.xlsx')
+        if not os.path.isfile(path):
+            print(f'Writing {path}')
+            with pd.ExcelWriter(path, engine='openpyxl') as writer:
+                for sheet in range(sheets):
+                    synthetic_table(sheet_rows, cols, rng).to_excel(writer, sheet_name=f'Sheet{sheet + 1}', index=False)
+        paths.append(path)
+    if importlib.util.find_spec('xlwt') is not None:
+        path = os.path.join(output_dir, f'old_{rows}.xls')
+        if not os.path.isfile(path):
+            print(f'Writing {path}')
+            sheets = -(-rows // (XLS_MAX_ROWS - 1))
+            write_xls(path, [synthetic_table(rows // sheets, 6, rng) for _ in range(sheets)])
+        paths.append(path)
+    else:
+        print('xlwt is not installed, so there is no synthetic .xls workbook: give .xls files on the command line to time them')
+    return paths
+
+def read_old_tables_by_cell(file_path:str):
+    """
+    Read each sheet of an .xls file as data_split did before it read whole columns, one cell at a time, for comparison
+    """
+    wb = xlrd.open_workbook(file_path)
+    for sheet in wb.sheets():
+        headers = [sheet.cell_value(0, col) for col in range(sheet.ncols)]
+        data = [
+            [sheet.cell_value(row, col) for col in range(sheet.ncols)]
+            for row in range(1, sheet.nrows)
+        ]
+        yield sheet.name, pd.DataFrame(data, columns=headers), ''
+
+def time_engine(file_path:str, engine:str, repeats:int)->tuple[float, list[pd.DataFrame]]:
+    """
+    Read all the tables in file_path with the engine (as for data_split.read_tables, or 'by cell' for the cell by cell
+    reading of an .xls file that data_split used to do), 'repeats' times
+    Returns:
+        the fastest time, and the tables
+    """
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        reader = read_old_tables_by_cell(file_path) if engine == 'by cell' else read_tables(file_path, engine)
+        tables = [df for _, df, _ in reader]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, tables
+
+if __name__ == '__main__':
+
+    # manage the command line options
+    parser = argparse.ArgumentParser(description='Compare the speed of the spreadsheet reading engines available to data_split.py')
+    parser.add_argument('files', nargs='*', help='Other .xlsx or .xls files to compare the engines on')
+    parser.add_argument('-o','--output_dir', default='benchmark', help='Directory for the synthetic workbooks, which are kept to reuse')
+    parser.add_argument('-r','--rows', type=int, default=50000, help='Number of rows in each synthetic workbook (default 50000)')
+    parser.add_argument('-n','--repeats', type=int, default=3, help='Number of times to read each file with each engine, the fastest is reported (default 3)')
+
+    # argparse populates an object using parse_args
+    # extract its members into a dict and from there into variables if used in more than one place
+    config = vars(parser.parse_args())
+
+    os.makedirs(config['output_dir'], exist_ok=True)
+    files = make_workbooks(config['output_dir'], config['rows']) + config['files']
+
+    engines = ['standard']
+    if calamine_available():
+        engines.append('calamine')
+    else:
+        print('python-calamine is not installed, so only the standard engines (openpyxl and xlrd) are timed')
+
+    print(f"{'file':<40} {'MB':>7} {'engine':<10} {'seconds':>8} {'tables':>6}  same as standard")
+    for file_path in files:
+        size = os.path.getsize(file_path) / 1e6
+        standard_tables = None
+        file_engines = engines + ['by cell'] if file_path.lower().endswith('.xls') else engines
+        for engine in file_engines:
+            elapsed, tables = time_engine(file_path, engine, config['repeats'])
+            if standard_tables is None:
+                standard_tables = tables
+                same = ''
+            else:
+                same = 'yes' if len(tables) == len(standard_tables) and all(df.equals(sdf) for df, sdf in zip(tables, standard_tables)) else 'no'
+            print(f'{os.path.basename(file_path):<40} {size:>7.1f} {engine:<10} {elapsed:>8.2f} {len(tables):>6}  {same}')
@@ -0,0 +1,92 @@
+"""finds the gene, log fold change and p-value columns of a data table from its headers, for data_convert, standard_check and create_rdf_triples"""
+import re
+from functools import lru_cache
+from typing import Iterable, NamedTuple
+from akg import possible_gene_names, possible_lfc_names, possible_pval_names
+
+# the roles, each with its possible column names, most preferred first (see akg)
+ROLE_NAMES = {'gene': possible_gene_names, 'lfc': possible_lfc_names, 'pval': possible_pval_names}
+
+# the characters left out of a header when looking for a name in it
+SQUASH_PATTERN = re.compile(r'[_\s-]')
+# for each role, matches any of its names, anywhere in a squashed header
+CONTAINS_PATTERNS = {role: re.compile('|'.join(re.escape(name) for name in names)) for role, names in ROLE_NAMES.items()}
+# for each role, the precedence of each of its names
+NAME_RANKS = {role: {name: rank for rank, name in enumerate(names)} for role, names in ROLE_NAMES.items()}
+
+# the number of different header rows remembered: many papers' tables have the same headers (from DESeq2, edgeR ...)
+ROLE_CACHE_SIZE = 4096
+
+class ColumnRoles(NamedTuple):
+    """
+    The headers of the gene, log fold change and p-value columns of a table, None where there isn't one
+    """
+    gene: str|None
+    lfc: str|None
+    pval: str|None
+
+def squash_header(header:str)->str:
+    """
+    A header in lower case without spaces, underscores or hyphens, to look for the names in
+    """
+    return SQUASH_PATTERN.sub('', header.lower())
+
+@lru_cache(maxsize=ROLE_CACHE_SIZE)
+def _column_roles(headers:tuple[str, ...], exact:bool)->ColumnRoles:
+    """
+    infer_column_roles, for a row of headers as a tuple, so that it can be remembered
+    """
+    found = {}
+    if exact:
+        # each header is looked up once, keeping the most preferred name for each role
+        best = {role: None for role in ROLE_NAMES}
+        for header in headers:
+            for role, ranks in NAME_RANKS.items():
+                rank = ranks.get(header)
+                if rank is not None and (best[role] is None or rank < best[role]):
+                    best[role] = rank
+        for role, rank in best.items():
+            found[role] = ROLE_NAMES[role][rank] if rank is not None else None
+    else:
+        squashed = [squash_header(header) for header in headers]
+        for role, pattern in CONTAINS_PATTERNS.items():
+            found[role] = next((header for header, text in zip(headers, squashed) if pattern.search(text)), None)
+    return ColumnRoles(**found)
+
+def infer_column_roles(headers:Iterable, exact:bool=False)->ColumnRoles:
+    """
+    Find the gene, log fold change and p-value columns from the headers of a table, in one pass over them.
+    With exact False, as used on the tables as they were downloaded, the column for a role is the first (left-most)
+    whose header contains any of the role's names, ignoring case, spaces, underscores and hyphens. With exact True, as
+    used on the cleaned tables (see csv_data_cleaning), whose headers are already in that form, it is the one that is
+    the role's most preferred name. The result for each row of headers is remembered.
+    Parameters:
+        headers:    the column headers, in order
+        exact:      match the whole header, in order of the names' preference, rather than look for the names in it
+    Returns:
+        the headers for the roles, as a ColumnRoles
+    """
+    return _column_roles(tuple(str(header) for header in headers), exact)
+
+def test_infer_column_roles():
+    """
+    Without exact, the left-most header containing a name is chosen, otherwise the most preferred name
+    """
+    deseq2 = ['Gene ID', 'baseMean', 'log2FoldChange', 'lfcSE', 'stat', 'pvalue', 'padj']
+    assert infer_column_roles(deseq2) == ColumnRoles('Gene ID', 'log2FoldChange', 'pvalue')
+    cleaned = [squash_header(header) for header in deseq2]
+    assert infer_column_roles(cleaned, exact=True) == ColumnRoles('geneid', None, 'padj')
+    assert infer_column_roles(['symbol', 'ensembl', 'logfc', 'log2', 'fdr'], exact=True) == ColumnRoles('ensembl', 'log2', 'fdr')
+    assert infer_column_roles(['a', 'b']) == ColumnRoles(None, None, None)
+    # headers that aren't text, as pandas can give
+    assert infer_column_roles([0, 'logFC']).lfc == 'logFC'
+
+def test_column_roles_cache():
+    """
+    A row of headers seen before is not looked at again
+    """
+    headers = ['gene_symbol', 'logFC', 'logCPM', 'PValue', 'FDR', 'cache test']
+    infer_column_roles(headers)
+    hits = _column_roles.cache_info().hits
+    assert infer_column_roles(tuple(headers)) == infer_column_roles(headers)
+    assert _column_roles.cache_info().hits == hits + 2
@@ -7,6 +7,7 @@ for example. However, a utility for this allows us to use alternative, faster-lo
 """
 from rdflib import Graph
 from akg import load_graph, AKGException, akg_logging_config
+from tracking import DEFAULT_TRACKING_FILE, tracking_exists
 import argparse
 import logging
 import os
@@ -17,7 +18,7 @@ def main():
     # manage the command line options
     parser = argparse.ArgumentParser(description='Combine graph files into a single file')
     parser.add_argument('-i','--input_dir', default='data', help='Destination top-level directory for input data files (output files also written here)')
-    parser.add_argument('-t','--tracking_file', default='akg_tracking.xlsx', help='Tracking file name. This file is created in the top-level directory.')
+    parser.add_argument('-t','--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file is created in the top-level directory.')
     parser.add_argument('-l','--log', default='combine_graphs.log', help='Log file name. This file is created in the top-level directory.')
     parser.add_argument('-p','--pmid', default=None, help="Combine the graphs that have been created for the given PMID")
     parser.add_argument('-o','--output_file', default='combined.nt', help='Output file name. This file is created in the graphs directory.')
@@ -53,7 +54,7 @@ def main():
     logging.info(f"Tracking file configured but not currently used in combine_graphs")
 
     # the tracking file must exist because it tells us which files to process
-    if not os.path.exists(tracking_file):
+    if not tracking_exists(tracking_file):
         raise AKGException(f"Combining: {tracking_file} must exist")
 
     if pmid:
@@ -4,20 +4,58 @@ import rdflib
 from rdflib import Namespace, URIRef, Literal
 import sys
 import os
-import io
 from rdflib.namespace import XSD
 import uuid
 import json
+import re
+import hashlib
+import tempfile
+import shutil
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from akg import GeneIdStore, AKGException, FilenameUUIDMap, akg_logging_config, possible_lfc_names, possible_gene_names, possible_pval_names, find_first_match
+import numpy as np
+from akg import GeneIdStore, _write_test_gene_sources, write_table, GENE_ID_INDEX_VERSION, gene_id_source_files, files_hash, file_hash, is_parquet, deterministic_row_uuid, AKGException, FilenameUUIDMap, akg_logging_config, possible_lfc_names, possible_gene_names, possible_pval_names
+from column_roles import infer_column_roles
 import argparse
-from tracking import check_tracking_writeable, create_tracking, load_tracking, save_tracking, create_empty_tracking_store, add_to_tracking, tracking_entry
+from graph_cleanup import cleanup_literal_rules
+from tracking import check_tracking_writeable, Tracking, tracking_record, DEFAULT_TRACKING_FILE, tracking_exists
 import logging
 from akg import BIOLINK, ENSEMBL, NCBIGENE, RDFS, RDF, SCHEMA, EDAM, DOI, DCT, PMC, OWL, MONARCH, URN
 
 # Create a global instance of FilenameUUIDMap to manage UUIDs for filenames
 # actually set this up in the main function, so that it can be configured from the command line
 g_filename_uuid_map = None
+# The gene ID lookup is shared by every file processed, set up on first use
+g_gene_id_store = None
+
+# increment this when a change to this program changes the triples created from the same data file, 
+# so that the graphs recorded in the tracking file are not reused
+GRAPH_FORMAT_VERSION = 1
+
+# the ways the literal values can be written, see make_literals
+LITERAL_MODES = ('typed', 'cleanup', 'plain')
+# the lexical form of an xsd:double, without INF and NaN, which are not wanted as data values
+XSD_DOUBLE_PATTERN = r'[-+]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+
+def gene_id_sources() -> tuple[str,str]:
+    """
+    The files the gene ID lookup is built from: those of g_gene_id_store once it is set up, otherwise the defaults
+    """
+    if g_gene_id_store is not None:
+        return g_gene_id_store.source_files
+    return gene_id_source_files()
+
+def conversion_key(csv_file_path:str, gene_name:str, pval_name:str, lfc_name:str, deterministic:bool=False, literals:str='typed', metadata_file:str='') -> str:
+    """
+    Identify everything that determines the triples created from a data file: its content, the chosen columns,
+    the type of row URI and literal, the article metadata added to its graph (if any), the content of the gene ID 
+    lookup's source files and the versions of its index and of this program's output. Saved as 'graphhash' in the 
+    tracking file so that a later run can skip the file if none of these have changed.
+    """
+    metadata_hash = files_hash(metadata_file) if metadata_file else ''
+    settings = f"{file_hash(csv_file_path)}|{gene_name}|{pval_name}|{lfc_name}|{deterministic}|{literals}|{metadata_hash}|{files_hash(*gene_id_sources())}|{GENE_ID_INDEX_VERSION}|{GRAPH_FORMAT_VERSION}"
+    return hashlib.sha256(settings.encode('utf-8')).hexdigest()
 
 def create_base_graph():
     graph = rdflib.Graph()
@@ -38,14 +76,148 @@ def create_base_graph():
     graph.bind("urn", URN)
     return graph
 
-def process_metadata_csv(csv_file_path, graph):
+def nt_quote(value:str) -> str:
+    """
+    The quoted form of a literal's text in N-Triples, escaped by the same rule as Graph.serialize(format='nt')
+    """
+    return '"%s"' % value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"').replace('\r', '\\r')
+
+def nt_row(triple) -> str:
+    """
+    One (subject, predicate, object) triple as a line of N-Triples, written as Graph.serialize(format='nt') writes it
+    """
+    subject, predicate, obj = triple
+    if isinstance(obj, Literal):
+        if obj.language:
+            obj_text = f"{nt_quote(obj)}@{obj.language}"
+        elif obj.datatype:
+            obj_text = f"{nt_quote(obj)}^^<{obj.datatype}>"
+        else:
+            obj_text = nt_quote(obj)
+    else:
+        obj_text = obj.n3()
+    return f"{subject.n3()} {predicate.n3()} {obj_text} .\n"
+
+class NTriplesWriter:
+    """
+    Writes triples straight to an N-Triples file as they are added, instead of holding them in an rdflib Graph 
+    until it is serialized. Has the add() method of rdflib.Graph, so it can be passed to process_metadata_csv and
+    process_regular_csv in place of one. Each line is formatted by nt_row, so the URIs and literals are written exactly
+    as Graph.serialize(format='nt') would write them.
+
+    Unlike a Graph, no check is made for duplicate triples (for example the type triple added for a PMID by
+    each of its data files). Duplicate lines in N-Triples make no difference to the graph once it is loaded.
+
+    Example:
+        with NTriplesWriter('main_graph.nt') as graph:
+            process_metadata_csv(article_file_path, graph)
+    """
+    def __init__(self, filename:str, buffer_size:int=1024*1024):
+        self.filename = filename
+        self.count = 0
+        # newline='' so that the lines end in '\n' on every platform, as they do from Graph.serialize
+        self._file = open(filename, 'w', encoding='utf-8', newline='', buffering=buffer_size)
+    def add(self, triple):
+        """
+        Write one (subject, predicate, object) triple to the file
+        """
+        self._file.write(nt_row(triple))
+        self.count += 1
+    def append_file(self, filename:str):
+        """
+        Copy the triples from an existing N-Triples file to the end of this one
+        """
+        with open(filename, 'r', encoding='utf-8', newline='') as part:
+            while True:
+                chunk = part.read(1024*1024)
+                if not chunk:
+                    break
+                self._file.write(chunk)
+                self.count += chunk.count('\n')
+    def flush(self):
+        self._file.flush()
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            logging.info(f"{self.count} triples written to {self.filename}")
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def make_literals(values:list[str], literals:str='typed', numeric:bool=False, name:str='') -> list[Literal|None]:
+    """
+    Create the literals for a column of values, working on the whole column at once.
+    Parameters:
+    - values: the values, as read from the data file
+    - literals: one of LITERAL_MODES
+      'typed': blank values and '-' are left out, and the values in a numeric column are given the xsd:double datatype
+               where they are numbers (anything else, e.g. 'NA', is kept as a plain literal)
+      'cleanup': exactly what graph_cleanup.py would make of the plain literals: blank values and '-' left out, and any
+               value that looks like a number (in any column) given the xsd:double datatype
+      'plain': plain literals, with only empty values left out: the output before the datatypes were added here
+    - numeric: the column holds numbers (p-values or log fold changes)
+    - name: the name of the column, for the log
+    Returns:
+    - the literal for each value, or None where the value is left out
+    """
+    if literals == 'plain':
+        return [Literal(value) if value else None for value in values]
+    column = pd.Series(values, dtype=object)
+    if literals == 'cleanup':
+        dropped, double = cleanup_literal_rules(column.map(nt_quote))
+    elif literals == 'typed':
+        stripped = column.str.strip()
+        dropped = stripped.isin(('', '-'))
+        if numeric:
+            double = stripped.str.fullmatch(XSD_DOUBLE_PATTERN)
+            # a number too big for a double is not valid either
+            numbers = pd.to_numeric(stripped.where(double), errors='coerce')
+            double &= np.isfinite(numbers.astype(float))
+            column = stripped.where(double, column)
+            not_numbers = int((~double & ~dropped).sum())
+            if not_numbers:
+                logging.info(f"{not_numbers} values in column {name} are not numbers, and are kept as text")
+        else:
+            double = pd.Series(False, index=column.index)
+    else:
+        raise AKGException(f"Unknown literal type {literals}, must be one of {LITERAL_MODES}")
+    return [None if drop else Literal(value, datatype=XSD.double, normalize=False) if is_double else Literal(value)
+            for value, drop, is_double in zip(column, dropped, double)]
+
+def make_year_literal(value:str, literals:str='typed') -> Literal|None:
+    """
+    Create the literal for the year of an article, as for make_literals: with the xsd:gYear datatype if typed (or if cleanup,
+    and graph_cleanup.py would have added it)
+    """
+    if literals == 'plain':
+        return Literal(value) if value else None
+    if literals == 'cleanup':
+        if re.fullmatch(r'\s*|-', nt_quote(value)[1:-1]):
+            return None
+        if re.fullmatch(r'\d+', value):
+            return Literal(value, datatype=XSD.gYear, normalize=False)
+        return Literal(value)
+    stripped = value.strip()
+    if stripped in ('', '-'):
+        return None
+    # the year may have been written out as a float, e.g. 2020.0
+    year = pd.to_numeric(stripped, errors='coerce')
+    if pd.notna(year) and year == int(year) and 0 < year < 10000:
+        return Literal(f"{int(year):04d}", datatype=XSD.gYear, normalize=False)
+    logging.warning(f"Year {value} is not a year, kept as text")
+    return Literal(value)
+
+def process_metadata_csv(csv_file_path, graph, pmid:str|None=None, literals:str='typed'):
     """Retrieves data from the article metadata file and converts to triples
+    If pmid is given, only the metadata for that PMID is added.
+    The literals are created as given, see make_literals.
     """
     with open(csv_file_path, 'r') as csvfile:
         reader = csv.DictReader(csvfile)
         
         for row in reader:
-            if 'pmid' in row and row['pmid']:
+            if 'pmid' in row and row['pmid'] and (pmid is None or row['pmid'].strip() == str(pmid)):
                 pmid_uri = PMC[row['pmid']]
                 
                 for column, value in row.items():
@@ -53,27 +225,61 @@ def process_metadata_csv(csv_file_path, graph):
                         graph.add((pmid_uri, DCT.identifier, DOI[value]))
                 for column, value in row.items():
                     if column == 'title' and value:
-                        graph.add((pmid_uri, DCT.title, Literal(value)))
+                        title = make_literals([value], literals)[0]
+                        if title is not None:
+                            graph.add((pmid_uri, DCT.title, title))
                 for column, value in row.items():
                     if column == 'year' and value:
-                        graph.add((pmid_uri, DCT.date, Literal(value)))
+                        year = make_year_literal(value, literals)
+                        if year is not None:
+                            graph.add((pmid_uri, DCT.date, year))
                 for column, value in row.items():
                     if column == 'journal' and value:
-                        graph.add((pmid_uri, DCT.publisher, Literal(value)))
+                        journal = make_literals([value], literals)[0]
+                        if journal is not None:
+                            graph.add((pmid_uri, DCT.publisher, journal))
+
 
+def read_parquet_columns(file_path:str, gene_name:str='', pval_name:str='', lfc_name:str='')->pd.DataFrame:
+    """
+    Read only the gene, p-value and log fold change columns of a Parquet data file (see akg.write_table): those named,
+    or for those not named, the ones process_regular_csv would find from the header
+    """
+    import pyarrow.parquet as pq
+    names = pq.read_schema(file_path).names
+    header_fields = [name.strip().lower() for name in names]
+    roles = infer_column_roles(header_fields, exact=True)
+    wanted = {gene_name or roles.gene, pval_name or roles.pval, lfc_name or roles.lfc}
+    return pd.read_parquet(file_path, columns=[name for name, field in zip(names, header_fields) if field in wanted])
+
+def table_column_text(column:pd.Series)->list[str]:
+    """
+    The values of a table column as process_regular_csv reads them from a csv file written from the table by pandas:
+    missing values are empty, everything else as its text
+    """
+    return ['' if pd.isna(value) else str(value) for value in column.astype(object)]
 
-def process_regular_csv(csv_file_path:str, matched_genes, unmatched_genes, graph, graph_file:str, gene_name:str='', pval_name:str='', lfc_name:str='')-> (int,int):
+def process_regular_csv(csv_file_path:str, matched_genes, unmatched_genes, graph, graph_file:str, gene_name:str='', pval_name:str='', lfc_name:str='', row_uri_labels:dict|None=None, deterministic:bool=False, literals:str='typed', table:pd.DataFrame|None=None)-> (int,int):
     """processes the gene expression csv files (not the metadata file).
     Searches for relevant information, converts to triples while adding relevant prefixes.
     Parameters:
     - csv_file_path: Path to the CSV file to process
     - matched_genes: count of genes that have been matched so far
     - unmatched_genes: count of genes that have not been matched so far
-    - graph: RDF graph to add triples to
-    - graph_file: Path to the graph file
+    - graph: RDF graph to add triples to, or an NTriplesWriter that is writing them out as they are added
+    - graph_file: Path to the graph file. If graph is an rdflib Graph it is serialized here when the file is finished
     - gene_name: Name of the gene column
     - pval_name: Name of the p-value column
     - lfc_name: Name of the log fold change column
+    - row_uri_labels: if given, the row labels are added to this instead, for the caller to save with save_row_uri_labels
+      (used when several files go into one graph file)
+    - deterministic: derive each row URI from the dataset UUID and row number (see deterministic_row_uuid), 
+      rather than a new random UUID, so that re-running gives identical triples. The row labels are not saved in this case.
+    - literals: how the literals are written, one of LITERAL_MODES (see make_literals)
+    - table: if given, the contents of csv_file_path, already in memory and not necessarily written out (see pipeline.py). 
+      Only the columns needed are taken from it, as the text the csv file written from it would hold (see table_column_text).
+      csv_file_path still names the dataset.
+      csv_file_path can also be a Parquet file, of which only the columns needed are read (see read_parquet_columns).
     Returns:
     - A tuple containing the updated counts of matched and unmatched genes
     """
@@ -89,28 +295,44 @@ def process_regular_csv(csv_file_path:str, matched_genes, unmatched_genes, graph
     graph.add((pmid_uri, RDF.type, DCT.identifier))
     
     # cached gene_id.txt data for faster lookup
-    mygids = GeneIdStore()
+    global g_gene_id_store
+    if g_gene_id_store is None:
+        g_gene_id_store = GeneIdStore()
+    mygids = g_gene_id_store
 
     # record the row uris/uuids that have been identified for this file, with their numeric index, so that we can identify them in metadata
-    row_uri_labels = {}
+    shared_labels = row_uri_labels is not None
+    if not shared_labels:
+        row_uri_labels = {}
     filename_row_uri_labels = f"{filename}_row_uri_labels.json"
 
-    total_rows = sum(1 for _ in open(csv_file_path, 'r'))
-    logging.info(f"Processing {total_rows} rows in {csv_file_path}")
-    report_interval = max(1, total_rows // 10)  # Report every 10% of the rows
+    logging.info(f"Processing {csv_file_path}")
+    # only the columns needed are read from a Parquet file, so it has none if none of them are there
+    projected = table is None and is_parquet(csv_file_path)
+    if projected:
+        table = read_parquet_columns(csv_file_path, gene_name, pval_name, lfc_name)
     # switching to raw file reading, DictReader and pandas didn't handle all files correctly
     # Open the file with 'utf-8-sig' encoding to handle potential BOM characters
-    with open(csv_file_path, mode='r', newline='', encoding='utf-8-sig') as csvfile:
-        # Read the raw header line
-        header_line = csvfile.readline()
-        if not header_line:
-            raise ValueError("File appears to be empty.")
-        # data_convert writes out with lines quoted
-        header_line = header_line.strip().strip('"')
-
-        # Manually split the header by commas
-        # .strip() removes whitespace/newlines from the ends
-        header_fields = [h.strip().lower() for h in header_line.strip().split(',')]
+    if table is None:
+        csvfile = open(csv_file_path, mode='r', newline='', encoding='utf-8-sig')
+    else:
+        csvfile = contextlib.nullcontext()
+    with csvfile:
+        if table is None:
+            # Read the raw header line
+            header_line = csvfile.readline()
+            if not header_line:
+                raise ValueError("File appears to be empty.")
+            # data_convert writes out with lines quoted
+            header_line = header_line.strip().strip('"')
+
+            # Manually split the header by commas
+            # .strip() removes whitespace/newlines from the ends
+            header_fields = [h.strip().lower() for h in header_line.strip().split(',')]
+        else:
+            if len(table.columns) == 0 and not projected:
+                raise ValueError("File appears to be empty.")
+            header_fields = [str(name).strip().lower() for name in table.columns]
 
         logging.info(f"Header processed. Found {len(header_fields)} columns.")
 
@@ -119,9 +341,11 @@ def process_regular_csv(csv_file_path:str, matched_genes, unmatched_genes, graph
         pval_found = False
 
         gene_index = lfc_index = pval_index = 0
+        # the columns not named in the tracking file are found from the header, all at once
+        roles = infer_column_roles(header_fields, exact=True)
         # Find the index of the 'gene' column
         if not gene_name:
-            gene_name = find_first_match(possible_gene_names, header_fields)
+            gene_name = roles.gene
             if not gene_name:
                 logging.warning(f"No gene column found in {csv_file_path}. Checked for: {possible_gene_names}")
         if gene_name:
@@ -136,7 +360,7 @@ def process_regular_csv(csv_file_path:str, matched_genes, unmatched_genes, graph
         # Find the index of the 'pval' column
         # spell these out one by one for debugging, should be shrunk into a single shared code block later
         if not pval_name:
-            pval_name = find_first_match(possible_pval_names, header_fields)
+            pval_name = roles.pval
             if not pval_name:
                 logging.warning(f"No pval column found in {csv_file_path}. Checked for: {possible_pval_names}")
         if pval_name:
@@ -150,7 +374,7 @@ def process_regular_csv(csv_file_path:str, matched_genes, unmatched_genes, graph
 
         # Find the index of the 'lfc' column
         if not lfc_name:
-            lfc_name = find_first_match(possible_lfc_names, header_fields)
+            lfc_name = roles.lfc
             if not lfc_name:
                 logging.warning(f"No lfc column found in {csv_file_path}. Checked for: {possible_lfc_names}")
         if lfc_name:
@@ -166,97 +390,286 @@ def process_regular_csv(csv_file_path:str, matched_genes, unmatched_genes, graph
             logging.warning(f"No relevant columns found in {csv_file_path}.")
             return matched_genes, unmatched_genes
 
-        # Loop through the rest of the file to process data rows
-        rowIndex = 0
-        for i, line in enumerate(csvfile):
-#            data_fields = line.strip().strip('"').split(',')
-# attempt 3 to get this robust. The header line is working so just use csv_reader to get the data lines.
-            # Use io.StringIO to treat the string like a file
-            line_as_file = io.StringIO(line)
-
-            # The csv.reader does all the hard work for you
-            csv_reader = csv.reader(line_as_file)
-
-            # The reader returns rows, so we loop (it will only loop once for a single line)
-            data_fields = []
-            for row in csv_reader:
-                data_fields = row
-                break            
-
-            # Ensure the row has enough columns before we try to access our index
-            n_fields = len(data_fields)
+        # Loop through the rest of the file to collect the data rows
+        # the gene names are then looked up as a whole column, before the triples are added
+        if table is not None:
+            # the columns are taken straight from the table, as the text they would be written out as
+            gene_symbols = table_column_text(table.iloc[:, gene_index])
+            pval_symbols = table_column_text(table.iloc[:, pval_index])
+            lfc_symbols = table_column_text(table.iloc[:, lfc_index])
+        else:
+            gene_symbols = []
+            pval_symbols = []
+            lfc_symbols = []
+            # The header line is working so just use a csv reader to get the data lines. A single reader for the whole file,
+            # reading it in one pass: the rows are written by pandas, so any value with a line break in it is quoted
+            csv_reader = csv.reader(csvfile)
             m_index = max(gene_index, pval_index, lfc_index)
-            if n_fields > m_index:
-                if gene_name:
-                    gene_symbol = data_fields[gene_index]
-                if pval_name:
-                    pval_symbol = data_fields[pval_index]
-                if lfc_name:
-                    lfc_symbol = data_fields[lfc_index]
-            else:
-                logging.warning(f"Skipping malformed row #{i + 2} (has {n_fields} columns) which is less than {m_index + 1}")
-                continue
+            for data_fields in csv_reader:
+                # Ensure the row has enough columns before we try to access our index
+                n_fields = len(data_fields)
+                if n_fields > m_index:
+                    gene_symbols.append(data_fields[gene_index])
+                    pval_symbols.append(data_fields[pval_index])
+                    lfc_symbols.append(data_fields[lfc_index])
+                else:
+                    # line_num counts the lines read by the reader, so add the header line
+                    logging.warning(f"Skipping malformed row #{csv_reader.line_num + 1} (has {n_fields} columns) which is less than {m_index + 1}")
 
-            if rowIndex % report_interval == 0:
-                logging.info(f"Processing row {rowIndex} of {total_rows}")
-            row_uuid = str(uuid.uuid4())
-            row_uri = URN[row_uuid]
-            graph.add((dataset_uri, EDAM.has_output, row_uri))
-            # retain the row number: because this is to be used as a label, create as text now
-            row_uri_labels[row_uri] = f'row {rowIndex}'
-
-            # add the gene
-            if gene_name:
-                row_gene = gene_symbol
-                if row_gene:
-                    monarch_uri = mygids.get_gene_id(row_gene)
-                    if monarch_uri:
-                        full_monarch_uri = MONARCH[monarch_uri]
-                        graph.add((row_uri, BIOLINK.Gene, full_monarch_uri))
-                        logging.debug(f"Added gene information for {row_gene}: {full_monarch_uri}")
-                        matched_genes += 1
+    total_rows = len(gene_symbols)
+    logging.info(f"Found {total_rows} data rows in {csv_file_path}")
+    report_interval = max(1, total_rows // 10)  # Report every 10% of the rows
+
+    if gene_name:
+        # empty cells are never looked up
+        gene_ids = mygids.resolve_many(gene_symbol if gene_symbol else None for gene_symbol in gene_symbols)
+    # and the literals are created a column at a time
+    no_literals = [None] * len(gene_symbols)
+    gene_literals = make_literals(gene_symbols, literals, name=gene_name) if gene_name else no_literals
+    pval_literals = make_literals(pval_symbols, literals, numeric=True, name=pval_name) if pval_name else no_literals
+    lfc_literals = make_literals(lfc_symbols, literals, numeric=True, name=lfc_name) if lfc_name else no_literals
+
+    rowIndex = 0
+    for gene_symbol, gene_literal, pval_literal, lfc_literal in zip(gene_symbols, gene_literals, pval_literals, lfc_literals):
+        if rowIndex % report_interval == 0:
+            logging.info(f"Processing row {rowIndex} of {total_rows}")
+        row_uuid = deterministic_row_uuid(dataset_uuid, rowIndex) if deterministic else str(uuid.uuid4())
+        row_uri = URN[row_uuid]
+        graph.add((dataset_uri, EDAM.has_output, row_uri))
+        # retain the row number: because this is to be used as a label, create as text now
+        row_uri_labels[row_uri] = f'row {rowIndex}'
+
+        # add the gene
+        if gene_name:
+            row_gene = gene_symbol
+            if row_gene:
+                monarch_uri = gene_ids[rowIndex]
+                if monarch_uri:
+                    full_monarch_uri = MONARCH[monarch_uri]
+                    graph.add((row_uri, BIOLINK.Gene, full_monarch_uri))
+                    logging.debug(f"Added gene information for {row_gene}: {full_monarch_uri}")
+                    matched_genes += 1
+                else:
+                    if gene_literal is None:
+                        pass
+                    elif 'ensembl' in gene_name.lower():
+                        graph.add((row_uri, ENSEMBL.id, gene_literal))
+                    elif 'entrez' in gene_name.lower() or 'ncbi' in gene_name.lower():
+                        graph.add((row_uri, NCBIGENE.id, gene_literal))
                     else:
-                        if 'ensembl' in gene_name.lower():
-                            graph.add((row_uri, ENSEMBL.id, Literal(row_gene)))
-                        elif 'entrez' in gene_name.lower() or 'ncbi' in gene_name.lower():
-                            graph.add((row_uri, NCBIGENE.id, Literal(row_gene)))
-                        else:
-                            graph.add((row_uri, BIOLINK.symbol, Literal(row_gene)))
-                        unmatched_genes += 1
-
-            # add the p-value
-            if pval_name:
-                row_pval = pval_symbol
-                if row_pval:
-                    logging.debug(f"Adding pval information for {row_pval}")
-                    graph.add((row_uri, EDAM.data_1669, Literal(row_pval)))
-
-            # add the log fold change
-            if lfc_name:
-                row_lfc = lfc_symbol
-                if row_lfc:
-                    logging.debug(f"Adding lfc information for {row_lfc}")
-                    graph.add((row_uri, EDAM.data_3754, Literal(row_lfc)))
+                        graph.add((row_uri, BIOLINK.symbol, gene_literal))
+                    unmatched_genes += 1
+
+        # add the p-value
+        if pval_literal is not None:
+            logging.debug(f"Adding pval information for {pval_literal}")
+            graph.add((row_uri, EDAM.data_1669, pval_literal))
+
+        # add the log fold change
+        if lfc_literal is not None:
+            logging.debug(f"Adding lfc information for {lfc_literal}")
+            graph.add((row_uri, EDAM.data_3754, lfc_literal))
 
 #                     # Add any other columns as generic predicates - removed for now to reduce graph size but can be readded for future use
 # #                        predicate = URIRef(f"rdf:predicate/{column}")
 # #                        graph.add((row_uri, predicate, Literal(value)))
-            rowIndex += 1
+        rowIndex += 1
     logging.info(f"Finished processing {rowIndex} rows in {csv_file_path}")
 
     # Save the row URI labels to a file for later reference
     logging.info(f"Saving graph file ...")
     if graph_file:
-        graph.serialize(destination=graph_file, format='nt', encoding= "utf-8" )
-        filename_row_uri_labels_path = graph_file + '.row_uri_labels.json'
-        row_uri_labels = {str(k): v for k, v in row_uri_labels.items()}  # Convert keys to strings for JSON serialization
-        with open(filename_row_uri_labels_path, 'w') as f:
-            json.dump(row_uri_labels, f)
-    else:
-        logging.warning(f"Warning: graph_folder not provided, row_uri_labels not saved to {filename_row_uri_labels_path}")
+        if isinstance(graph, NTriplesWriter):
+            # the triples have been written out already, as they were added
+            graph.flush()
+        else:
+            graph.serialize(destination=graph_file, format='nt', encoding= "utf-8" )
+        if deterministic:
+            logging.info(f"Deterministic row URIs, so row labels are not saved for {graph_file}")
+        elif not shared_labels:
+            save_row_uri_labels(graph_file, row_uri_labels)
+    elif not shared_labels and not deterministic:
+        logging.warning(f"Warning: graph_folder not provided, row_uri_labels not saved to {filename_row_uri_labels}")
+
+    return matched_genes, unmatched_genes
+
+def save_row_uri_labels(graph_file:str, row_uri_labels:dict):
+    """
+    Save the row URI labels alongside the graph file, for later reference
+    """
+    filename_row_uri_labels_path = graph_file + '.row_uri_labels.json'
+    row_uri_labels = {str(k): v for k, v in row_uri_labels.items()}  # Convert keys to strings for JSON serialization
+    with open(filename_row_uri_labels_path, 'w') as f:
+        json.dump(row_uri_labels, f)
+
+def init_worker(file_to_uuid_path:str, log_file:str):
+    """
+    Set up a process in the pool used by the --jobs option. The dataset UUIDs have all been allocated by the
+    main process before the pool is started, so the map is only read here, never written.
+    """
+    global g_filename_uuid_map
+    akg_logging_config(log_file)
+    g_filename_uuid_map = FilenameUUIDMap(file_to_uuid_path)
 
+def convert_file(csv_file_path:str, graph_file:str, gene_name:str, pval_name:str, lfc_name:str, stream:bool, metadata_file:str='', labels:bool=True, deterministic:bool=False, literals:str='typed', table:pd.DataFrame|None=None) -> tuple[int,int]:
+    """
+    Convert one data file into a graph file of its own: used for the per file graphs, and by the --jobs option.
+    Parameters:
+    - csv_file_path: Path to the CSV file to process
+    - graph_file: Path to the graph file to write
+    - gene_name, pval_name, lfc_name: the column names, as for process_regular_csv
+    - stream: write the triples as they are created, rather than serializing an rdflib Graph at the end
+    - metadata_file: if given, the article metadata file to add to the graph as well
+    - labels: write the row URI labels file alongside the graph file
+    - deterministic: use deterministic row URIs, as for process_regular_csv
+    - literals: how the literals are written, as for process_regular_csv
+    - table: the data already in memory, as for process_regular_csv
+    Returns:
+    - A tuple containing the counts of matched and unmatched genes in this file
+    """
+    graph = NTriplesWriter(graph_file) if stream else create_base_graph()
+    try:
+        # add the metadata in to every graph, not big, if requested
+        if metadata_file:
+            logging.info(f"Processing file: {metadata_file}")
+            process_metadata_csv(metadata_file, graph, literals=literals)
+        matched_genes, unmatched_genes = process_regular_csv(csv_file_path, 0, 0, graph, graph_file if labels else '', gene_name, pval_name, lfc_name, deterministic=deterministic, literals=literals, table=table)
+        if not stream and not labels:
+            graph.serialize(destination=graph_file, format='nt', encoding= "utf-8" )
+    finally:
+        if stream:
+            graph.close()
     return matched_genes, unmatched_genes
 
+def convert_pmid(pmid:str, conversions:list[tuple[str,str,str,str]], graph_file:str, metadata_file:str='', deterministic:bool=False, literals:str='typed') -> list[tuple[int,int]]:
+    """
+    Convert all the data files for one PMID into a single graph file, written as the triples are created. 
+    The graph also gets the article metadata for this PMID, but no other.
+    Parameters:
+    - pmid: the PMID
+    - conversions: the data files, each as (csv_file_path, gene_name, pval_name, lfc_name)
+    - graph_file: Path to the graph file to write
+    - metadata_file: the article metadata file, if available
+    - deterministic: use deterministic row URIs, as for process_regular_csv
+    - literals: how the literals are written, as for process_regular_csv
+    Returns:
+    - For each data file in turn, a tuple containing the counts of matched and unmatched genes in that file
+    """
+    counts = []
+    row_uri_labels = {}
+    with NTriplesWriter(graph_file) as graph:
+        if metadata_file:
+            process_metadata_csv(metadata_file, graph, pmid, literals)
+        for csv_file_path, gene_name, pval_name, lfc_name in conversions:
+            logging.info(f"Processing file: {csv_file_path}")
+            counts.append(process_regular_csv(csv_file_path, 0, 0, graph, graph_file, gene_name, pval_name, lfc_name, row_uri_labels, deterministic, literals))
+    if not deterministic:
+        save_row_uri_labels(graph_file, row_uri_labels)
+    return counts
+
+def test_conversion_key():
+    """
+    The key changes with the article metadata added and with the content of the gene ID lookup's source files
+    """
+    global g_gene_id_store
+    gene_id_store = g_gene_id_store
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        gene_ids, hgnc_file = _write_test_gene_sources(scratch_dir)
+        data_file = os.path.join(scratch_dir, 'clean_a.csv')
+        metadata_file = os.path.join(scratch_dir, 'asd_article_metadata.csv')
+        for file_path in (data_file, metadata_file):
+            with open(file_path, 'w') as f:
+                f.write('a,b\n1,2\n')
+        try:
+            g_gene_id_store = GeneIdStore(gene_ids, hgnc_file, use_index=False)
+            key = conversion_key(data_file, 'gene', 'pvalue', 'logfc')
+            assert conversion_key(data_file, 'gene', 'pvalue', 'logfc') == key
+            with_metadata = conversion_key(data_file, 'gene', 'pvalue', 'logfc', metadata_file=metadata_file)
+            assert with_metadata != key
+            with open(metadata_file, 'a') as f:
+                f.write('3,4\n')
+            assert conversion_key(data_file, 'gene', 'pvalue', 'logfc', metadata_file=metadata_file) not in (key, with_metadata)
+            with open(gene_ids, 'a') as f:
+                f.write('HGNC:7\tA2M\tENSG00000175899\n')
+            assert conversion_key(data_file, 'gene', 'pvalue', 'logfc') != key
+        finally:
+            g_gene_id_store = gene_id_store
+
+def test_parquet_columns():
+    """
+    A Parquet data file gives the same triples as the same table as a csv file, and one without any of the columns
+    needed is passed over, as the csv file is
+    """
+    global g_gene_id_store, g_filename_uuid_map
+    gene_id_store, filename_uuid_map = g_gene_id_store, g_filename_uuid_map
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        gene_ids, hgnc_file = _write_test_gene_sources(scratch_dir)
+        try:
+            g_gene_id_store = GeneIdStore(gene_ids, hgnc_file, use_index=False)
+            g_filename_uuid_map = FilenameUUIDMap(os.path.join(scratch_dir, 'filename_uuid_map.json'))
+            tables = {'clean_a': pd.DataFrame({'gene': ['A1BG', 'NRXN1'], 'note': ['x', 'y'], 'pvalue': [0.001, np.nan], 'logfc': [1.5, -0.5]}),
+                      'clean_b': pd.DataFrame({'foo': ['x'], 'bar': [1]})}
+            for name, table in tables.items():
+                graphs = []
+                for extension in ('.csv', '.parquet'):
+                    file_path = os.path.join(scratch_dir, name + extension)
+                    write_table(table, file_path)
+                    graph = create_base_graph()
+                    counts = process_regular_csv(file_path, 0, 0, graph, '', deterministic=True)
+                    graphs.append((counts, sorted(graph)))
+                assert graphs[0] == graphs[1]
+            assert graphs[0][0] == (0, 0)
+        finally:
+            g_gene_id_store, g_filename_uuid_map = gene_id_store, filename_uuid_map
+
+def test_table_column_text():
+    """
+    A column taken from a table holds the same text as the csv file written from the table
+    """
+    table = pd.DataFrame({'gene': ['A1BG', None, 'NRXN1'], 'pvalue': [1e-05, np.nan, 0.1 + 0.2], 'logfc': [1, 2, 3]})
+    rows = list(csv.reader(table.to_csv(index=False).splitlines()))[1:]
+    for index, name in enumerate(table.columns):
+        assert table_column_text(table[name]) == [row[index] for row in rows]
+
+def test_ntriples_writer():
+    """
+    The streamed file must hold the same triples as the serialized in-memory graph
+    """
+    triples = [(PMC['12345678'], DCT.title, Literal('A "quoted" title\nover two lines')),
+               (PMC['12345678'], RDF.type, DCT.identifier),
+               (URN['0d5e6c52-0000-4000-8000-000000000000'], EDAM.data_1669, Literal('1e-5')),
+               (URN['0d5e6c52-0000-4000-8000-000000000000'], BIOLINK.symbol, Literal('caf\u00e9')),
+               (URN['0d5e6c52-0000-4000-8000-000000000000'], EDAM.data_3754, Literal(' -1.5', datatype=XSD.double, normalize=False)),
+               (PMC['12345678'], DCT.title, Literal('back\\slash\r\nand "quotes"', lang='en')),
+               (PMC['12345678'], DCT.date, Literal('2020', datatype=XSD.gYear, normalize=False))]
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        graph = create_base_graph()
+        graph_file = os.path.join(scratch_dir, 'graph.nt')
+        stream_file = os.path.join(scratch_dir, 'stream.nt')
+        with NTriplesWriter(stream_file) as writer:
+            for triple in triples:
+                graph.add(triple)
+                writer.add(triple)
+        graph.serialize(destination=graph_file, format='nt', encoding="utf-8")
+        with open(graph_file, 'rb') as gf, open(stream_file, 'rb') as sf:
+            assert sorted(gf.read().splitlines()) == sorted(sf.read().splitlines())
+
+def test_make_literals():
+    values = ['0.05', ' 1E-05 ', 'NA', '-', '', ' ', '7', '1e999']
+    typed = make_literals(values, 'typed', numeric=True)
+    assert typed[0] == Literal('0.05', datatype=XSD.double, normalize=False)
+    assert typed[1] == Literal('1E-05', datatype=XSD.double, normalize=False)
+    assert typed[2] == Literal('NA')
+    assert typed[3:6] == [None, None, None]
+    assert typed[7] == Literal('1e999')
+    assert make_literals(values, 'typed')[6] == Literal('7')
+    cleanup = make_literals(values, 'cleanup')
+    assert cleanup[6] == Literal('7', datatype=XSD.double, normalize=False)
+    assert cleanup[1] == Literal(' 1E-05 ')
+    assert make_literals(values, 'plain') == [Literal(value) if value else None for value in values]
+    assert make_year_literal('2020.0') == Literal('2020', datatype=XSD.gYear, normalize=False)
+    assert make_year_literal('2020.0', 'cleanup') == Literal('2020.0')
+
 def test_unicode_bug_1():
     """
     has been crashing after processing the given file
@@ -274,9 +687,14 @@ if __name__ == '__main__':
     # manage the command line options
     parser = argparse.ArgumentParser(description='Convert downloaded supplementary data to graph precursor')
     parser.add_argument('-i','--input_dir', default='data', help='Destination top-level directory for input data files (output files also written here)')
-    parser.add_argument('-t','--tracking_file', default='akg_tracking.xlsx', help='Tracking file name. This file is created in the top-level directory.')
+    parser.add_argument('-t','--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file is created in the top-level directory.')
     parser.add_argument('-f','--per_file', action='store_true', help="Create one graph per data file (default is one graph)")
-    parser.add_argument('-p','--per_pmid', action='store_true', help="Create one graph per PMID (default is one graph). Overridden by per_file)")
+    parser.add_argument('-p','--per_pmid', action='store_true', help="Create one graph per PMID, graph_<pmid>.nt in the PMID's directory (default is one graph). Overridden by per_file)")
+    parser.add_argument('-s','--stream', action='store_true', help="Write the triples to the graph file(s) as they are created, instead of building each graph in memory first")
+    parser.add_argument('-j','--jobs', type=int, default=1, help="Number of data files to convert at the same time, in separate processes (default 1)")
+    parser.add_argument('-r','--rebuild', action='store_true', help="Convert every data file. By default, with -f or -p, files unchanged since their graph was created are skipped")
+    parser.add_argument('-d','--deterministic', action='store_true', help="Derive each row URI from its dataset and row number, so that re-running gives identical graphs (default is a random UUID for each row)")
+    parser.add_argument('-y','--literals', default='typed', choices=LITERAL_MODES, help="How to write the values: 'typed' gives the p-values, log fold changes and years their datatypes (the default), 'cleanup' gives exactly the output of graph_cleanup.py, 'plain' gives untyped values as graph_cleanup.py expects")
     parser.add_argument('-m','--metadata', action='store_true', help="Process the article metadata file (default is to process all data files)")
     parser.add_argument('-l','--log', default='create_rdf_triples.log', help='Log file name. This file is created in the top-level directory.')
 
@@ -288,6 +706,11 @@ if __name__ == '__main__':
     per_file = config['per_file']
     per_pmid = config['per_pmid']
     metadata = config['metadata']
+    stream = config['stream']
+    jobs = config['jobs']
+    rebuild = config['rebuild']
+    deterministic = config['deterministic']
+    literals = config['literals']
 
     main_dir = config['input_dir']
 
@@ -302,7 +725,7 @@ if __name__ == '__main__':
     tracking_file = config['tracking_file']
     tracking_file = os.path.join(main_dir, tracking_file)
 
-    if not os.path.exists(tracking_file):
+    if not tracking_exists(tracking_file):
         raise AKGException(f"create_rdf_triples: {tracking_file} must exist")
 
     if not check_tracking_writeable(tracking_file):
@@ -335,93 +758,190 @@ if __name__ == '__main__':
         adf = pd.read_csv(article_file_path, encoding='unicode_escape')
 
     # the exclusion is now in the tracking file
-    tdf = load_tracking(tracking_file)
-    
-    # create a local DataFrame to hold the tracking information for this run
-    local_tdf = create_empty_tracking_store()
+    tracking = Tracking(tracking_file, step=3)
+
+    # with more than one job, the data files are converted by a pool of processes, and the results 
+    # (including all the tracking updates) are collected here after the loop over the tracking data
+    pool = None
+    pending = []
+    part_folder = ''
+    if jobs > 1:
+        # the processes only read the UUID map, so add the data files to it before the pool starts
+        to_convert = tracking.rows_for_step(3, excluded=False)
+        for file in to_convert['file']:
+            g_filename_uuid_map.get_uuid(os.path.splitext(file)[0])
+        logging.info(f"Converting {len(to_convert)} files with {jobs} processes")
+        pool = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(file_to_uuid_path, os.path.join(main_dir, config['log'])))
+        if not per_file and not per_pmid:
+            # each process writes its part of the single graph here, to be copied into it in tracking file order
+            part_folder = tempfile.mkdtemp(prefix='parts_', dir=graph_folder)
 
     # used by the all-together approach
-    global_graph = create_base_graph()
+    global_graph = None
+    global_graph_file = os.path.join(graph_folder, 'main_graph.nt')
 
     # per file means separate graphs for each csv file, to be combined by combine_graphs
     if per_file:
         logging.info('per file graph output chosen')
     elif per_pmid:
-        logging.info('per pmid not yet implemented')
+        logging.info('per pmid graph output chosen')
+        # the data files to convert, for each PMID, in tracking file order: the conversion is done after the loop
+        pmid_conversions = {}
+        pmid_metadata_file = article_file_path if os.path.isfile(article_file_path) else ''
     else:
         global_csv_count = 0
         global_matched_genes = 0
         global_unmatched_genes = 0
 
+        if stream:
+            logging.info(f"Streaming triples to {global_graph_file}")
+            global_graph = NTriplesWriter(global_graph_file)
+        else:
+            global_graph = create_base_graph()
+
         logging.info(f"Processing file: {article_file_path}")
-        process_metadata_csv(article_file_path, global_graph)
-
-    for index, row in tdf.iterrows():
-        # only handle the output of csv_data_cleaning (step 3)
-        if row['step'] == 3:
-            excl = row['excl']
-            root = row['path']
-            file = row['file']
-            pmid = row['pmid']
-            gene_name = row['gene']
-            pval_name = row['pval']
-            lfc_name  = row['lfc']
-            file_path = os.path.join(root, file)
-            if excl:
-                logging.info(f"Excluding file: {file_path} manual: {row['manual']} : {row['manualreason']}")
+        process_metadata_csv(article_file_path, global_graph, literals=literals)
+
+    # only handle the output of csv_data_cleaning (step 3)
+    for index, row in tracking.entries(3):
+        excl = row['excl']
+        root = row['path']
+        file = row['file']
+        pmid = row['pmid']
+        gene_name = row['gene']
+        pval_name = row['pval']
+        lfc_name  = row['lfc']
+        file_path = os.path.join(root, file)
+        if excl:
+            logging.info(f"Excluding file: {file_path} manual: {row['manual']} : {row['manualreason']}")
+        else:
+            logging.info(f"Processing file: {file_path}")
+            if per_file:
+                metadata_file = article_file_path if metadata else ''
+                key = conversion_key(file_path, gene_name, pval_name, lfc_name, deterministic, literals, metadata_file)
+                graph_file_name = f"graph_{file}.nt"
+                graph_file = os.path.join(root, graph_file_name)
+                if not rebuild and row['graphhash'] == key and os.path.isfile(graph_file):
+                    logging.info(f"Skipping file: {file_path}, unchanged since {graph_file} was created")
+                    continue
+                if not metadata:
+                    logging.info(f"Skipping metadata processing for file: {article_file_path}")
+                # the tracking entry for the new file
+                new_entry = tracking_record(4, root, pmid, graph_file_name, False, True, file_path, False, False, '', 0, '', '', '', graph_file_name, 0, 0, False, '')
+
+                if pool is not None:
+                    future = pool.submit(convert_file, file_path, graph_file, gene_name, pval_name, lfc_name, stream, metadata_file, True, deterministic, literals)
+                    pending.append((index, file_path, graph_file, new_entry, key, future))
+                    continue
+
+                file_matched, file_unmatched = convert_file(file_path, graph_file, gene_name, pval_name, lfc_name, stream, metadata_file, True, deterministic, literals)
+                matched_genes += file_matched
+                unmatched_genes += file_unmatched
+                logging.info(f"Processing file: {file_path} complete")
+                logging.info(f"Combined graph has been serialized to {graph_file}")
+                tracking.set(index, graphfile=graph_file, unmatched=file_unmatched, matched=file_matched, graphhash=key)
+                # Add the new file to the tracking, unless an earlier run already has
+                if tracking.find(4, root, graph_file_name) is None:
+                    tracking.add(new_entry)
+                # record the progress so far in the tracking journal, so that a run that stops part way can carry on from here
+                tracking.checkpoint()
+
+            elif per_pmid:
+                # each PMID's graph gets the article metadata, if there is any
+                key = conversion_key(file_path, gene_name, pval_name, lfc_name, deterministic, literals, pmid_metadata_file)
+                pmid_conversions.setdefault(str(pmid), []).append((index, root, key, (file_path, gene_name, pval_name, lfc_name)))
+            elif pool is not None:
+                part_file = os.path.join(part_folder, f"part_{len(pending)}.nt")
+                future = pool.submit(convert_file, file_path, part_file, gene_name, pval_name, lfc_name, True, '', False, deterministic, literals)
+                pending.append((index, file_path, part_file, None, '', future))
             else:
-                logging.info(f"Processing file: {file_path}")
-                if per_file:
-                    graph = create_base_graph()
-                    # add the metadata in to every graph, not big, if requested
-                    if metadata:
-                        logging.info(f"Processing file: {article_file_path}")
-                        process_metadata_csv(article_file_path, graph)
-                    else:
-                        logging.info(f"Skipping metadata processing for file: {article_file_path}")
-
-                    mg_before = matched_genes
-                    ug_before = unmatched_genes
-                    graph_file_name = f"graph_{file}.nt"
-                    graph_file = os.path.join(root, graph_file_name)
-
-                    matched_genes, unmatched_genes = process_regular_csv(file_path, matched_genes, unmatched_genes, graph, graph_file, gene_name, pval_name, lfc_name)
-                    logging.info(f"Processing file: {file_path} complete")
-                    logging.info(f"Combined graph has been serialized to {graph_file}")
-                    tdf.loc[index,'graphfile'] = graph_file
-                    tdf.loc[index,'unmatched'] = (unmatched_genes-ug_before)
-                    tdf.loc[index,'matched']   = (matched_genes-mg_before)
-                    # write out the updated information for the source dataset (will have the new files we just wrote out)
-                    # do this inside the loop so that we can keep track of the progress of an aborted run
-                    save_tracking(tdf, tracking_file)
-                    # Add the new file to the local tracking DataFrame
-                    new_entry = tracking_entry(4, root, pmid, graph_file_name, False, True, file_path, False, False, '', 0, '', '', '', graph_file_name, 0, 0, False, '')
-
-                    local_tdf = add_to_tracking(local_tdf, new_entry)
-
-                elif per_pmid:
-                    logging.info('per pmid not yet implemented')
-                else:
-                    mg_before = matched_genes
-                    ug_before = unmatched_genes
-                    matched_genes, unmatched_genes = process_regular_csv(file_path, matched_genes, unmatched_genes, global_graph)
-                    global_matched_genes += matched_genes - mg_before
-                    global_unmatched_genes += unmatched_genes - ug_before
-    
-    # add the new entries
-    tdf = add_to_tracking(tdf, local_tdf)
+                mg_before = matched_genes
+                ug_before = unmatched_genes
+                matched_genes, unmatched_genes = process_regular_csv(file_path, matched_genes, unmatched_genes, global_graph, '', gene_name, pval_name, lfc_name, deterministic=deterministic, literals=literals)
+                global_matched_genes += matched_genes - mg_before
+                global_unmatched_genes += unmatched_genes - ug_before
     
-    # write out the updated information (should have the new files we just wrote out)
-    save_tracking(tdf, tracking_file)
+    # collect the results from the pool, in tracking file order
+    for index, file_path, output_file, new_entry, key, future in pending:
+        try:
+            file_matched, file_unmatched = future.result()
+        except Exception as e:
+            logging.error(f"Failed to convert file: {file_path}: {str(e)}")
+            continue
+        logging.info(f"Processing file: {file_path} complete")
+        matched_genes += file_matched
+        unmatched_genes += file_unmatched
+        if per_file:
+            tracking.set(index, graphfile=output_file, unmatched=file_unmatched, matched=file_matched, graphhash=key)
+            if tracking.find(4, os.path.dirname(file_path), os.path.basename(output_file)) is None:
+                tracking.add(new_entry)
+            tracking.checkpoint()
+        else:
+            global_matched_genes += file_matched
+            global_unmatched_genes += file_unmatched
+            if stream:
+                global_graph.append_file(output_file)
+            else:
+                global_graph.parse(output_file, format='nt')
+            os.remove(output_file)
+
+    if per_pmid and not per_file:
+        pmid_pending = []
+        for pmid, conversions in pmid_conversions.items():
+            # the graph goes alongside the PMID's data files
+            root = conversions[0][1]
+            graph_file_name = f"graph_{pmid}.nt"
+            graph_file = os.path.join(root, graph_file_name)
+            # the PMID's graph is only unchanged if the same files, each unchanged, go into it
+            pmid_key = hashlib.sha256('|'.join(key for _, _, key, _ in conversions).encode('utf-8')).hexdigest()
+            graph_index = tracking.find(4, root, graph_file_name)
+            if not rebuild and graph_index is not None and tracking.get(graph_index, 'graphhash') == pmid_key and os.path.isfile(graph_file):
+                logging.info(f"Skipping PMID {pmid}, unchanged since {graph_file} was created")
+                continue
+            args = (pmid, [conversion for _, _, _, conversion in conversions], graph_file, pmid_metadata_file, deterministic, literals)
+            if pool is not None:
+                pmid_pending.append((pmid, root, graph_file, conversions, pmid_key, pool.submit(convert_pmid, *args)))
+            else:
+                pmid_pending.append((pmid, root, graph_file, conversions, pmid_key, convert_pmid(*args)))
+        for pmid, root, graph_file, conversions, pmid_key, result in pmid_pending:
+            try:
+                counts = result.result() if pool is not None else result
+            except Exception as e:
+                logging.error(f"Failed to create graph for PMID {pmid}: {str(e)}")
+                continue
+            # record the graph against each of the data files it was made from, and add it to the tracking as a new file
+            for (index, _, key, _), (file_matched, file_unmatched) in zip(conversions, counts):
+                tracking.set(index, graphfile=graph_file, unmatched=file_unmatched, matched=file_matched, graphhash=key)
+            pmid_matched = sum(file_matched for file_matched, _ in counts)
+            pmid_unmatched = sum(file_unmatched for _, file_unmatched in counts)
+            matched_genes += pmid_matched
+            unmatched_genes += pmid_unmatched
+            graph_file_name = os.path.basename(graph_file)
+            graph_index = tracking.find(4, root, graph_file_name)
+            if graph_index is None:
+                tracking.add(tracking_record(4, root, pmid, graph_file_name, False, True, root, False, False, '', 0, '', '', '', graph_file_name, pmid_matched, pmid_unmatched, False, '', pmid_key))
+            else:
+                tracking.set(graph_index, matched=pmid_matched, unmatched=pmid_unmatched, graphhash=pmid_key)
+            logging.info(f"Graph for PMID {pmid} from {len(counts)} files written to {graph_file}")
+            tracking.checkpoint()
 
-    if per_file:
+    if pool is not None:
+        pool.shutdown()
+    if part_folder:
+        shutil.rmtree(part_folder, ignore_errors=True)
+
+    # write out the updated information (should have the new files we just wrote out), with the new entries, 
+    # which replaces the journal
+    tracking.save()
+
+    if per_file or per_pmid:
         pass
-    elif per_pmid:
-        logging.info('per pmid not yet implemented')
     else:
         logging.info(f"Processing file: {file_path} complete")
-        global_graph_file = os.path.join(graph_folder, 'main_graph.nt')
-        global_graph.serialize(destination=global_graph_file, format='nt', encoding= "utf-8" )
+        if stream:
+            global_graph.close()
+        else:
+            global_graph.serialize(destination=global_graph_file, format='nt', encoding= "utf-8" )
         logging.info(f"Combined graph has been serialized to {global_graph_file}")
 
 
@@ -5,10 +5,14 @@ import re
 import warnings
 import argparse
 import logging
-from akg import AKGException, akg_logging_config
-from tracking import check_tracking_writeable, create_tracking, load_tracking, save_tracking, create_empty_tracking_store, add_to_tracking, tracking_entry
+import pytest
+from akg import AKGException, akg_logging_config, read_table, sniff_csv, is_parquet, write_table, written_with, table_extension, parquet_available, INTERMEDIATE_FORMATS, WRITTEN_ENCODING, WRITTEN_DELIMITER
+from tracking import check_tracking_writeable, create_tracking, Tracking, tracking_record, DEFAULT_TRACKING_FILE, tracking_exists
 
 
+# the number of rows cleaned at a time with --stream
+DEFAULT_CHUNK_ROWS = 100000
+
 # TODO: #35 Implement logic to rename the 'ensembl' column
 def rename_ensembl_column(df):
     """finds a column with clear ensembl data and renames the column title
@@ -22,29 +26,129 @@ def rename_ensembl_column(df):
     return df
 
 
-def process_csv_file(file_path)->str:
-    """Data cleaning for the saved expression info csv files.
+def clean_column_name(name:str)->str:
+    """
+    Remove extra characters and gaps from a column name, to help searching and prevent broken URIs
+    """
+    # updated to take out double quotes
+    return re.sub(r'[\s\-_<>\(\)\[\]\{\}"]', '', name.lower())
+
+def clean_dataframe(df:pd.DataFrame)->pd.DataFrame:
+    """
     removes rows with multiple blank cells, and removes spaces and characters from column headers.
     """
-    try:
-        with warnings.catch_warnings():
-            warnings.simplefilter("error", pd.errors.DtypeWarning)
-            df = pd.read_csv(file_path)
     # Remove rows with multiple NAs or blanks
-        df_cleaned = df.dropna(thresh=len(df.columns)//4)
-        # Process column names to remove extra characters and gaps to help searching and prevent broken URIs
-        # updated to take out double quotes
-        df_cleaned.columns = df_cleaned.columns.map(lambda x: re.sub(r'[\s\-_<>\(\)\[\]\{\}"]', '', x.lower()))
-        # Rename Ensembl column if it exists
-        # commented out, see Issue #35
-#         df_cleaned = rename_ensembl_column(df_cleaned)
-
-        # prepend 'clean_' to the filename for output
-        base_name = os.path.basename(file_path)
-        dir_name = os.path.dirname(file_path)
-        new_file_name = f"clean_{base_name}"
-        new_file_path = os.path.join(dir_name, new_file_name)
-        df_cleaned.to_csv(new_file_path, index=False, sep=",")
+    df_cleaned = df.dropna(thresh=len(df.columns)//4)
+    # Process column names to remove extra characters and gaps to help searching and prevent broken URIs
+    df_cleaned.columns = df_cleaned.columns.map(lambda x: clean_column_name(str(x)))
+    # Rename Ensembl column if it exists
+    # commented out, see Issue #35
+#   df_cleaned = rename_ensembl_column(df_cleaned)
+    return df_cleaned
+
+def read_chunks(file_path:str, encoding:str, delimiter:str, chunk_rows:int):
+    """
+    Read file_path chunk_rows rows at a time. A csv file is read with every column as text, so a column of numbers
+    with some text in it doesn't matter, and the values are kept as they were written; a Parquet file's columns keep
+    their types. There is always at least one chunk, so an empty table still has its header.
+    """
+    if is_parquet(file_path):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(file_path)
+        if parquet_file.metadata.num_rows == 0:
+            yield parquet_file.schema_arrow.empty_table().to_pandas()
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    else:
+        # a file with only the header line gives one empty chunk
+        with pd.read_csv(file_path, delimiter=delimiter, encoding=encoding, dtype=str, chunksize=chunk_rows) as reader:
+            yield from reader
+
+def clean_csv_in_chunks(file_path:str, new_file_path:str, encoding:str, delimiter:str, chunk_rows:int=DEFAULT_CHUNK_ROWS)->int:
+    """
+    Clean file_path into new_file_path chunk_rows rows at a time (see read_chunks), with clean_dataframe, appending
+    each cleaned chunk to the output so that only one chunk is in memory at once. Either file can be csv or Parquet
+    (see write_table). The values of a csv file are written out as they were read (a whole table read by pandas has
+    its numbers rewritten, so 1.50 is written 1.5).
+    Returns:
+        the number of rows written
+    """
+    written = 0
+    if is_parquet(new_file_path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for chunk in read_chunks(file_path, encoding, delimiter, chunk_rows):
+                table = pa.Table.from_pandas(clean_dataframe(chunk), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(new_file_path, table.schema)
+                else:
+                    # a chunk whose text column is all blank would otherwise have no type for it
+                    table = table.cast(writer.schema)
+                writer.write_table(table)
+                written += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        return written
+    with open(new_file_path, 'w', encoding=WRITTEN_ENCODING, newline='') as output:
+        for number, chunk in enumerate(read_chunks(file_path, encoding, delimiter, chunk_rows)):
+            cleaned = clean_dataframe(chunk)
+            cleaned.to_csv(output, index=False, sep=WRITTEN_DELIMITER, header=(number == 0))
+            written += len(cleaned)
+    return written
+
+def test_clean_csv_in_chunks(tmp_path):
+    """
+    Rows are dropped and headers cleaned across chunks as for the whole table, and a column with numbers and text is kept as read
+    """
+    expdata = tmp_path / 'expdata_table.csv'
+    expdata.write_text('Gene Symbol,log2 (FC),p-value,note\nSHANK3,1.50,0.01,\n,,,\nCHD8,-2,NA,up\n,,,x\nNRXN1,0.5,n/a,\n')
+    clean = tmp_path / 'clean_expdata_table.csv'
+    assert clean_csv_in_chunks(str(expdata), str(clean), 'utf-8', ',', chunk_rows=2) == 4
+    assert clean.read_text() == 'genesymbol,log2fc,pvalue,note\nSHANK3,1.50,0.01,\nCHD8,-2,,up\n,,,x\nNRXN1,0.5,,\n'
+    header_only = tmp_path / 'expdata_empty.csv'
+    header_only.write_text('Gene,LFC\n')
+    assert clean_csv_in_chunks(str(header_only), str(clean), 'utf-8', ',') == 0
+    assert clean.read_text() == 'gene,lfc\n'
+    pytest.importorskip('pyarrow')
+    clean_parquet = tmp_path / 'clean_expdata_table.parquet'
+    assert clean_csv_in_chunks(str(expdata), str(clean_parquet), 'utf-8', ',', chunk_rows=2) == 4
+    assert list(pd.read_parquet(clean_parquet)['log2fc'].fillna('')) == ['1.50', '-2', '', '0.5']
+
+def process_csv_file(file_path, encoding:str=WRITTEN_ENCODING, delimiter:str=WRITTEN_DELIMITER, chunk_rows:int=0, intermediate_format:str='csv')->str:
+    """Data cleaning for the saved expression info csv (or Parquet) files, see clean_dataframe.
+    encoding and delimiter are those recorded in the tracking file: if not known, they are found from the start of the file.
+    With chunk_rows, the file is cleaned that many rows at a time (see clean_csv_in_chunks). Otherwise it is read whole,
+    and a csv file with mixed data types in a column is skipped.
+    The clean file is written in intermediate_format, one of INTERMEDIATE_FORMATS.
+    """
+    # prepend 'clean_' to the filename for output
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    dir_name = os.path.dirname(file_path)
+    new_file_name = f"clean_{base_name}{table_extension(intermediate_format)}"
+    new_file_path = os.path.join(dir_name, new_file_name)
+    try:
+        if chunk_rows:
+            if not is_parquet(file_path) and (not encoding or not delimiter):
+                sniffed_encoding, sniffed_delimiter = sniff_csv(file_path)
+                encoding = encoding or sniffed_encoding
+                delimiter = delimiter or sniffed_delimiter
+            try:
+                clean_csv_in_chunks(file_path, new_file_path, encoding, delimiter, chunk_rows)
+            except UnicodeDecodeError:
+                # as read_csv_data does
+                if encoding not in ('utf-8', 'utf-8-sig'):
+                    raise
+                logging.info(f"{file_path} is not {encoding} throughout, reading it as latin1")
+                clean_csv_in_chunks(file_path, new_file_path, 'latin1', delimiter, chunk_rows)
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", pd.errors.DtypeWarning)
+                df, _, _ = read_table(file_path, encoding, delimiter)
+            df_cleaned = clean_dataframe(df)
+            write_table(df_cleaned, new_file_path)
         logging.info(f"Processed to: {new_file_path}")
         return new_file_name
     except pd.errors.DtypeWarning:
@@ -55,45 +159,45 @@ def process_csv_file(file_path)->str:
     # default is to return None, failure to add any new file
     return None
 
-def process_data_folder(data_folder:str,  tracking_file:str):
-
-    df = load_tracking(tracking_file)
-    tdf = create_empty_tracking_store()
-
-    for index, row in df.iterrows():
-        if row['step'] == 2:
-            excl = row['excl']
-            root = row['path']
-            file = row['file']
-            pmid = row['pmid']
-            lfc = row['lfc']
-            pval = row['pval']
-            gene = row['gene']
+def process_data_folder(data_folder:str,  tracking_file:str, chunk_rows:int=0, intermediate_format:str='csv'):
+    """
+    Clean each of the files made by data_convert, as process_csv_file, chunk_rows rows at a time if given, writing
+    the clean files in intermediate_format
+    """
 
-            file_path = os.path.join(root, file)
-            if excl:
-                logging.info(f"Excluding file: {file_path} manual: {row['manual']} : {row['manualreason']}")
+    tracking = Tracking(tracking_file, step=2)
+
+    for index, row in tracking.entries(2):
+        excl = row['excl']
+        root = row['path']
+        file = row['file']
+        pmid = row['pmid']
+        lfc = row['lfc']
+        pval = row['pval']
+        gene = row['gene']
+
+        file_path = os.path.join(root, file)
+        if excl:
+            logging.info(f"Excluding file: {file_path} manual: {row['manual']} : {row['manualreason']}")
+        else:
+            if file.endswith(('.csv', '.parquet')):
+                logging.info(f"Processing file: {file_path}")
+                new_file_path = process_csv_file(file_path, row['encoding'], row['delimiter'], chunk_rows, intermediate_format)
+                if new_file_path:
+                    # Add the new file to the tracking data
+                    # Because the pval,gene,lfc data has been sanitised by process_csv_file, do the same to the column names which are stored here in the tracking file
+                    clean_pval = clean_column_name(pval)
+                    clean_gene = clean_column_name(gene)
+                    clean_lfc = clean_column_name(lfc)
+                    new_entry = tracking_record(3, root, pmid, new_file_path,   False, True, file_path, False, False, '', 0, clean_pval, clean_gene, clean_lfc, '', 0, 0, False, '', '', *written_with(new_file_path))
+                    tracking.add(new_entry)
+                tracking.set(index, cleaned=True)
+                tracking.checkpoint()
             else:
-                if file.endswith('.csv'):
-                    logging.info(f"Processing file: {file_path}")
-                    new_file_path = process_csv_file(file_path)
-                    if new_file_path:
-                        # Add the new file to the tracking DataFrame
-                        # Because the pval,gene,lfc data has been sanitised by process_csv_file, do the same to the column names which are stored here in the tracking file
-                        clean_pval = re.sub(r'[\s\-_<>\(\)\[\]\{\}"]', '', pval.lower())
-                        clean_gene = re.sub(r'[\s\-_<>\(\)\[\]\{\}"]', '', gene.lower())
-                        clean_lfc = re.sub(r'[\s\-_<>\(\)\[\]\{\}"]', '', lfc.lower())
-                        new_entry = tracking_entry(3, root, pmid, new_file_path,   False, True, file_path, False, False, '', 0, clean_pval, clean_gene, clean_lfc, '', 0, 0, False, '')
-                        tdf = add_to_tracking(tdf, new_entry)
-                    df.loc[index,'cleaned'] = True
-                else:
-                    logging.info(f"Skipping non-CSV file: {file_path}")
-
-    # now the loop has finished add the accumulated tracking info into the main one
-    df = add_to_tracking(df, tdf)
+                logging.info(f"Skipping file that is not csv or Parquet: {file_path}")
 
-    # write out the updated information (should have the new files we just wrote out)
-    save_tracking(df, tracking_file)
+    # write out the updated information (should have the new files we just wrote out), all the new entries together
+    tracking.save()
 
 if __name__ == '__main__':
     command_line_str = ' '.join(sys.argv)
@@ -101,8 +205,11 @@ if __name__ == '__main__':
     # manage the command line options
     parser = argparse.ArgumentParser(description='Convert downloaded supplementary data to graph precursor')
     parser.add_argument('-i','--input_dir', default='data', help='Destination top-level directory for input data files (output files also written here)')
-    parser.add_argument('-t','--tracking_file', default='akg_tracking.xlsx', help='Tracking file name. This file is created in the top-level directory.')
+    parser.add_argument('-t','--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file is created in the top-level directory.')
     parser.add_argument('-l','--log', default='csv_data_cleaning.log', help='Log file name. This file is created in the top-level directory.')
+    parser.add_argument('-s','--stream', action='store_true', help="Clean each file a chunk of rows at a time, reading every column as text, rather than reading it whole")
+    parser.add_argument('-c','--chunk_rows', type=int, default=DEFAULT_CHUNK_ROWS, help=f"Number of rows in each chunk with -s (default {DEFAULT_CHUNK_ROWS})")
+    parser.add_argument('--intermediate-format', default='csv', choices=INTERMEDIATE_FORMATS, help="Write the clean_ files as csv (the default) or as Parquet, which keeps the column types and is much faster for create_rdf_triples.py to read")
 
     # argparse populates an object using parse_args
     # extract its members into a dict and from there into variables if used in more than one place
@@ -112,6 +219,8 @@ if __name__ == '__main__':
 
     if not os.path.isdir(main_dir):
         raise AKGException(f"data_convert: data directory {main_dir} must exist")
+    if config['intermediate_format'] == 'parquet' and not parquet_available():
+        raise AKGException("csv_data_cleaning: pyarrow must be installed for --intermediate-format parquet (pip install pyarrow)")
     
     # set up logging
     akg_logging_config( os.path.join(main_dir, config['log']))
@@ -122,12 +231,12 @@ if __name__ == '__main__':
     tracking_file = os.path.join(main_dir, tracking_file)
 
     # the tracking file must exist because it tells us which files to process
-    if not os.path.exists(tracking_file):
+    if not tracking_exists(tracking_file):
         raise AKGException(f"csv_data_cleaning: {tracking_file} must exist")
 
     if not check_tracking_writeable(tracking_file):
         raise AKGException(f"csv_data_cleaning: {tracking_file} must be writable: close it in Excel and try again")
 
     supp_data_folder = os.path.join(main_dir,"supp_data")
-    process_data_folder(supp_data_folder, tracking_file)
+    process_data_folder(supp_data_folder, tracking_file, config['chunk_rows'] if config['stream'] else 0, config['intermediate_format'])
     
\ No newline at end of file
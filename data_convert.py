@@ -7,15 +7,16 @@ import os
 from openpyxl import load_workbook
 import xlrd
 import csv
-import re
 import argparse
-from akg import AKGException, akg_logging_config, possible_lfc_names
-from tracking import check_tracking_writeable, create_tracking, load_tracking, save_tracking, create_empty_tracking_store, add_to_tracking, tracking_entry
+from akg import AKGException, akg_logging_config, possible_lfc_names, output_file_name, read_table, write_table, written_with, table_extension, parquet_available, INTERMEDIATE_FORMATS
+from column_roles import infer_column_roles, squash_header
+from tracking import check_tracking_writeable, create_tracking, Tracking, tracking_record, DEFAULT_TRACKING_FILE, tracking_exists
 import sys
 
 
-def process_csv_file(file_path:str, skip_rows:int=0, pval_name:str='', gene_name:str='', lfc_name:str='')->pd.DataFrame:
-    """loads csv, tsc or txt files and prepares them to be inputs to the AKG
+def process_csv_file(file_path:str, skip_rows:int=0, pval_name:str='', gene_name:str='', lfc_name:str='', encoding:str='', delimiter:str='', intermediate_format:str='csv')->tuple[list[dict], str, str]:
+    """loads csv, tsc or txt files (or the Parquet files data_split writes with --intermediate-format parquet) and 
+    prepares them to be inputs to the AKG
 
         Parameters:
             file_path:str   The file to process
@@ -23,47 +24,39 @@ def process_csv_file(file_path:str, skip_rows:int=0, pval_name:str='', gene_name
             pval_name:      The name at the head of the pval column
             gene_name:      The name at the head of the gene column
             lfc_name:       The name at the head of the lfc column
+            encoding:       The encoding of the file, if known from the tracking file
+            delimiter:      The delimiter of the file, if known from the tracking file
+            intermediate_format: The format to write the expdata file in, one of INTERMEDIATE_FORMATS
         Returns:
-            Information about the added output files (if any) in a form suitable for adding to the tracking data (a DataFrame)
+            Information about the added output files (if any) in a form suitable for adding to the tracking data (a list of tracking records)
+            The encoding and delimiter the file was read with ('' if it couldn't be), to record in the tracking file
     """
     # The processing creates files that need to be added to the tracking, which can't be done inside the loop.
 # this is the pattern for adding some:
 #    added_files = pd.DataFrame({col: pd.Series(dtype=dt) for col, dt in tracking_col_names.items()})
 #    df = pd.concat([df,added_files],ignore_index=True)
 
-    # tracking DataFrame
-    tdf = create_empty_tracking_store()
+    # tracking entries
+    tdf = []
 
     output_dir = os.path.dirname(file_path)
     file_name = os.path.splitext(os.path.basename(file_path))[0]
-    # Try reading with different settings
-    for encoding in ['utf-8', 'iso-8859-1', 'latin1']:
-        # remove tab stuff and see if python can detect the file on its own
-        try:
-            # *this is the only point where the skip at the start of the file is made*
-            # after this stage, the column headers are assumed to be on the first line.
-            df = pd.read_csv(file_path, delimiter=None, engine='python', encoding=encoding, on_bad_lines='warn', skiprows=skip_rows)
-            if len(df.columns) <= 1:
-                logging.warning('pd.read_csv detected 1 column only. This is unlikely.')
-            if not df.empty:
-#                new_file = process_dataframe(df, file_name, output_dir, file_path, input_delimiter=delim, skip_rows=skip_rows, pval_name=pval_name, gene_name=gene_name, lfc_name=lfc_name)
-                new_file = process_dataframe(df, file_name, output_dir, file_path, input_delimiter=None, skip_rows=skip_rows, pval_name=pval_name, gene_name=gene_name, lfc_name=lfc_name)
-                return add_to_tracking(tdf, new_file)
-        except Exception as e:
-            logging.error(f"Failed to read {file_path} with encoding '{encoding}': {str(e)}")
-#            logging.error(f"Failed to read {file_path} with delimiter '{delim}' and encoding '{encoding}': {str(e)}")
-        # for delim in ['\t', ',', ';']:  # prioritize tab
-        #     try:
-        #         # *this is the only point where the skip at the start of the file is made*
-        #         # after this stage, the column headers are assumed to be on the first line.
-        #         df = pd.read_csv(file_path, delimiter=delim, encoding=encoding, on_bad_lines='warn', skiprows=skip_rows)
-        #         if not df.empty:
-        #             new_file = process_dataframe(df, file_name, output_dir, file_path, input_delimiter=delim, skip_rows=skip_rows, pval_name=pval_name, gene_name=gene_name, lfc_name=lfc_name)
-        #             return add_to_tracking(tdf, new_file)
-        #     except Exception as e:
-        #         logging.error(f"Failed to read {file_path} with delimiter '{delim}' and encoding '{encoding}': {str(e)}")
-
-    # If all attempts fail, try reading as plain text
+    # the encoding and delimiter are those recorded in the tracking file, or are found from the start of the file,
+    # so that it is parsed just once, with the C parser, rather than pandas' much slower delimiter detection
+    try:
+        # *this is the only point where the skip at the start of the file is made*
+        # after this stage, the column headers are assumed to be on the first line.
+        df, encoding, delimiter = read_table(file_path, encoding, delimiter, skip_rows, on_bad_lines='warn')
+        if len(df.columns) <= 1:
+            logging.warning('pd.read_csv detected 1 column only. This is unlikely.')
+        if not df.empty:
+            new_file = process_dataframe(df, file_name, output_dir, file_path, input_delimiter=delimiter, skip_rows=skip_rows, pval_name=pval_name, gene_name=gene_name, lfc_name=lfc_name,
+                                         intermediate_format=intermediate_format)
+            return tdf + new_file, encoding, delimiter
+    except Exception as e:
+        logging.error(f"Failed to read {file_path} with delimiter '{delimiter}' and encoding '{encoding}': {str(e)}")
+
+    # If it can't be read, try reading as plain text
     try:
         with open(file_path, 'r', encoding='utf-8') as file:
             content = file.read()
@@ -72,18 +65,16 @@ def process_csv_file(file_path:str, skip_rows:int=0, pval_name:str='', gene_name
     except Exception as e:
         logging.error(f"Failed to read {file_path} as text: {str(e)}")
 
-    return tdf
+    return tdf, '', ''
 
 def test_lfc_search():
     """Debug test snippet from process_dataframe, to confirm that some odd LFC columns are being chosen
     because of the compression of the column name (see the reg expression)
     """
     col = "Relevance of circQTLs to ASD"
-    log_fold_col = ''
-    if any(phrase in re.sub(r'[_\s-]', '', col.lower()) for phrase in possible_lfc_names):
-        log_fold_col = col
+    log_fold_col = infer_column_roles([col]).lfc
 
-    sqcol = re.sub(r'[_\s-]', '', col.lower())
+    sqcol = squash_header(col)
     print(sqcol)
     for phrase in possible_lfc_names:
         print(f'{phrase}:{sqcol.find(phrase)}\n')
@@ -91,19 +82,19 @@ def test_lfc_search():
     print(f'log_fold_col:{log_fold_col}')
 
 
-def process_dataframe(df:pd.DataFrame, sheet_name:str, output_dir:str, file_path:str, input_delimiter:str='\t', skip_rows:int=0, pval_name:str='', gene_name:str='', lfc_name:str='')->pd.DataFrame:
+def process_dataframe(df:pd.DataFrame, sheet_name:str, output_dir:str, file_path:str, input_delimiter:str='\t', skip_rows:int=0, pval_name:str='', gene_name:str='', lfc_name:str='',
+                      write:bool=True, taken:set|None=None, intermediate_format:str='csv')->list[dict]:
     """processes dataframes to assess if the data relates to gene expression - looks for "log fold change" or similar
     in column titles
+    With write False, the expdata file is named, and its tracking entry made, but it isn't written (see pipeline.py).
+    taken is the names already given to files not written, as for output_file_name.
+    The expdata file is a csv file, or with intermediate_format 'parquet', a Parquet file (see write_table).
     """
-    # tracking DataFrame. There should be a maximum of one entry in the returned value because this function works on a single dataframe
-    tdf = create_empty_tracking_store()
+    # tracking entries. There should be a maximum of one entry in the returned value because this function works on a single dataframe
+    tdf = []
 
     df.columns = df.columns.astype(str)
-    log_fold_col = None
-    for col in df.columns:
-        if any(phrase in re.sub(r'[_\s-]', '', col.lower()) for phrase in possible_lfc_names):
-            log_fold_col = col
-            break
+    log_fold_col = infer_column_roles(df.columns).lfc
     # save the file as .csv but ONLY if a log fold column is found or nominated through the input 
     if log_fold_col or lfc_name:
         if lfc_name:
@@ -131,32 +122,28 @@ def process_dataframe(df:pd.DataFrame, sheet_name:str, output_dir:str, file_path
             new_filestub = f'expdata_{sheet_name[start_index:]}'
         else:
             new_filestub = f'expdata_{sheet_name}'
-        new_filename = new_filestub+'.csv'
+        new_filename = output_file_name(new_filestub, output_dir, file_path, taken, table_extension(intermediate_format))
         output_file = os.path.join(output_dir, new_filename)
-
-        if os.path.exists(output_file):
-            original_filename = os.path.splitext(os.path.basename(file_path))[0]
-            new_filename = f"{new_filestub}_{original_filename}.csv"
-            output_file = os.path.join(output_dir, new_filename)
         # the if statement is redundant
         # if input_delimiter == '\t':
         #     df.to_csv(output_file, index=False, sep=',')
         # else:
         #     df.to_csv(output_file, index=False)
-        df.to_csv(output_file, index=False)
-        logging.info(f"Saved {sheet_name} as CSV: {output_file}")
+        if write:
+            write_table(df, output_file)
+            logging.info(f"Saved {sheet_name} as {intermediate_format}: {output_file}")
 
         # assume the pmid is the last component of the output dir
         pmid = os.path.basename(output_dir)
         # create a new tracking entry
-        new_entry = tracking_entry(2,output_dir,pmid,new_filename, False, True, file_path, False, False, '', skip_rows, pval_name, gene_name, log_fold_col,'', 0, 0,False,'')
-        tdf = add_to_tracking(tdf, new_entry)
+        new_entry = tracking_record(2,output_dir,pmid,new_filename, False, True, file_path, False, False, '', skip_rows, pval_name, gene_name, log_fold_col,'', 0, 0,False,'', '', *written_with(new_filename))
+        tdf.append(new_entry)
     else:
         logging.info(f"Skipped {sheet_name} in {file_path}: No 'log fold change' column found")
 
     return tdf
 
-def process_supp_data_folder(data_folder:str, tracking_file_path:str):
+def process_supp_data_folder(data_folder:str, tracking_file_path:str, intermediate_format:str='csv'):
     """ 
     function process_supp_data_folder
 
@@ -167,6 +154,7 @@ def process_supp_data_folder(data_folder:str, tracking_file_path:str):
     Parameters:
         data_folder:str
         tracking_file_path:str   # must be a full path
+        intermediate_format:str  # the format of the expdata files, one of INTERMEDIATE_FORMATS
 
     Returns:
         None
@@ -175,33 +163,32 @@ def process_supp_data_folder(data_folder:str, tracking_file_path:str):
         No direct exception handling/raising in this code    
 
     """
-    df = load_tracking(tracking_file_path)
-
-# The processing creates files that need to be added to the tracking, which can't be done inside the loop.
-    tdf  = create_empty_tracking_store()
-    local_tdf = create_empty_tracking_store()
-# TODO: remove loop iteration, do sthg more pythonic
-    for index, row in df.iterrows():
-        # data_convert only works on step 1 files, the raw data that was downloaded and then split
-        if row['step'] == 1 and not row['excl']:
-            root = row['path']
-            filename = row['file']
-            file_path = os.path.join(root, filename)
-            # never process files that we wrote out on a previous iteration
-            logging.info(f"Processing file: {file_path}")
-            if filename.lower().endswith(('.csv')):
-                local_tdf = process_csv_file(file_path, skip_rows=row['skip'], pval_name=row['pval'], gene_name=row['gene'], lfc_name=row['lfc'])
-                tdf = add_to_tracking(tdf,local_tdf)
-            else:
-                logging.info(f'Skipping file: {file_path}, should be a .csv file ')
-                continue
-    logging.info(f'Finished processing files in {data_folder}, found {len(tdf)} new files to add to tracking')
-
-    # now the loop has finished add the accumulated tracking info into the main one
-    df = add_to_tracking(df, tdf)
+    tracking = Tracking(tracking_file_path, step=1)
+
+    # The processing creates files that need to be added to the tracking: they are added all together after the loop
+    found = 0
+    # data_convert only works on step 1 files, the raw data that was downloaded and then split
+    for index, row in tracking.entries(1, excluded=False):
+        root = row['path']
+        filename = row['file']
+        file_path = os.path.join(root, filename)
+        # never process files that we wrote out on a previous iteration
+        logging.info(f"Processing file: {file_path}")
+        if filename.lower().endswith(('.csv', '.parquet')):
+            local_tdf, encoding, delimiter = process_csv_file(file_path, skip_rows=row['skip'], pval_name=row['pval'], gene_name=row['gene'], lfc_name=row['lfc'],
+                                                              encoding=row['encoding'], delimiter=row['delimiter'], intermediate_format=intermediate_format)
+            tracking.add(local_tdf)
+            if encoding:
+                tracking.set(index, encoding=encoding, delimiter=delimiter)
+            tracking.checkpoint()
+            found += len(local_tdf)
+        else:
+            logging.info(f'Skipping file: {file_path}, should be a .csv or .parquet file ')
+            continue
+    logging.info(f'Finished processing files in {data_folder}, found {found} new files to add to tracking')
 
     # write out the updated information (should have the new files we just wrote out)
-    save_tracking(df, tracking_file_path)
+    tracking.save()
 
 
 if __name__ == '__main__':
@@ -211,8 +198,9 @@ if __name__ == '__main__':
     # manage the command line options
     parser = argparse.ArgumentParser(description='Convert downloaded supplementary data to graph precursor')
     parser.add_argument('-i','--input_dir', default='data', help='Destination top-level directory for input data files (output files also written here)')
-    parser.add_argument('-t','--tracking_file', default='akg_tracking.xlsx', help='Tracking file name. This file must exist in the top-level directory.')
+    parser.add_argument('-t','--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file must exist in the top-level directory.')
     parser.add_argument('-l', '--log', default='data_convert.log', help='Log file name. This file is created in the top-level directory.')
+    parser.add_argument('--intermediate-format', default='csv', choices=INTERMEDIATE_FORMATS, help="Write the expdata_ files as csv (the default) or as Parquet, which keeps the column types and is much faster for the later programs to read")
 
     # argparse populates an object using parse_args
     # extract its members into a dict and from there into variables if used in more than one place
@@ -222,6 +210,8 @@ if __name__ == '__main__':
 
     if not os.path.isdir(main_dir):
         raise AKGException(f"data_convert: data directory {main_dir} must exist") 
+    if config['intermediate_format'] == 'parquet' and not parquet_available():
+        raise AKGException("data_convert: pyarrow must be installed for --intermediate-format parquet (pip install pyarrow)")
 
     akg_logging_config(os.path.join(main_dir, config['log']))
     logging.info(f'Starting data_convert in {main_dir}')
@@ -230,7 +220,7 @@ if __name__ == '__main__':
     # load the tracking file    
     tracking_file = config['tracking_file']
     tracking_file = os.path.join(main_dir, tracking_file)
-    if not os.path.exists(tracking_file):
+    if not tracking_exists(tracking_file):
         raise AKGException(f"create_rdf_triples: {tracking_file} must exist")
     else:
         if not check_tracking_writeable(tracking_file):
@@ -243,6 +233,6 @@ if __name__ == '__main__':
     log_file = os.path.join(main_dir, log_file)
 
     supp_data_folder = os.path.join(main_dir,"supp_data")
-    process_supp_data_folder(supp_data_folder, tracking_file)
+    process_supp_data_folder(supp_data_folder, tracking_file, config['intermediate_format'])
 
     # save_filenames(supp_data_folder, article_file_path)
\ No newline at end of file
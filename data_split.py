@@ -8,108 +8,184 @@ from fileinput import filename
 import logging
 import pandas as pd
 import os
-from openpyxl import load_workbook
 import xlrd
 import csv
 import re
 import argparse
-from akg import AKGException, akg_logging_config
-from tracking import check_tracking_writeable, create_tracking, load_tracking, save_tracking, create_empty_tracking_store, add_to_tracking, tracking_entry
+import importlib.util
+from akg import AKGException, akg_logging_config, output_file_name, read_csv_data, write_table, written_with, table_extension, parquet_available, INTERMEDIATE_FORMATS
+from tracking import check_tracking_writeable, create_tracking, update_tracking_downloads, Tracking, tracking_record, DEFAULT_TRACKING_FILE, tracking_exists
 import sys
 
-def process_excel_file(file_path)->pd.DataFrame:
-    """loads excel files into dataframes
+# the choices of engine for reading spreadsheets, see excel_engine
+EXCEL_ENGINES = ('standard', 'calamine', 'auto')
+
+def calamine_available()->bool:
+    """
+    Whether python-calamine (pip install python-calamine), the Rust-based spreadsheet reader, is installed
+    """
+    return importlib.util.find_spec('python_calamine') is not None
+
+def excel_engine(file_path:str, engine:str='standard')->str:
+    """
+    The pandas engine to read a spreadsheet with, for the given choice (one of EXCEL_ENGINES): 'standard' is openpyxl 
+    for .xlsx and xlrd for .xls, 'calamine' is python-calamine for either, which is much faster on large files, and 
+    'auto' is calamine if it is installed, otherwise the standard one.
+    """
+    if engine == 'auto':
+        engine = 'calamine' if calamine_available() else 'standard'
+    if engine == 'calamine':
+        return 'calamine'
+    return 'xlrd' if file_path.lower().endswith('.xls') else 'openpyxl'
+
+def read_excel_tables(file_path:str, engine:str='standard'):
+    """
+    Read each sheet of an excel file into a dataframe, from a single opening of the workbook: each call to 
+    pd.read_excel(file_path) would open and parse the whole file again. One sheet's dataframe is made at a time.
+    engine is one of EXCEL_ENGINES, see excel_engine.
+    Yields:
+        the sheet name, dataframe and delimiter ('' for a sheet) of each sheet
     """
-    # tracking DataFrame
-    tdf = create_empty_tracking_store()
+    with pd.ExcelFile(file_path, engine=excel_engine(file_path, engine)) as wb:
+        for sheet_name in wb.sheet_names:
+            df = wb.parse(sheet_name)
+            yield sheet_name, df, ''
+
+def read_old_tables(file_path:str, engine:str='standard'):
+    """
+    Read each sheet of an older-style excel file (.xls) into a dataframe, as for read_excel_tables
+    The standard engine reads the cells with xlrd directly, as data_split always has, a whole column at a time rather
+    than cell by cell, and loads one sheet at a time.
+    """
+    if excel_engine(file_path, engine) == 'calamine':
+        yield from read_excel_tables(file_path, engine)
+        return
+    wb = xlrd.open_workbook(file_path, on_demand=True)
+    try:
+        for sheet_name in wb.sheet_names():
+            sheet = wb.sheet_by_name(sheet_name)
+            logging.info(f"Processing sheet: {sheet.name}")
+            # the first row is the column headers
+            headers = sheet.row_values(0) if sheet.nrows else []
+            if sheet.nrows > 1:
+                df = pd.DataFrame({col: sheet.col_values(col, start_rowx=1) for col in range(sheet.ncols)})
+                df.columns = headers
+            else:
+                # no data: gives the same column types as the rows would have
+                df = pd.DataFrame([], columns=headers)
+            wb.unload_sheet(sheet_name)
+            yield sheet.name, df, ''
+    finally:
+        wb.release_resources()
+
+def read_csv_table(file_path:str, encoding:str='', delimiter:str='')->tuple[pd.DataFrame, str, str]|None:
+    """
+    Read a csv, tsv or txt file into a dataframe, with the encoding and delimiter given (from the tracking file), or 
+    otherwise those found from the start of the file (see akg.sniff_csv)
+    Returns:
+        the dataframe and the encoding and delimiter that read it, or None if it can't be read
+    """
+    try:
+        df, encoding, delimiter = read_csv_data(file_path, encoding, delimiter, on_bad_lines='warn')
+        if not df.empty:
+            return df, encoding, delimiter
+        logging.error(f"No data in {file_path} with delimiter '{delimiter}' and encoding '{encoding}'")
+    except Exception as e:
+        logging.error(f"Failed to read {file_path} with delimiter '{delimiter}' and encoding '{encoding}': {str(e)}")
+
+    # If it can't be read, try reading as plain text
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            content = file.read()
+        logging.info(f"File {file_path} couldn't be processed as CSV. Content preview:")
+        logging.info(content[:100])  # Print first 100 characters
+    except Exception as e:
+        logging.error(f"Failed to read {file_path} as text: {str(e)}")
+    return None
+
+def read_tables(file_path:str, engine:str='standard', encoding:str='', delimiter:str=''):
+    """
+    Read the tables in a downloaded file, according to its extension: each sheet of an excel file, or the whole of a 
+    csv, tsv or txt file. engine is the choice of spreadsheet reader, see excel_engine, and encoding and delimiter are 
+    those of a csv, tsv or txt file if known, see read_csv_table.
+    Yields:
+        the name (the sheet name, or the file name without its extension), dataframe and delimiter of each table
+    """
+    lower_name = file_path.lower()
+    if lower_name.endswith('.xlsx'):
+        yield from read_excel_tables(file_path, engine)
+    elif lower_name.endswith('.xls'):
+        yield from read_old_tables(file_path, engine)
+    elif lower_name.endswith(('.csv', '.tsv', '.txt')):
+        table = read_csv_table(file_path, encoding, delimiter)
+        if table is not None:
+            df, _, delim = table
+            yield os.path.splitext(os.path.basename(file_path))[0], df, delim
+
+def process_excel_file(file_path, engine:str='standard', intermediate_format:str='csv')->list[dict]:
+    """loads excel files into dataframes, writing out each sheet in intermediate_format (see process_dataframe)
+    """
+    # tracking entries
+    tdf = []
 
     try:
-        wb = load_workbook(filename=file_path, read_only=True)
         output_dir = os.path.dirname(file_path)
         
-        for sheet_name in wb.sheetnames:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
-            new_file = process_dataframe(df, sheet_name, output_dir, file_path)
-            tdf = add_to_tracking(tdf, new_file)
+        for sheet_name, df, _ in read_excel_tables(file_path, engine):
+            new_file = process_dataframe(df, sheet_name, output_dir, file_path, intermediate_format=intermediate_format)
+            tdf.extend(new_file)
 
     except Exception as e:
         logging.error(f"Failed to process excel file: {file_path}: {str(e)}")
 
     return tdf
 
-def process_old_file(file_path)->pd.DataFrame:
-    """loads older-style excel files (.xls) into dataframes
+def process_old_file(file_path, engine:str='standard', intermediate_format:str='csv')->list[dict]:
+    """loads older-style excel files (.xls) into dataframes, writing out each sheet in intermediate_format (see process_dataframe)
     """
-    # tracking DataFrame
-    tdf = create_empty_tracking_store()
+    # tracking entries
+    tdf = []
 
     try:
-        wb = xlrd.open_workbook(file_path)
         output_dir = os.path.dirname(file_path)
-        for sheet in wb.sheets():
-            logging.info(f"Processing sheet: {sheet.name}")
-            headers = [sheet.cell_value(0, col) for col in range(sheet.ncols)]
-            data = [
-                [sheet.cell_value(row, col) for col in range(sheet.ncols)]
-                for row in range(1, sheet.nrows)
-            ]
-            df = pd.DataFrame(data, columns=headers)
-            
-            new_file = process_dataframe(df, sheet.name, output_dir, file_path)
-            tdf = add_to_tracking(tdf, new_file)
+        for sheet_name, df, _ in read_old_tables(file_path, engine):
+            new_file = process_dataframe(df, sheet_name, output_dir, file_path, intermediate_format=intermediate_format)
+            tdf.extend(new_file)
 
     except Exception as e:
         logging.error(f"Failed to process 'old' file: {file_path}: {str(e)}")
 
     return tdf
 
-def process_csv_file(file_path:str)->pd.DataFrame:
+def process_csv_file(file_path:str, encoding:str='', delimiter:str='', intermediate_format:str='csv')->tuple[list[dict], str, str]:
     """loads csv, tsc or txt files and prepares them to be inputs to the AKG
 
         Parameters:
             file_path:str   The file to process
+            encoding:       The encoding of the file, if known from the tracking file
+            delimiter:      The delimiter of the file, if known from the tracking file
+            intermediate_format: The format to write the table in, one of INTERMEDIATE_FORMATS
         Returns:
-            Information about the added output files (if any) in a form suitable for adding to the tracking data (a DataFrame)
+            Information about the added output files (if any) in a form suitable for adding to the tracking data (a list of tracking records)
+            The encoding and delimiter the file was read with ('' if it couldn't be), to record in the tracking file
     """
-    # The processing creates files that need to be added to the tracking, which can't be done inside the loop.
-# this is the pattern for adding some:
-#    added_files = pd.DataFrame({col: pd.Series(dtype=dt) for col, dt in tracking_col_names.items()})
-#    df = pd.concat([df,added_files],ignore_index=True)
-
-    # tracking DataFrame
-    tdf = create_empty_tracking_store()
-
+    table = read_csv_table(file_path, encoding, delimiter)
+    if table is None:
+        return [], '', ''
+    df, encoding, delim = table
     output_dir = os.path.dirname(file_path)
     file_name = os.path.splitext(os.path.basename(file_path))[0]
-    # Try reading with different settings
-    for encoding in ['utf-8', 'iso-8859-1', 'latin1']:
-        for delim in ['\t', ',', ';']:  # prioritize tab
-            try:
-                df = pd.read_csv(file_path, delimiter=delim, encoding=encoding, on_bad_lines='warn')
-                if not df.empty:
-                    new_file = process_dataframe(df, file_name, output_dir, file_path, input_delimiter=delim)
-                    return add_to_tracking(tdf, new_file)
-            except Exception as e:
-                logging.error(f"Failed to read {file_path} with delimiter '{delim}' and encoding '{encoding}': {str(e)}")
-
-    # If all attempts fail, try reading as plain text
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-        logging.info(f"File {file_path} couldn't be processed as CSV. Content preview:")
-        logging.info(content[:100])  # Print first 100 characters
-    except Exception as e:
-        logging.error(f"Failed to read {file_path} as text: {str(e)}")
+    return process_dataframe(df, file_name, output_dir, file_path, input_delimiter=delim, intermediate_format=intermediate_format), encoding, delim
 
-    return tdf
-
-
-def process_dataframe(df, sheet_name, output_dir, file_path, input_delimiter='\t')->pd.DataFrame:
+def process_dataframe(df, sheet_name, output_dir, file_path, input_delimiter='\t', write:bool=True, taken:set|None=None, intermediate_format:str='csv')->list[dict]:
     """processes dataframes to assess if the data relates to gene expression - looks for "log fold change" or similar
     in column titles
+    With write False, the split file is named, and its tracking entry made, but it isn't written (see pipeline.py).
+    taken is the names already given to files not written, as for output_file_name.
+    The split file is a csv file, or with intermediate_format 'parquet', a Parquet file (see write_table).
     """
-    # tracking DataFrame. There should be a maximum of one entry in the returned value because this function works on a single dataframe
-    tdf = create_empty_tracking_store()
+    # tracking entries. There should be a maximum of one entry in the returned value because this function works on a single dataframe
+    tdf = []
 
     df.columns = df.columns.astype(str)
     
@@ -128,30 +204,24 @@ def process_dataframe(df, sheet_name, output_dir, file_path, input_delimiter='\t
     for old, new in replacement_chars.items():
         sheet_name = sheet_name.replace(old, new)
     new_filestub = f'split_{sheet_name}'
-    new_filename = new_filestub+'.csv'
+    new_filename = output_file_name(new_filestub, output_dir, file_path, taken, table_extension(intermediate_format))
     output_file = os.path.join(output_dir, new_filename)
 
-    if os.path.exists(output_file):
-        original_filename = os.path.splitext(os.path.basename(file_path))[0]
-        new_filename = f"{new_filestub}_{original_filename}.csv"
-        output_file = os.path.join(output_dir, new_filename)
-
-    if input_delimiter == '\t':
-        df.to_csv(output_file, index=False, sep=',')
-    else:
-        df.to_csv(output_file, index=False)
-    logging.info(f"Saved {sheet_name} as CSV: {output_file}")
+    if write:
+        # written with a comma delimiter, whatever input_delimiter was
+        write_table(df, output_file)
+        logging.info(f"Saved {sheet_name} as {intermediate_format}: {output_file}")
 
     # assume the pmid is the last component of the output dir
     pmid = os.path.basename(output_dir)
     # create a new tracking entry
-    new_entry = tracking_entry(1,output_dir,pmid,new_filename, False, True, file_path, False, False, '', 0, '', '', '','', 0, 0,False,'')
+    new_entry = tracking_record(1,output_dir,pmid,new_filename, False, True, file_path, False, False, '', 0, '', '', '','', 0, 0,False,'', '', *written_with(new_filename))
 
-    tdf = add_to_tracking(tdf, new_entry)
+    tdf.append(new_entry)
 
     return tdf
 
-def process_supp_data_folder(data_folder:str, tracking_file_path:str ):
+def process_supp_data_folder(data_folder:str, tracking_file_path:str, engine:str='standard', intermediate_format:str='csv'):
     """ 
     function process_supp_data_folder
 
@@ -162,6 +232,8 @@ def process_supp_data_folder(data_folder:str, tracking_file_path:str ):
     Parameters:
         data_folder:str
         tracking_file_path:str # must be a full path
+        engine:str  # the choice of spreadsheet reader, see excel_engine
+        intermediate_format:str # the format of the split files, one of INTERMEDIATE_FORMATS
 
     Returns:
         None
@@ -170,41 +242,39 @@ def process_supp_data_folder(data_folder:str, tracking_file_path:str ):
         No direct exception handling/raising in this code    
 
     """
-    df = load_tracking(tracking_file_path)
-
-# The processing creates files that need to be added to the tracking, which can't be done inside the loop.
-    tdf  = create_empty_tracking_store()
-    local_tdf = create_empty_tracking_store()
-# TODO: remove loop iteration, do sthg more pythonic
-    for index, row in df.iterrows():
-        # data_split only works on step 0 files, the raw data that was downloaded
-        if row['step'] == 0 and not row['excl']:
-            root = row['path']
-            file = row['file']
-            file_path = os.path.join(root, file)
-            # never process files that we wrote out on a previous iteration
-            if file.lower().startswith('expdata_') or file.lower().startswith('split_'):
-                logging.info(f"Skipping file: {file_path}")
-                continue
-            logging.info(f"Processing file: {file_path}")
-            if file.lower().endswith('.xlsx'):
-                local_tdf = process_excel_file(file_path)
-            elif file.lower().endswith('.xls'):
-                local_tdf = process_old_file(file_path)
-            elif file.lower().endswith(('.csv', '.tsv', '.txt')):
-                local_tdf = process_csv_file(file_path)
-            tdf = add_to_tracking(tdf,local_tdf)
-            # flag the source data as excluded, just for completeness.
-            # see the check above. This means that if you rerun data_split, the same file will not be processed twice unless you
-            # change the 'excl' flag back to False.
-            df.loc[int(index),'excl'] = True
-    logging.info(f'Finished processing files in {data_folder}, found {len(tdf)} new files to add to tracking')
-
-    # now the loop has finished add the accumulated tracking info into the main one
-    df = add_to_tracking(df, tdf)
+    tracking = Tracking(tracking_file_path, step=0)
+
+    # The processing creates files that need to be added to the tracking: they are added all together after the loop
+    found = 0
+    # data_split only works on step 0 files, the raw data that was downloaded
+    for index, row in tracking.entries(0, excluded=False):
+        root = row['path']
+        file = row['file']
+        file_path = os.path.join(root, file)
+        # never process files that we wrote out on a previous iteration
+        if file.lower().startswith('expdata_') or file.lower().startswith('split_'):
+            logging.info(f"Skipping file: {file_path}")
+            continue
+        logging.info(f"Processing file: {file_path}")
+        local_tdf = []
+        if file.lower().endswith('.xlsx'):
+            local_tdf = process_excel_file(file_path, engine, intermediate_format)
+        elif file.lower().endswith('.xls'):
+            local_tdf = process_old_file(file_path, engine, intermediate_format)
+        elif file.lower().endswith(('.csv', '.tsv', '.txt')):
+            local_tdf, encoding, delimiter = process_csv_file(file_path, row['encoding'], row['delimiter'], intermediate_format)
+            tracking.set(index, encoding=encoding, delimiter=delimiter)
+        tracking.add(local_tdf)
+        found += len(local_tdf)
+        # flag the source data as excluded, just for completeness.
+        # see the check above. This means that if you rerun data_split, the same file will not be processed twice unless you
+        # change the 'excl' flag back to False.
+        tracking.set(index, excl=True)
+        tracking.checkpoint()
+    logging.info(f'Finished processing files in {data_folder}, found {found} new files to add to tracking')
 
     # write out the updated information (should have the new files we just wrote out)
-    save_tracking(df, tracking_file_path)
+    tracking.save()
 
 
 if __name__ == '__main__':
@@ -214,17 +284,24 @@ if __name__ == '__main__':
     # manage the command line options
     parser = argparse.ArgumentParser(description='Splits downloaded supplementary data in .xlsx files (and others) into .csv files, one per table')
     parser.add_argument('-i','--input_dir', default='data', help='Destination top-level directory for input data files (output files also written here)')
-    parser.add_argument('-t','--tracking_file', default='akg_tracking.xlsx', help='Tracking file name. This file is created in the top-level directory.')
+    parser.add_argument('-t','--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file is created in the top-level directory.')
     parser.add_argument('-l', '--log', default='data_split.log', help='Log file name. This file is created in the top-level directory.')
+    parser.add_argument('-e', '--engine', default='standard', choices=EXCEL_ENGINES, help="How to read .xlsx and .xls files: 'standard' uses openpyxl and xlrd (the default), 'calamine' uses python-calamine, which is much faster on large files, 'auto' uses calamine if it is installed")
+    parser.add_argument('--intermediate-format', default='csv', choices=INTERMEDIATE_FORMATS, help="Write the split_ files as csv (the default) or as Parquet, which keeps the column types and is much faster for the later programs to read")
 
     # argparse populates an object using parse_args
     # extract its members into a dict and from there into variables if used in more than one place
     config = vars(parser.parse_args())
 
     main_dir = config['input_dir']
+    engine = config['engine']
 
     if not os.path.isdir(main_dir):
         raise AKGException(f"data_convert: data directory {main_dir} must exist") 
+    if engine == 'calamine' and not calamine_available():
+        raise AKGException("data_split: python-calamine must be installed for --engine calamine (pip install python-calamine)")
+    if config['intermediate_format'] == 'parquet' and not parquet_available():
+        raise AKGException("data_split: pyarrow must be installed for --intermediate-format parquet (pip install pyarrow)")
 
     akg_logging_config(os.path.join(main_dir, config['log']))
     logging.info(f'Starting data_split in {main_dir}')
@@ -239,13 +316,15 @@ if __name__ == '__main__':
     log_file = config['log']
     log_file = os.path.join(main_dir, log_file)
 
-    if not os.path.exists(tracking_file):
+    if not tracking_exists(tracking_file):
         create_tracking(main_dir, tracking_file)
     else:
         if not check_tracking_writeable(tracking_file):
             logging.error(f"csv_data_cleaning: {tracking_file} must be writable: close it in Excel and try again")
             raise AKGException(f"csv_data_cleaning: {tracking_file} must be writable: close it in Excel and try again")
+        # pick up any papers downloaded since the tracking file was created
+        update_tracking_downloads(main_dir, tracking_file)
 
     supp_data_folder = os.path.join(main_dir,"supp_data")
-    process_supp_data_folder(supp_data_folder, tracking_file)
+    process_supp_data_folder(supp_data_folder, tracking_file, engine, config['intermediate_format'])
 
@@ -6,9 +6,9 @@ from dotenv import load_dotenv
 import textwrap
 import json
 import argparse
-from akg import AKGException, akg_logging_config
+from akg import AKGException, akg_logging_config, is_parquet, parquet_head
 import logging
-from tracking import check_tracking_writeable, load_tracking, save_tracking
+from tracking import check_tracking_writeable, Tracking, DEFAULT_TRACKING_FILE, tracking_exists
 import sys 
 
 # Load environment variables from .env file
@@ -29,6 +29,9 @@ if not GOOGLE_API_KEY:
 
 genai.configure(api_key=GOOGLE_API_KEY)
 
+# the number of rows of a Parquet file to show the model, which are then cut to the same length as a csv file's start
+PREVIEW_ROWS = 50
+
 def genai_check(filename:str)->Tuple[bool,str]:
     """Check (using generative AI model) if the file is of the type we require
     for our study. See prompt_template below for the exact details.
@@ -44,8 +47,12 @@ def genai_check(filename:str)->Tuple[bool,str]:
     max_chars = 500
     # Read the content of the file
     try:
-        with open(filename, 'r') as f:
-            file_content = f.read(max_chars)
+        if is_parquet(filename):
+            # a split_ file written with --intermediate-format parquet: its first rows, as they would be in a csv file
+            file_content = parquet_head(filename, PREVIEW_ROWS).to_csv(index=False)[:max_chars]
+        else:
+            with open(filename, 'r') as f:
+                file_content = f.read(max_chars)
     except FileNotFoundError:
         print(f"Error: The file '{filename}' was not found.")
         exit()
@@ -132,7 +139,7 @@ if __name__ == "__main__":
     # manage the command line options
     parser = argparse.ArgumentParser(description='Check the format of chosen files using Google Gemini AI model.')
     parser.add_argument('-i', '--input_dir', default='data', help='Destination top-level directory for input data files (output files also written here)')
-    parser.add_argument('-t', '--tracking_file', default='akg_tracking.xlsx', help='Tracking file name. This file is created in the top-level directory.')
+    parser.add_argument('-t', '--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file is created in the top-level directory.')
     parser.add_argument('-l', '--log', default='genai_check.log', help='Log file name. This file is created in the top-level directory.')
     parser.add_argument('-e', '--exclude', action='store_true', help='Set the tracking file exclude value to True for the files that are not suitable')
     parser.add_argument('-c', '--check-one-file', default=None, help='Check this one file only, in the input directory')
@@ -166,7 +173,7 @@ if __name__ == "__main__":
         # create the tracking file    
         tracking_file = config['tracking_file']
         tracking_file = os.path.join(main_dir, tracking_file)
-        if not os.path.exists(tracking_file):
+        if not tracking_exists(tracking_file):
             raise AKGException(f'No tracking file {tracking_file}, cannot track results or determine which files to process')
         else:
             if not check_tracking_writeable(tracking_file):
@@ -174,36 +181,30 @@ if __name__ == "__main__":
                 raise AKGException(f"csv_data_cleaning: {tracking_file} must be writable: close it in Excel and try again")
 
         # loop over all the files identified by the tracking file and process them
-        df = load_tracking(tracking_file)
+        tracking = Tracking(tracking_file, step=1)
 
-    # TODO: remove loop iteration, do sthg more pythonic
-        for index, row in df.iterrows():
+        # only operate on those files created by data_split
+        for index, row in tracking.entries(1):
             root = row['path']
             file = row['file']
-            # only operate on those files created by data_split
             # Use the excluded flag to skip files
-            if row['step'] == 1:
-                file_path = os.path.join(root, file)
-                if row['excl']:
-                    logging.info(f"File: {file_path} flagged as excluded")
+            file_path = os.path.join(root, file)
+            if row['excl']:
+                logging.info(f"File: {file_path} flagged as excluded")
+            else:
+                logging.info(f"Processing file: {file_path}")
+                is_valid, explanation, skip_rows, lfc, pval, gene = genai_check(file_path)
+                if is_valid:
+                    logging.info(f"File '{file_path}' is of the required type.")
                 else:
-                    logging.info(f"Processing file: {file_path}")
-                    is_valid, explanation, skip_rows, lfc, pval, gene = genai_check(file_path)
-                    if is_valid:
-                        logging.info(f"File '{file_path}' is of the required type.")
-                    else:
-                        logging.info(f"File '{file_path}' is not of the required type.")
-                    logging.info(f"Explanation: {explanation}")
-                    df.loc[int(index),'suitable'] = is_valid
-                    df.loc[int(index),'suitablereason'] = explanation
-                    df.loc[int(index),'skip'] = skip_rows
-                    df.loc[int(index),'lfc'] = lfc
-                    df.loc[int(index),'pval'] = pval
-                    df.loc[int(index),'gene'] = gene
-                    if not is_valid and record_exclusions:
-                        df.loc[int(index),'excl'] = True
-                        logging.info(f"Excluding file: {file_path}")
-                    # insert a delay of 10s to avoid hammering the API and hitting rate limits
-                    sleep(10)
-
-        save_tracking(df, tracking_file)
+                    logging.info(f"File '{file_path}' is not of the required type.")
+                logging.info(f"Explanation: {explanation}")
+                tracking.set(index, suitable=is_valid, suitablereason=explanation, skip=skip_rows, lfc=lfc, pval=pval, gene=gene)
+                if not is_valid and record_exclusions:
+                    tracking.set(index, excl=True)
+                    logging.info(f"Excluding file: {file_path}")
+                tracking.checkpoint()
+                # insert a delay of 10s to avoid hammering the API and hitting rate limits
+                sleep(10)
+
+        tracking.save()
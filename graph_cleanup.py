@@ -4,42 +4,91 @@ import argparse
 import os
 import logging
 import sys
+import pandas as pd
 from akg import AKGException,akg_logging_config
 
+# the cleaning rules, applied to each line of an N-Triples file
+decimal_pattern = re.compile(r'"(-?\d+(\.\d+)?([eE][-+]?\d+)?)"(?!\^\^)')
+empty_literal_pattern = re.compile(r'\s+"(\s*|-)"(\^\^<[^>]+>)?\s*\.$')
+date_pattern = re.compile(r'<http://purl.org/dc/terms/date>\s+"(\d+)"\s+\.$')
+DATE_PREDICATE = 'http://purl.org/dc/terms/date'
+
+def cleanup_line(line:str) -> str|None:
+    """Apply the cleaning rules to one line of an N-Triples file. Returns the line to write, or None if the line is dropped.
+    create_rdf_triples can apply the same rules as it creates each literal (its --literals cleanup option), see cleanup_literal_rules.
+    """
+    if line.strip() == '' or empty_literal_pattern.search(line):
+        return None
+
+    #find any date predicate, label datatype of the object as a date
+    if DATE_PREDICATE in line:
+        return date_pattern.sub(r'<http://purl.org/dc/terms/date> "\1"^^<http://www.w3.org/2001/XMLSchema#gYear> .', line)
+    #find any decimal value, label datatype of the object as a double
+    return decimal_pattern.sub(r'"\1"^^<http://www.w3.org/2001/XMLSchema#double>', line)
+
+def cleanup_literal_rules(quoted:pd.Series) -> tuple[pd.Series, pd.Series]:
+    """The result of cleanup_line for a column of literal objects, worked out all at once: quoted holds each literal as written
+    in N-Triples, with its quotes (as rdflib writes a plain literal). The subject and predicate must be URIs that cannot change 
+    the result, so not the date predicate: all those written by create_rdf_triples are.
+    Returns:
+    - a boolean Series, True where the line would be dropped
+    - a boolean Series, True where the literal would be given the double datatype (this is only ever the last quoted number on
+      the line, which can only be the whole literal or the end of it, after an escaped quote)
+    """
+    # object dtype, so that the patterns are matched by re, exactly as cleanup_line matches them
+    quoted = quoted.astype(object)
+    dropped = quoted.str.fullmatch(r'"(\s*|-)"')
+    double = (quoted.str.contains(r'"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?"$', regex=True)
+              & ~quoted.str.contains(DATE_PREDICATE, regex=False) & ~dropped)
+    return dropped, double
+
 def process_nt_file(input_file:str, output_file:str):
     """Add extra data cleaning to the file graph file - ensures any values are given correct datatype (double or data), 
     and that any blank values are removed.
-
+    Not needed for graphs created by create_rdf_triples with typed literals (its default), or with --literals cleanup, which
+    gives exactly what this would.
     """
-    decimal_pattern = re.compile(r'"(-?\d+(\.\d+)?([eE][-+]?\d+)?)"')
-    empty_literal_pattern = re.compile(r'\s+"(\s*|-)"(\^\^<[^>]+>)?\s*\.$')
-    date_pattern = re.compile(r'<http://purl.org/dc/terms/date>\s+"(\d+)"\s+\.$')
-
     with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
         for line in infile:
-            if line.strip() == '' or empty_literal_pattern.search(line):
-                continue
-
-            #find any date predicate, label datatype of the object as a date
-            if 'http://purl.org/dc/terms/date' in line:
-                modified_line = date_pattern.sub(r'<http://purl.org/dc/terms/date> "\1"^^<http://www.w3.org/2001/XMLSchema#gYear> .', line)
+            modified_line = cleanup_line(line)
+            if modified_line is not None:
                 outfile.write(modified_line)
-            else:
-                #find any decimal value, label datatype of the object as a double
-                match = decimal_pattern.search(line)
-                if match:
-                    modified_line = decimal_pattern.sub(r'"\1"^^<http://www.w3.org/2001/XMLSchema#double>', line)
-                    outfile.write(modified_line)
-                else:
-                    outfile.write(line)
+
+def test_cleanup_literal_rules():
+    """
+    The column rules must agree with cleanup_line, including on the awkward values
+    """
+    from rdflib import URIRef, Literal
+    from create_rdf_triples import nt_row
+    values = ['0.05', '-1.2e-05', '1E+3', '7', '.5', '5.', '1,5', 'NA', '', ' ', '\t', '-', '--', ' - ', '\n', 'x "5', 
+              '5"x', 'a"1"b', '"12"', 'x\\', '\u0663', f'{DATE_PREDICATE} 5', 'BRCA1', 'caf\u00e9']
+    triples = [(URIRef('urn:uuid:0d5e6c52-0000-4000-8000-000000000000'), URIRef('http://edamontology.org/data_1669'), Literal(v)) for v in values]
+    lines = [nt_row(triple) for triple in triples]
+    quoted = pd.Series([line.split(' ', 2)[2][:-3] for line in lines])
+    dropped, double = cleanup_literal_rules(quoted)
+    for i, line in enumerate(lines):
+        expected = cleanup_line(line)
+        if dropped[i]:
+            assert expected is None, values[i]
+        elif double[i]:
+            assert expected == line[:-3] + '^^<http://www.w3.org/2001/XMLSchema#double> .\n', values[i]
+        else:
+            assert expected == line, values[i]
+
+def test_cleanup_line_typed():
+    """
+    Lines that already have a datatype are left alone, so cleaning a graph twice does no harm
+    """
+    line = '<urn:uuid:0d5e6c52-0000-4000-8000-000000000000> <http://edamontology.org/data_1669> "0.05"^^<http://www.w3.org/2001/XMLSchema#double> .\n'
+    assert cleanup_line(line) == line
+    assert cleanup_line(cleanup_line(line.replace('^^<http://www.w3.org/2001/XMLSchema#double>', ''))) == line
 
 
 if __name__ == '__main__':
     """
     Main entry point for graph_cleanup.
-    No tracking file, this is to clean up existing graphs, this should really be implemented at the time of graph creation.
+    No tracking file, this is to clean up existing graphs: create_rdf_triples now gives the datatypes as the graph is created.
     The standard logging is not used here.
-    TODO: #31 change create_rdf_triples to implement the formatting given in graph_cleanup.py
 
     """
 
@@ -2,7 +2,7 @@ import json
 import os
 import argparse
 from rdflib import Graph, Namespace, URIRef, Literal, query
-from akg import AKGException, FilenameUUIDMap, load_graph
+from akg import AKGException, FilenameUUIDMap, load_graph, deterministic_row_uuid
 # from akg import BIOLINK, ENSEMBL, NCBIGENE, RDFS, RDF, SCHEMA, EDAM, DOI, DCT, PMC, OWL, MONARCH, URN
 
 
@@ -207,8 +207,9 @@ def main():
                                 row_uri_labels = json.load(f)
                                 print(f'Loaded {len(row_uri_labels)} row labels from {rulfile}')
                         else:
-                            print(f'File {rulfile} does not exist in the same directory. Row labels not available.')
-                            row_uri_labels = {}
+                            # the graph may have been created with deterministic row URIs, which give the labels without the file
+                            print(f'File {rulfile} does not exist in the same directory. Using deterministic row labels.')
+                            row_uri_labels = {f'urn:uuid:{deterministic_row_uuid(dataset_uuid_trim, i)}': f'row {i}' for i in range(len(row_results))}
                     except FileNotFoundError:
                         row_uri_labels = {}
 
@@ -0,0 +1,236 @@
+"""runs data_split, data_convert, csv_data_cleaning and create_rdf_triples (per file) on each downloaded file in turn, passing the tables from one stage to the next in memory"""
+import os
+import sys
+import logging
+import argparse
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from akg import AKGException, FilenameUUIDMap, GeneIdStore, MONARCH, _write_test_gene_sources, akg_logging_config, sniff_csv, write_table, written_with, table_extension, parquet_available, INTERMEDIATE_FORMATS
+from tracking import check_tracking_writeable, create_tracking, update_tracking_downloads, Tracking, tracking_record, DEFAULT_TRACKING_FILE, tracking_exists
+import data_split
+import data_convert
+from csv_data_cleaning import clean_dataframe, clean_column_name
+import create_rdf_triples
+from create_rdf_triples import conversion_key, convert_file, LITERAL_MODES
+
+def run_download(file_path:str, encoding:str='', delimiter:str='', keep:bool=False, stream:bool=False, metadata_file:str='', deterministic:bool=False, literals:str='typed', engine:str='standard', intermediate_format:str='csv')->list[dict]:
+    """
+    Take one downloaded file through all the stages, as data_split.py, data_convert.py, csv_data_cleaning.py and
+    create_rdf_triples.py -f would. Each table goes from one stage to the next as a dataframe: the split_ and expdata_
+    files are only written if keep is True, but are still given their tracking entries, so the lineage of each graph is
+    as if they had been. The clean_ file is always written, being the file that the graph records the hash of.
+    Parameters:
+        file_path:      the downloaded file
+        encoding, delimiter: those of a csv, tsv or txt file, if known, as for data_split.read_tables
+        keep:           write out the split_ and expdata_ files too
+        stream, metadata_file, deterministic, literals: as for create_rdf_triples.convert_file
+        engine:         the choice of spreadsheet reader, as for data_split.read_tables
+        intermediate_format: the format of the split_, expdata_ and clean_ files, one of INTERMEDIATE_FORMATS
+    Returns:
+        the tracking records for all the files created from file_path, in the order the stages would add them
+    """
+    records = []
+    output_dir = os.path.dirname(file_path)
+    # the names given to the files that haven't been written, so that no two tables are given the same one
+    taken = set()
+    for sheet_name, df, delim in data_split.read_tables(file_path, engine, encoding, delimiter):
+        # data_split
+        split_record = data_split.process_dataframe(df, sheet_name, output_dir, file_path, input_delimiter=delim, write=keep, taken=taken, intermediate_format=intermediate_format)[0]
+        records.append(split_record)
+        split_path = os.path.join(output_dir, split_record['file'])
+
+        # data_convert, which works on the table as read back from the split_ file
+        split_name = os.path.splitext(split_record['file'])[0]
+        expdata_records = data_convert.process_dataframe(df, split_name, output_dir, split_path, input_delimiter=None, write=keep, taken=taken, intermediate_format=intermediate_format)
+        if not expdata_records:
+            continue
+        expdata_record = expdata_records[0]
+        records.append(expdata_record)
+        expdata_path = os.path.join(output_dir, expdata_record['file'])
+
+        # csv_data_cleaning
+        cleaned = clean_dataframe(df)
+        clean_name = f"clean_{os.path.splitext(expdata_record['file'])[0]}{table_extension(intermediate_format)}"
+        clean_path = os.path.join(output_dir, clean_name)
+        write_table(cleaned, clean_path)
+        logging.info(f"Processed to: {clean_path}")
+        expdata_record['cleaned'] = True
+        pval = clean_column_name(expdata_record['pval'])
+        gene = clean_column_name(expdata_record['gene'])
+        lfc = clean_column_name(expdata_record['lfc'])
+        clean_record = tracking_record(3, output_dir, expdata_record['pmid'], clean_name, False, True, expdata_path, False, False, '', 0, pval, gene, lfc, '', 0, 0, False, '', '', *written_with(clean_name))
+        records.append(clean_record)
+
+        # create_rdf_triples -f
+        graph_file_name = f"graph_{clean_name}.nt"
+        graph_file = os.path.join(output_dir, graph_file_name)
+        key = conversion_key(clean_path, gene, pval, lfc, deterministic, literals, metadata_file)
+        matched, unmatched = convert_file(clean_path, graph_file, gene, pval, lfc, stream, metadata_file, True, deterministic, literals, table=cleaned)
+        logging.info(f"Graph for {clean_path} written to {graph_file}")
+        clean_record.update(graphfile=graph_file, matched=matched, unmatched=unmatched, graphhash=key)
+        records.append(tracking_record(4, output_dir, expdata_record['pmid'], graph_file_name, False, True, clean_path, False, False, '', 0, '', '', '', graph_file_name, 0, 0, False, ''))
+    return records
+
+def init_worker(file_to_uuid_path:str, log_file:str):
+    """
+    Set up a process in the pool used by the --jobs option. Its dataset UUIDs are returned with its results, for the
+    main process to add to the map file (see FilenameUUIDMap.persist)
+    """
+    akg_logging_config(log_file)
+    create_rdf_triples.g_filename_uuid_map = FilenameUUIDMap(file_to_uuid_path, persist=False)
+
+def run_download_worker(file_path:str, *args)->tuple[list[dict], dict]:
+    """
+    run_download, in a process in the pool
+    Returns:
+        its tracking records, and the dataset UUIDs it has made
+    """
+    uuid_map = create_rdf_triples.g_filename_uuid_map
+    uuid_map.new = {}
+    return run_download(file_path, *args), uuid_map.new
+
+def test_run_download(tmp_path):
+    """
+    A csv download gives a split, expdata and clean tracking entry, and a graph, with only the clean_ file written
+    """
+    pmid_dir = tmp_path / '12345'
+    pmid_dir.mkdir()
+    download = pmid_dir / 'table1.csv'
+    download.write_text('Gene\tlog2FoldChange\tpvalue\nA1BG\t1.5\t0.001\nNRXN1\t-0.5\t0.02\n')
+    # a small gene source, in which A1BG is HGNC:5 and NRXN1 isn't found
+    gene_dir = tmp_path / 'genes'
+    gene_dir.mkdir()
+    gene_ids, hgnc_file = _write_test_gene_sources(str(gene_dir))
+    gene_id_store = create_rdf_triples.g_gene_id_store
+    create_rdf_triples.g_gene_id_store = GeneIdStore(gene_ids, hgnc_file)
+    create_rdf_triples.g_filename_uuid_map = FilenameUUIDMap(str(tmp_path / 'filename_uuid_map.json'))
+    try:
+        records = run_download(str(download), deterministic=True)
+        assert [record['step'] for record in records] == [1, 2, 3, 4]
+        assert [record['file'] for record in records] == ['split_table1.csv', 'expdata_table1.csv', 'clean_expdata_table1.csv', 'graph_clean_expdata_table1.csv.nt']
+        assert records[1]['cleaned'] and records[1]['lfc'] == 'log2FoldChange'
+        assert records[2]['lfc'] == 'log2foldchange' and records[2]['graphhash']
+        assert (records[2]['matched'], records[2]['unmatched']) == (1, 1)
+        assert sorted(os.listdir(pmid_dir)) == ['clean_expdata_table1.csv', 'graph_clean_expdata_table1.csv.nt', 'table1.csv']
+        graph = (pmid_dir / 'graph_clean_expdata_table1.csv.nt').read_text()
+        assert f'<{MONARCH["HGNC:5"]}>' in graph and '"NRXN1"' in graph
+        # the same graph from a Parquet clean_ file
+        pytest.importorskip('pyarrow')
+        parquet_records = run_download(str(download), deterministic=True, intermediate_format='parquet')
+        assert parquet_records[2]['file'] == 'clean_expdata_table1.parquet' and parquet_records[2]['encoding'] == ''
+        assert (pmid_dir / 'graph_clean_expdata_table1.parquet.nt').read_text() == graph
+    finally:
+        create_rdf_triples.g_gene_id_store = gene_id_store
+
+if __name__ == '__main__':
+
+    command_line_str = ' '.join(sys.argv)
+
+    # manage the command line options
+    parser = argparse.ArgumentParser(description='Split, convert, clean and create a graph for each downloaded supplementary data file, in one run')
+    parser.add_argument('-i','--input_dir', default='data', help='Destination top-level directory for input data files (output files also written here)')
+    parser.add_argument('-t','--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file is created in the top-level directory.')
+    parser.add_argument('-l','--log', default='pipeline.log', help='Log file name. This file is created in the top-level directory.')
+    parser.add_argument('-k','--keep_intermediate', action='store_true', help="Also write out the split_ and expdata_ files (by default only the clean_ files and graphs are written)")
+    parser.add_argument('-j','--jobs', type=int, default=1, help="Number of downloaded files to process at the same time, in separate processes (default 1)")
+    parser.add_argument('-s','--stream', action='store_true', help="Write the triples to the graph files as they are created, as for create_rdf_triples.py")
+    parser.add_argument('-d','--deterministic', action='store_true', help="Derive each row URI from its dataset and row number, as for create_rdf_triples.py")
+    parser.add_argument('-y','--literals', default='typed', choices=LITERAL_MODES, help="How to write the values, as for create_rdf_triples.py")
+    parser.add_argument('-m','--metadata', action='store_true', help="Add the article metadata to each graph, as for create_rdf_triples.py")
+    parser.add_argument('-e','--engine', default='standard', choices=data_split.EXCEL_ENGINES, help="How to read .xlsx and .xls files, as for data_split.py")
+    parser.add_argument('--intermediate-format', default='csv', choices=INTERMEDIATE_FORMATS, help="Write the clean_ files (and with -k, the split_ and expdata_ files) as csv (the default) or as Parquet")
+
+    # argparse populates an object using parse_args
+    # extract its members into a dict and from there into variables if used in more than one place
+    config = vars(parser.parse_args())
+
+    main_dir = config['input_dir']
+    keep = config['keep_intermediate']
+    jobs = config['jobs']
+
+    if not os.path.isdir(main_dir):
+        raise AKGException(f"pipeline: data directory {main_dir} must exist")
+    if config['engine'] == 'calamine' and not data_split.calamine_available():
+        raise AKGException("pipeline: python-calamine must be installed for --engine calamine (pip install python-calamine)")
+    if config['intermediate_format'] == 'parquet' and not parquet_available():
+        raise AKGException("pipeline: pyarrow must be installed for --intermediate-format parquet (pip install pyarrow)")
+
+    log_file = os.path.join(main_dir, config['log'])
+    akg_logging_config(log_file)
+    logging.info(f'Starting pipeline in {main_dir}')
+    logging.info(f"Program executed with command: {command_line_str}")
+
+    tracking_file = config['tracking_file']
+    tracking_file = os.path.join(main_dir, tracking_file)
+    if not tracking_exists(tracking_file):
+        create_tracking(main_dir, tracking_file)
+    else:
+        if not check_tracking_writeable(tracking_file):
+            raise AKGException(f"pipeline: {tracking_file} must be writable: close it in Excel and try again")
+        # pick up any papers downloaded since the tracking file was created
+        update_tracking_downloads(main_dir, tracking_file)
+
+    graph_folder = os.path.join(main_dir, "graph")
+    os.makedirs(graph_folder, exist_ok=True)
+    file_to_uuid_path = os.path.join(graph_folder, 'filename_uuid_map.json')
+    uuid_map = FilenameUUIDMap(file_to_uuid_path)
+    create_rdf_triples.g_filename_uuid_map = uuid_map
+
+    metadata_file = ''
+    if config['metadata']:
+        metadata_file = os.path.join(main_dir, 'asd_article_metadata.csv')
+        if not os.path.isfile(metadata_file):
+            raise AKGException(f"pipeline: {metadata_file} must exist for -m: run processing.py first")
+    args = (keep, config['stream'], metadata_file, config['deterministic'], config['literals'], config['engine'], config['intermediate_format'])
+
+    # works through the downloads, as data_split does
+    tracking = Tracking(tracking_file, step=0)
+    pool = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(file_to_uuid_path, log_file)) if jobs > 1 else None
+
+    pending = []
+    for index, row in tracking.entries(0, excluded=False):
+        file = row['file']
+        file_path = os.path.join(row['path'], file)
+        # never process files that we wrote out on a previous iteration
+        if file.lower().startswith('expdata_') or file.lower().startswith('split_'):
+            logging.info(f"Skipping file: {file_path}")
+            continue
+        logging.info(f"Processing file: {file_path}")
+        # recorded for the download as data_split does, see read_csv_data
+        read_with = {}
+        if file.lower().endswith(('.csv', '.tsv', '.txt')):
+            encoding, delimiter = row['encoding'], row['delimiter']
+            if not encoding or not delimiter:
+                try:
+                    encoding, delimiter = sniff_csv(file_path)
+                except OSError as e:
+                    logging.error(f"Error processing file {file_path}: {str(e)}")
+                    continue
+            read_with = {'encoding': encoding, 'delimiter': delimiter}
+        file_args = (read_with.get('encoding', ''), read_with.get('delimiter', '')) + args
+        future = pool.submit(run_download_worker, file_path, *file_args) if pool is not None else None
+        pending.append((index, file_path, read_with, file_args, future))
+
+    # the results are recorded in tracking file order
+    found = 0
+    for index, file_path, read_with, file_args, future in pending:
+        try:
+            if future is None:
+                records = run_download(file_path, *file_args)
+            else:
+                records, new_uuids = future.result()
+                uuid_map.merge(new_uuids)
+        except Exception as e:
+            logging.error(f"Error processing file {file_path}: {str(e)}")
+            continue
+        tracking.add(records)
+        found += len(records)
+        # flag the source data as excluded, as data_split does
+        tracking.set(index, excl=True, **read_with)
+        tracking.checkpoint()
+
+    if pool is not None:
+        pool.shutdown()
+    logging.info(f'Finished processing files in {main_dir}, found {found} new files to add to tracking')
+
+    tracking.save()
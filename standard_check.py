@@ -6,55 +6,84 @@ from dotenv import load_dotenv
 import textwrap
 import json
 import argparse
-from akg import AKGException, akg_logging_config
+from akg import AKGException, akg_logging_config, read_table, read_table_head
+from column_roles import infer_column_roles
 import logging
-from tracking import load_tracking, save_tracking
+from tracking import check_tracking_writeable, Tracking, DEFAULT_TRACKING_FILE, tracking_exists
 import sys 
 import pandas as pd
-import re
+from concurrent.futures import ProcessPoolExecutor
 
-def standard_check(file_path:str, skip_rows:int)->Tuple[bool,str, str]:
+def standard_check(file_path:str, skip_rows:int, encoding:str='', delimiter:str='', sample_rows:int|None=None)->Tuple[bool,str, str]:
     """Check (using standard algorithm) if the file is of the type we require
     for our study. See prompt_template below for the exact details.
 
     Args:
         file_path (str): The path to the file to check.
+        encoding, delimiter (str): of the file, if known from the tracking file, otherwise found from the start of the file
+        sample_rows (int): if given, read only the header line and this many rows after it, rather than the whole file.
+            With rows, the log fold change column must have a number in them. 0 reads just the header.
     Returns:
         bool: True if the file is of the required type, False otherwise.
         str: Explanation of the result.
         lfc: the title of the column containing log fold changes.
     """
     # Read the content of the file
+    # the file is read once, with the encoding and delimiter given or found from the start of it, rather than with 
+    # each possible encoding and delimiter in turn (or it is a Parquet file written by data_split). With sample_rows,
+    # only the lines needed are read, without pandas' parser
     try:
-        # Try reading with different settings
-        for encoding in ['utf-8', 'iso-8859-1', 'latin1']:
-# commented out previous version           for delim in ['\t', ',', ';']:  # prioritize tab
-            for delim in [',', '\t', ';']:  # prioritize comma, this is a CSV file. I don't know why the previous prioritisation was used.
-                try:
-                    # this is the only point where the skip at the start of the file is made
-                    # after this stage, the column headers are assumed to be on the first line.
-                    df = pd.read_csv(file_path, delimiter=delim, encoding=encoding, on_bad_lines='warn', skiprows=skip_rows)
-                    if not df.empty:
+        # this is the only point where the skip at the start of the file is made
+        # after this stage, the column headers are assumed to be on the first line.
+        if sample_rows is None:
+            df, encoding, delimiter = read_table(file_path, encoding, delimiter, skip_rows, on_bad_lines='warn')
+        else:
+            df, encoding, delimiter = read_table_head(file_path, sample_rows, encoding, delimiter, skip_rows)
+        if not df.empty or sample_rows == 0:
 # commented out previous version                       df.columns = df.columns.astype(str)
-                        log_fold_col = None
-                        for col in df.columns:
-                            logging.debug(f"Column found: {col}")
-                            if any(phrase in re.sub(r'[_\s-]', '', col.lower()) for phrase in ['logfoldchange', 'logfold', 'logfold2', 'lf', 
-                                                                                            'expression', 'enrichment', 'logfc', 'foldchange', 'fc', 
-                                                                                            'log2', 'lf2', 'lfc', 'log2fc', 'log', 'fold']):
-                                log_fold_col = col
-                                logging.info(f"Log Fold Change Column: {log_fold_col}")
-                                break
-                        if log_fold_col:
-                            return True, "Found a log fold change column.", log_fold_col
-                        else:
-                            return False, "No suitable column found.", ''
-                except Exception as e:
-                    logging.error(f"Failed to read {file_path} with delimiter '{delim}' and encoding '{encoding}': {str(e)}")
+            logging.debug(f"Columns found: {list(df.columns)}")
+            # the same column names, found the same way, as data_convert uses
+            log_fold_col = infer_column_roles(df.columns).lfc
+            if not log_fold_col:
+                return False, "No suitable column found.", ''
+            if sample_rows and pd.to_numeric(df[log_fold_col], errors='coerce').isna().all():
+                return False, f"The log fold change column {log_fold_col} has no numbers in the first {len(df)} rows.", ''
+            logging.info(f"Log Fold Change Column: {log_fold_col}")
+            return True, "Found a log fold change column.", log_fold_col
     except FileNotFoundError:
         print(f"Error: The file '{file_path}' was not found.")
+    except Exception as e:
+        logging.error(f"Failed to read {file_path} with delimiter '{delimiter}' and encoding '{encoding}': {str(e)}")
     return False, "File is not of the required type.", ''
 
+def check_files(files:list[tuple[str, int, str, str]], sample_rows:int|None=None, jobs:int=1, log_file:str='')->list[Tuple[bool, str, str]]:
+    """
+    standard_check each of the files, given as (file path, skip_rows, encoding, delimiter), in jobs processes at the
+    same time if more than one, each logging to log_file
+    Returns:
+        the results of standard_check, in the same order as files
+    """
+    checks = [(file_path, skip_rows, encoding, delimiter, sample_rows) for file_path, skip_rows, encoding, delimiter in files]
+    if jobs <= 1 or not checks:
+        return [standard_check(*check) for check in checks]
+    # the files are handed out in batches, because each check is quick
+    batch = max(1, len(checks) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=akg_logging_config, initargs=(log_file,)) as pool:
+        return list(pool.map(standard_check, *zip(*checks), chunksize=batch))
+
+def test_check_files(tmp_path):
+    """
+    Only the header is needed to find the column, and a sample of rows shows whether it has numbers in it
+    """
+    table = tmp_path / 'split_table.csv'
+    table.write_text('a note\nGene,Relevance of circQTLs to ASD,p\nSHANK3,high,0.01\nCHD8,low,0.2\n')
+    files = [(str(table), 1, 'utf-8', ','), (str(tmp_path / 'missing.csv'), 0, 'utf-8', ',')]
+    header, missing = check_files(files, sample_rows=0)
+    assert header == (True, "Found a log fold change column.", 'Relevance of circQTLs to ASD')
+    assert not missing[0]
+    sampled = check_files(files[:1], sample_rows=5, jobs=2)[0]
+    assert not sampled[0] and 'no numbers' in sampled[1]
+
 
 if __name__ == "__main__":
 
@@ -63,10 +92,13 @@ if __name__ == "__main__":
     # manage the command line options
     parser = argparse.ArgumentParser(description='Check the format of chosen files using Google Gemini AI model.')
     parser.add_argument('-i', '--input_dir', default='data', help='Destination top-level directory for input data files (output files also written here)')
-    parser.add_argument('-t', '--tracking_file', default='akg_tracking.xlsx', help='Tracking file name. This file is created in the top-level directory.')
+    parser.add_argument('-t', '--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file is created in the top-level directory.')
     parser.add_argument('-l', '--log', default='standard_check.log', help='Log file name. This file is created in the top-level directory.')
     parser.add_argument('-e', '--exclude', action='store_true', help='Set the tracking file exclude value to True for the files that are not suitable')
     parser.add_argument('-c', '--check-one-file', default=None, help='Check this one file only, in the input directory')
+    parser.add_argument('-H', '--header-only', action='store_true', help='Read only the header line of each file (after the lines to skip), and the number of rows given by --sample-rows, rather than the whole file')
+    parser.add_argument('-n', '--sample-rows', type=int, default=0, help='With -H, also read this many rows, and check that the log fold change column has a number in them (default 0)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of files to check at the same time, in separate processes (default 1)')
 
     # argparse populates an object using parse_args
     # extract its members into a dict and from there into variables if used in more than one place
@@ -75,11 +107,13 @@ if __name__ == "__main__":
     main_dir = config['input_dir']
     one_file = config['check_one_file']
     record_exclusions = config['exclude']
+    # None to read the whole of each file
+    sample_rows = config['sample_rows'] if config['header_only'] else None
 
     if one_file:
         filename = one_file
 
-        is_valid, explanation, lfc = standard_check(filename, 0)
+        is_valid, explanation, lfc = standard_check(filename, 0, sample_rows=sample_rows)
         if is_valid:
             print(f"File '{filename}' is of the required type.")
         else:
@@ -90,7 +124,8 @@ if __name__ == "__main__":
         if not os.path.isdir(main_dir):
             raise AKGException(f"data_convert: data directory {main_dir} must exist") 
 
-        akg_logging_config(os.path.join(main_dir, config['log']))
+        log_file = os.path.join(main_dir, config['log'])
+        akg_logging_config(log_file)
         logging.info(f"Program executed with command: {command_line_str}")
 
         logging.info(f'Top-level data directory {os.path.realpath(main_dir)}')
@@ -98,37 +133,38 @@ if __name__ == "__main__":
         # create the tracking file    
         tracking_file = config['tracking_file']
         tracking_file = os.path.join(main_dir, tracking_file)
-        if not os.path.exists(tracking_file):
+        if not tracking_exists(tracking_file):
             raise AKGException(f'No tracking file {tracking_file}, cannot track results or determine which files to process')
 
-        # loop over all the files identified by the tracking file and process them
-        df = load_tracking(tracking_file)
-
-    # TODO: remove loop iteration, do sthg more pythonic
-        for index, row in df.iterrows():
-            root = row['path']
-            file = row['file']
-            skip_rows = row['skip'] if 'skip' in row else 0
-            # only operate on those files created by data_convert
-            # ignore excluded flag at present, to make a comparison
-            if row['step'] == 1:
-                if row['excl']:
-                    logging.info(f"File: {file_path} flagged as excluded")
-                file_path = os.path.join(root, file)
-                logging.info(f"Processing file: {file_path}")
-                is_valid, explanation, lfc = standard_check(file_path, skip_rows)
-                if is_valid:
-                    logging.info(f"File '{file_path}' is of the required type.")
-                else:
-                    logging.info(f"File '{file_path}' is not of the required type.")
-                logging.info(f"Explanation: {explanation}")
-                if lfc:
-                    logging.info(f"Log Fold Change Column: {lfc}")
-                df.loc[int(index),'suitable'] = is_valid
-                df.loc[int(index),'suitablereason'] = explanation
-                df.loc[int(index),'lfc'] = lfc
-                if not is_valid and record_exclusions:
-                    df.loc[int(index),'excl'] = True
-                    logging.info(f"Excluding file: {file_path}")
-
-        save_tracking(df, tracking_file)
+        if not check_tracking_writeable(tracking_file):
+            raise AKGException(f"standard_check: {tracking_file} must be writable: close it in Excel and try again")
+
+        # the files created by data_split, as for genai_check
+        tracking = Tracking(tracking_file, step=1)
+        # ignore excluded flag at present, to make a comparison
+        indexes = []
+        files = []
+        for index, row in tracking.entries(1):
+            file_path = os.path.join(row['path'], row['file'])
+            if row['excl']:
+                logging.info(f"File: {file_path} flagged as excluded")
+            indexes.append(index)
+            files.append((file_path, row['skip'], row['encoding'], row['delimiter']))
+        logging.info(f"Checking {len(files)} files" + (f", from their headers and first {sample_rows} rows" if sample_rows is not None else ''))
+        results = check_files(files, sample_rows, config['jobs'], log_file)
+
+        # the results are all written to the tracking file together
+        for index, (file_path, _, _, _), (is_valid, explanation, lfc) in zip(indexes, files, results):
+            if is_valid:
+                logging.info(f"File '{file_path}' is of the required type.")
+            else:
+                logging.info(f"File '{file_path}' is not of the required type.")
+            logging.info(f"Explanation: {explanation}")
+            if lfc:
+                logging.info(f"Log Fold Change Column: {lfc}")
+            tracking.set(index, suitable=is_valid, suitablereason=explanation, lfc=lfc)
+            if not is_valid and record_exclusions:
+                tracking.set(index, excl=True)
+                logging.info(f"Excluding file: {file_path}")
+
+        tracking.save()
@@ -1,13 +1,42 @@
 import os
 import re
+import sys
+import argparse
+import sqlite3
+import json
 import pandas as pd
 import tempfile
-from akg import AKGException
+import glob
+from contextlib import contextmanager
+from akg import AKGException, akg_logging_config
 import logging
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
 """
 Tracking functions
-TODO: refactor to a class
+The tracking data is stored in a SQLite database (akg_tracking.db by default), which can be updated a row at a time.
+It can be exported to a spreadsheet for editing by hand, and the edits imported again, see main below.
+A tracking file name ending .xlsx is still read and written directly as a spreadsheet.
+The programs work on the tracking data through the Tracking class, which wraps the functions below.
+While a program runs, its changes are appended to a journal alongside the tracking file (see Tracking.checkpoint), and 
+written to the tracking file itself at the end. A run that stops part way leaves the journal behind, and the next run 
+picks up its changes from there.
+Programs can run at the same time on a tracking database, each working on the rows for a different step (see 
+claim_tracking): each has its own journal, they take turns to write to the database, and each writes only the values it 
+has changed, so none loses another's changes. A spreadsheet can only be used by one program at a time.
 """
+DEFAULT_TRACKING_FILE = 'akg_tracking.db'
+TRACKING_DB_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+TRACKING_TABLE = 'akg_tracking'
+TRACKING_SHEET = 'akg tracking'
+TRACKING_JOURNAL_EXTENSION = '.journal'
+TRACKING_LOCK_EXTENSION = '.lock'
+TRACKING_MANIFEST_EXTENSION = '.manifest.json'
+# the files written alongside the downloads by the programs, which are not downloads themselves
+DERIVED_PREFIXES = ('split_', 'expdata_', 'clean_', 'graph_')
+
 tracking_col_names = {'step':'int'
                         , 'path':"str"
                         , 'pmid':"str"
@@ -27,7 +56,12 @@ tracking_col_names = {'step':'int'
                         , 'unmatched':'int'
                         , 'suitable':'bool'
                         , 'suitablereason':'str'
+                        , 'graphhash':'str'
+                        , 'encoding':'str'
+                        , 'delimiter':'str'
                         }
+# the column types in the SQLite database. The pmid is kept as a number, as it is once loaded
+sqlite_col_types = {col: 'INTEGER' if dt in ('int', 'bool') or col == 'pmid' else 'TEXT' for col, dt in tracking_col_names.items()}
 
 def create_empty_tracking_store()->pd.DataFrame:
     """
@@ -48,9 +82,14 @@ def add_to_tracking(existing:pd.DataFrame, new:pd.DataFrame)->pd.DataFrame:
         new:        pd.DataFrame      a tracking store
 
     Returns:
-        the content of existing, with new's entries added
+        the content of existing, with new's entries added. The existing entries keep their index, which identifies
+        them in the tracking database (see update_tracking), and the new entries are numbered after them
     """
-    return pd.concat([existing,new],ignore_index=True)
+    start = int(existing.index.max()) + 1 if len(existing) else 0
+    new = new.set_axis(range(start, start + len(new)))
+    if len(existing) == 0:
+        return new
+    return pd.concat([existing,new])
 
 def check_tracking_writeable(tracking_file_path:str)->bool:
     """
@@ -67,43 +106,294 @@ def check_tracking_writeable(tracking_file_path:str)->bool:
         return False
     return True
 
-def create_tracking(folder:str, name:str='akg_tracking.xlsx'):
+def create_tracking(folder:str, name:str=DEFAULT_TRACKING_FILE):
     """
     Create the file that can be used to track the contents of 'folder' through the akg process
     This will start as a pandas dataframe serialised to a file
     """
-    # create an empty dataframe
-    df = create_empty_tracking_store()
     logging.info(f'Creating a tracking file {name} for the contents of folder:{folder}')
-    for dirpath, dirnames, filenames in os.walk(folder):
-        for filename in filenames:
-            pmid = os.path.basename(dirpath)
-            # assuming a PMID consists of 8 digits
-            if re.fullmatch(r'\d{8}',pmid):
-                new = tracking_entry(0,dirpath,pmid,filename,False,False,'',False,False,'', 0, '', '', '','', 0, 0,False,'')
-                df = add_to_tracking(df,new)
-                
-    save_tracking(df, name)
+    tracking = Tracking(name, create_empty_tracking_store())
+    manifest = add_downloads(tracking, folder, {})
+    tracking.save()
+    save_manifest(name, manifest)
+
+def update_tracking_downloads(folder:str, name:str=DEFAULT_TRACKING_FILE)->int:
+    """
+    Add the files downloaded to 'folder' since the tracking file was created or last updated, leaving the existing rows as they are
+    Returns:
+        the number of files added
+    """
+    tracking = Tracking(name)
+    added = len(tracking)
+    manifest = add_downloads(tracking, folder, load_manifest(name))
+    added = len(tracking) - added
+    logging.info(f'{added} new or changed downloads in folder:{folder} added to tracking file {name}')
+    tracking.save()
+    save_manifest(name, manifest)
+    return added
+
+def tracking_manifest_name(name:str)->str:
+    """
+    The record of the size and modification time of each download, when the tracking file 'name' was last updated from them
+    """
+    return name + TRACKING_MANIFEST_EXTENSION
+
+def load_manifest(name:str)->dict:
+    try:
+        with open(tracking_manifest_name(name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(name:str, manifest:dict):
+    with open(tracking_manifest_name(name), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+def scan_downloads(folder:str):
+    """
+    Find the downloads: the files in each PMID-named directory (a PMID consists of 8 digits) under folder, in name order
+    Yields:
+        the directory, file name, size and modification time (in ns) of each
+    """
+    directories = [folder]
+    while directories:
+        path = directories.pop()
+        is_pmid = re.fullmatch(r'\d{8}', os.path.basename(path)) is not None
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logging.warning(f'Cannot scan {path} for downloads: {str(e)}')
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif is_pmid and entry.is_file():
+                stat = entry.stat()
+                yield path, entry.name, stat.st_size, stat.st_mtime_ns
+        directories.extend(reversed(subdirectories))
+
+def add_downloads(tracking:'Tracking', folder:str, manifest:dict)->dict:
+    """
+    Add a step 0 row to the tracking data for each download in folder that is new, or changed, since the manifest was made
+    A file already in the tracking data, at any step, is only added again if it has changed and its rows have all been
+    processed (data_split marks them excluded), and not excluded by hand.
+    Parameters:
+        tracking:   the tracking data
+        folder:     the top of the downloads, usually supp_data
+        manifest:   the size and modification time of each download at the last scan, by full name (from load_manifest)
+    Returns:
+        the manifest for the downloads now in folder
+    """
+    scanned = {}
+    # added together at the end, so that looking up each file doesn't add the ones before it to the data
+    new_rows = []
+    for path, file, size, mtime in scan_downloads(folder):
+        full_name = os.path.join(path, file)
+        scanned[full_name] = [size, mtime]
+        if file.lower().startswith(DERIVED_PREFIXES) or manifest.get(full_name) == [size, mtime]:
+            continue
+        rows = tracking.rows_for_file(path, file)
+        if len(rows) > 0:
+            if full_name not in manifest:
+                # tracked before there was a manifest
+                continue
+            step_0 = rows[rows['step'] == 0]
+            if len(step_0) == 0 or not step_0['excl'].all():
+                continue
+            if step_0['manual'].any():
+                logging.info(f'Download {full_name} has changed, but is excluded by hand: not added again')
+                continue
+            logging.info(f'Download {full_name} has changed since it was processed: adding it again')
+        new_rows.append(tracking_record(0, path, os.path.basename(path), file, False, False, '', False, False, '', 0, '', '', '', '', 0, 0, False, ''))
+    tracking.add(new_rows)
+    return scanned
+
+def tracking_record(step:int, path:str, pmid:str, filename:str, excl:bool, derived:bool, source:str, cleaned:bool, manual:bool, manualreason:str, 
+                    skip:int, pval:str, gene:str, lfc:str, graphfile:str, matched:int, unmatched:int, suitable:bool, suitablereason:str, graphhash:str='',
+                    encoding:str='', delimiter:str='')->dict:
+    """
+    Format the provided data into a default tracking entry, as a dict to pass to Tracking.add
+    encoding and delimiter are those of a csv, tsv or txt file, once known (see akg.sniff_csv), for the next program to read it with
+    """
+    return {'step':step,"path":path,"pmid":int(pmid),"file":filename, "excl":excl, "derived":derived,"source":source,"cleaned":cleaned, 
+            "manual":manual, "manualreason":manualreason, "skip":skip, "pval":pval, "gene":gene,'lfc':lfc, 'graphfile':graphfile, 'matched':matched, 'unmatched':unmatched,
+            'suitable':suitable, 'suitablereason':suitablereason, 'graphhash':graphhash, 'encoding':encoding, 'delimiter':delimiter}
 
 def tracking_entry(step:int, path:str, pmid:str, filename:str, excl:bool, derived:bool, source:str, cleaned:bool, manual:bool, manualreason:str, 
-                   skip:int, pval:str, gene:str, lfc:str, graphfile:str, matched:int, unmatched:int, suitable:bool, suitablereason:str)->pd.DataFrame:
+                   skip:int, pval:str, gene:str, lfc:str, graphfile:str, matched:int, unmatched:int, suitable:bool, suitablereason:str, graphhash:str='',
+                   encoding:str='', delimiter:str='')->pd.DataFrame:
     """
     Format the provided data into a default tracking entry
     """
-    return pd.DataFrame([{'step':step,"path":path,"pmid":int(pmid),"file":filename, "excl":excl, "derived":derived,"source":source,"cleaned":cleaned, 
-                          "manual":manual, "manualreason":manualreason, "skip":skip, "pval":pval, "gene":gene,'lfc':lfc, 'graphfile':graphfile, 'matched':matched, 'unmatched':unmatched,
-                          'suitable':suitable, 'suitablereason':suitablereason}])
+    return pd.DataFrame([tracking_record(step, path, pmid, filename, excl, derived, source, cleaned, manual, manualreason,
+                                         skip, pval, gene, lfc, graphfile, matched, unmatched, suitable, suitablereason, graphhash, encoding, delimiter)])
 
-def load_tracking(name:str='akg_tracking.xlsx')->pd.DataFrame:
+def find_tracking_entry(df:pd.DataFrame, step:int, path:str, filename:str)->int|None:
     """
-    Load the tracking data into memory from file
+    Find the row for a file in the tracking data
+    Returns:
+        the index of the first row with this step, path and file name, or None if there isn't one
+    """
+    matches = df.index[(df['step'] == step) & (df['path'] == path) & (df['file'] == filename)]
+    return matches[0] if len(matches) else None
+
+def is_tracking_db(name:str)->bool:
+    """
+    Whether the tracking file is a SQLite database, rather than a spreadsheet
+    """
+    return os.path.splitext(name)[1].lower() in TRACKING_DB_EXTENSIONS
+
+def tracking_xlsx_name(name:str)->str:
+    """
+    The spreadsheet that goes with a tracking database, for export and import: the same name ending .xlsx
+    """
+    return os.path.splitext(name)[0] + '.xlsx'
+
+def tracking_journal_name(name:str, step:int|None=None)->str:
+    """
+    The journal of changes not yet saved to the tracking file 'name', by the program working on the rows for 'step' if given
+    """
+    return name + ('' if step is None else f'.step{step}') + TRACKING_JOURNAL_EXTENSION
+
+def tracking_lock_name(name:str, owner:int|str|None=None)->str:
+    """
+    The file locked while writing to the tracking file 'name', or for as long as a program owns the rows for a step (see claim_tracking)
+    """
+    return name + ('' if owner is None else f'.step{owner}') + TRACKING_LOCK_EXTENSION
+
+def _lock(f, blocking:bool)->bool:
+    """
+    Lock an open file against other processes, until it is closed
+    Returns:
+        False if another process has it locked already, and blocking is False
+    """
+    try:
+        if os.name == 'nt':
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except OSError:
+        if blocking:
+            raise
+        return False
+    return True
+
+@contextmanager
+def tracking_lock(name:str):
+    """
+    Hold the lock on the tracking file 'name', waiting for any other program writing to it to finish
+    """
+    with open(tracking_lock_name(name), 'a+') as f:
+        _lock(f, True)
+        yield
+
+def claim_tracking(name:str, step:int):
+    """
+    Take ownership of the rows for a step of the tracking file 'name' (the rows a program works through), so that
+    two programs can't work on them at the same time. With a spreadsheet, this takes ownership of the whole file.
+    The ownership lasts until the file returned is closed, or the program ends.
+    Raises:
+        AKGException if another program already owns them
+    """
+    owner = step if is_tracking_db(name) else 'all'
+    f = open(tracking_lock_name(name, owner), 'a+')
+    if not _lock(f, False):
+        f.close()
+        what = f'the step {step} rows of {name}' if is_tracking_db(name) else name
+        raise AKGException(f'Another program is working on {what}: wait for it to finish and try again')
+    return f
+
+def _connect_tracking(name:str)->sqlite3.Connection:
+    """
+    Open the tracking database, creating the table if needed, with any columns added since it was created
+    """
+    con = sqlite3.connect(name)
+    columns = ', '.join(f'"{col}" {col_type}' for col, col_type in sqlite_col_types.items())
+    con.execute(f'CREATE TABLE IF NOT EXISTS {TRACKING_TABLE} (id INTEGER PRIMARY KEY, {columns})')
+    con.execute(f'CREATE TABLE IF NOT EXISTS {TRACKING_TABLE}_info (key TEXT PRIMARY KEY, value TEXT)')
+    existing = {row[1] for row in con.execute(f'PRAGMA table_info({TRACKING_TABLE})')}
+    for col, col_type in sqlite_col_types.items():
+        if col not in existing:
+            default = "''" if col_type == 'TEXT' else '0'
+            con.execute(f'ALTER TABLE {TRACKING_TABLE} ADD COLUMN "{col}" {col_type} NOT NULL DEFAULT {default}')
+    return con
+
+def _tracking_rows(df:pd.DataFrame)->list[tuple]:
+    """
+    The rows of the tracking data as tuples of python values for SQLite, each starting with its index as the id
+    """
+    values = df[list(tracking_col_names)].astype(object)
+    return [(int(index),) + row for index, row in zip(df.index, values.itertuples(index=False, name=None))]
+
+def _write_tracking_rows(con:sqlite3.Connection, df:pd.DataFrame):
+    columns = ', '.join(f'"{col}"' for col in tracking_col_names)
+    placeholders = ', '.join('?' * (len(tracking_col_names) + 1))
+    con.executemany(f'INSERT OR REPLACE INTO {TRACKING_TABLE} (id, {columns}) VALUES ({placeholders})', _tracking_rows(df))
+
+def _xlsx_mtime(name:str)->str:
+    xlsx = tracking_xlsx_name(name)
+    return str(os.stat(xlsx).st_mtime_ns) if os.path.exists(xlsx) else ''
+
+def _record_xlsx(con:sqlite3.Connection, name:str):
+    """
+    Note the state of the spreadsheet, once it has been exported or imported, so that a later change to it can be spotted
+    """
+    con.execute(f'INSERT OR REPLACE INTO {TRACKING_TABLE}_info (key, value) VALUES (?, ?)', ('xlsx_mtime', _xlsx_mtime(name)))
+
+def migrate_tracking(name:str)->bool:
     """
+    If the tracking database doesn't exist yet, but the spreadsheet from an earlier version does, 
+    create the database from the spreadsheet
+    Returns:
+        True if the database was created
+    """
+    xlsx = tracking_xlsx_name(name)
+    if not is_tracking_db(name) or os.path.exists(name) or not os.path.exists(xlsx):
+        return False
+    logging.info(f'Creating tracking database {name} from {xlsx}')
+    import_tracking_xlsx(name, xlsx)
+    return True
 
+def tracking_exists(name:str)->bool:
+    """
+    Check if the tracking file exists. A tracking database is created from the spreadsheet of an earlier version
+    here, the first time it is needed
+    """
+    migrate_tracking(name)
+    return os.path.exists(name)
+
+def load_tracking(name:str=DEFAULT_TRACKING_FILE)->pd.DataFrame:
+    """
+    Load the tracking data into memory from file
+    From a database, the index of each row is its id, and the rows are in the order that save_tracking writes them to a spreadsheet
+    """
+    migrate_tracking(name)
     if not os.path.exists(name):
         raise AKGException(f'Tracking file {name} does not exist')
 
-    with pd.ExcelFile(name) as xls:
-        df = pd.read_excel(xls, "akg tracking", keep_default_na=False)  
+    if is_tracking_db(name):
+        with _connect_tracking(name) as con:
+            df = pd.read_sql_query(f'SELECT * FROM {TRACKING_TABLE} ORDER BY step, pmid, file, id', con, index_col='id')
+            exported = con.execute(f"SELECT value FROM {TRACKING_TABLE}_info WHERE key = 'xlsx_mtime'").fetchone()
+        con.close()
+        df.index.name = None
+        if exported is not None and exported[0] != _xlsx_mtime(name):
+            logging.warning(f'{tracking_xlsx_name(name)} has changed since it was exported from {name}: '
+                            f'if it has been edited, import it with tracking.py --import-xlsx')
+    else:
+        with pd.ExcelFile(name) as xls:
+            df = pd.read_excel(xls, TRACKING_SHEET, keep_default_na=False)  
+    for journal in glob.glob(glob.escape(name) + '*' + TRACKING_JOURNAL_EXTENSION):
+        logging.warning(f'{name} has changes from an interrupted run in {journal}, not included here: '
+                        f'they are saved by the next run of the same program on it')
+
+    # tracking files written by earlier versions may not have all the columns
+    for col in tracking_col_names:
+        if col not in df.columns:
+            df[col] = {'int': 0, 'bool': False}.get(tracking_col_names[col], '')
 
     # I'm sure there's a better way:
     df['step'] = df['step'].astype('int')
@@ -116,25 +406,411 @@ def load_tracking(name:str='akg_tracking.xlsx')->pd.DataFrame:
     df['matched'] = df['matched'].astype('int')
     df['unmatched'] = df['unmatched'].astype('int')
     df['suitable'] = df['suitable'].astype('bool')
+    for col, dt in tracking_col_names.items():
+        if dt == 'str' and col != 'pmid':
+            df[col] = df[col].fillna('').astype(str)
 
     return df
 
-def save_tracking(df:pd.DataFrame, name:str='akg_tracking.xlsx'):
+def save_tracking(df:pd.DataFrame, name:str=DEFAULT_TRACKING_FILE):
     """
     Save the tracking data to file
+    A database is replaced by the rows of df, each with its index as the id. A spreadsheet is sorted first.
     """
+    if is_tracking_db(name):
+        with _connect_tracking(name) as con:
+            con.execute(f'DELETE FROM {TRACKING_TABLE}')
+            _write_tracking_rows(con, df)
+        con.close()
+        return
+
     # sort the data first
     sorted_df = df.sort_values(by=['step','pmid','file'])
 
     with pd.ExcelWriter(name) as writer:
-        sorted_df.to_excel(writer,index=False,sheet_name='akg tracking', )  
+        sorted_df.to_excel(writer,index=False,sheet_name=TRACKING_SHEET, )  
+
+def update_tracking(df:pd.DataFrame, name:str, rows:list)->None:
+    """
+    Save just the given rows of the tracking data to file, added or changed since it was loaded
+    Parameters:
+        df:     the tracking data, as loaded by load_tracking and added to by add_to_tracking
+        name:   the tracking file
+        rows:   the index of each row to save
+    A spreadsheet can only be written as a whole, so all of df is saved in that case.
+    """
+    if not is_tracking_db(name):
+        save_tracking(df, name)
+        return
+    with _connect_tracking(name) as con:
+        _write_tracking_rows(con, df.loc[list(rows)])
+    con.close()
+
+class Tracking:
+    """
+    The tracking data, loaded from the tracking file, for a program to read, change and add to.
+    New entries are held back and added to the data all at once, when it is next needed (see flush): each is given its
+    index straight away, so it can be found and changed before then. The data is indexed by step, pmid, source and
+    (path, file), so that selecting the rows for a step, or finding a file, doesn't scan the whole table.
+    save() writes out just the values that have been added or changed, if the tracking file is a database.
+    checkpoint() appends the changes since the last checkpoint to the journal, which is much cheaper than saving, so it
+    can be done after each file: if the program stops before save(), the next Tracking for this file replays them.
+    A new row's index is negative until it is saved, when it is given the next id in the database, so rows added by
+    programs running at the same time never share an id.
+
+    Example:
+        tracking = Tracking(tracking_file, step=2)
+        for index, row in tracking.entries(2, excluded=False):
+            tracking.add(tracking_record(3, row['path'], row['pmid'], 'clean_' + row['file'], ...))
+            tracking.set(index, cleaned=True)
+            tracking.checkpoint()
+        tracking.save()
+    """
+    # the columns (or pairs of columns) that are indexed
+    INDEXED = ('step', 'pmid', 'source', ('path', 'file'))
+    INDEXED_COLUMNS = {'step', 'pmid', 'source', 'path', 'file'}
+
+    def __init__(self, name:str=DEFAULT_TRACKING_FILE, df:pd.DataFrame|None=None, step:int|None=None):
+        """
+        Load the tracking data from the tracking file 'name', or start from df (to be written to 'name' in full)
+        If the program works through the rows for a step, give it, to take ownership of them (see claim_tracking)
+        until release() or the program ends.
+        """
+        self.name = name
+        self.step = step
+        self._claim = claim_tracking(name, step) if step is not None else None
+        self._df = load_tracking(name) if df is None else df
+        self._pending = {}
+        self._indexes = {}
+        self._next = -1
+        # the columns changed in each row since the last save, and the new rows, not in the tracking file yet
+        self._dirty = {}
+        self._new = set()
+        self._replace = df is not None
+        # the changes to each row since the last checkpoint
+        self._changes = {}
+        self.journal = tracking_journal_name(name, step)
+        if df is None and os.path.exists(self.journal):
+            self.replay()
+
+    def release(self):
+        """
+        Give up ownership of the rows for the step
+        """
+        if self._claim is not None:
+            self._claim.close()
+            self._claim = None
+
+    def __len__(self):
+        return len(self._df) + len(self._pending)
+
+    @property
+    def df(self)->pd.DataFrame:
+        """
+        All the tracking data, including any new entries
+        """
+        self.flush()
+        return self._df
+
+    def add(self, entries:dict|list[dict]|pd.DataFrame)->list[int]:
+        """
+        Add new entries: a tracking_record, a list of them, or a DataFrame with the tracking columns (such as a tracking_entry)
+        Returns:
+            the index of each new entry
+        """
+        if isinstance(entries, pd.DataFrame):
+            entries = entries.to_dict('records')
+        elif isinstance(entries, dict):
+            entries = [entries]
+        added = []
+        for entry in entries:
+            self._pending[self._next] = dict(entry)
+            self._changes[self._next] = dict(entry)
+            added.append(self._next)
+            self._next -= 1
+        self._new.update(added)
+        return added
+
+    def flush(self):
+        """
+        Add the new entries to the data, all at once
+        """
+        if not self._pending:
+            return
+        new = pd.DataFrame.from_records(list(self._pending.values()), index=list(self._pending), columns=list(tracking_col_names))
+        self._df = new if len(self._df) == 0 else pd.concat([self._df, new])
+        self._pending = {}
+        self._indexes = {}
+
+    def _index(self, key:str|tuple)->dict:
+        if key not in self._indexes:
+            cols = list(key) if isinstance(key, tuple) else key
+            self._indexes[key] = self._df.groupby(cols, sort=False).groups if len(self._df) else {}
+        return self._indexes[key]
+
+    def _select(self, key:str|tuple, value, excluded:bool|None=None)->pd.DataFrame:
+        self.flush()
+        rows = self._df.loc[self._index(key).get(value, [])]
+        if excluded is not None:
+            rows = rows[rows['excl'] == excluded]
+        return rows
+
+    def rows_for_step(self, step:int, excluded:bool|None=None)->pd.DataFrame:
+        """
+        The rows for a step, in the order of the tracking data: all of them, or only those excluded (or not) if given
+        """
+        return self._select('step', step, excluded)
+
+    def rows_for_pmid(self, pmid:int|str, excluded:bool|None=None)->pd.DataFrame:
+        return self._select('pmid', int(pmid), excluded)
+
+    def rows_from_source(self, source:str, excluded:bool|None=None)->pd.DataFrame:
+        """
+        The rows for the files derived from the file 'source' (a full path)
+        """
+        return self._select('source', source, excluded)
+
+    def rows_for_file(self, path:str, filename:str)->pd.DataFrame:
+        """
+        The rows for a file, at any step
+        """
+        return self._select(('path', 'file'), (path, filename))
+
+    def entries(self, step:int, excluded:bool|None=None):
+        """
+        Iterate over the rows for a step, as for rows_for_step, giving the index and a dict of the values for each
+        """
+        rows = self.rows_for_step(step, excluded)
+        return zip(rows.index, rows.to_dict('records'))
+
+    def find(self, step:int, path:str, filename:str)->int|None:
+        """
+        Find the row for a file, as find_tracking_entry does, including the new entries
+        Returns:
+            the index of the first row with this step, path and file name, or None if there isn't one
+        """
+        for index in self._index(('path', 'file')).get((path, filename), []):
+            if self._df.loc[index, 'step'] == step:
+                return index
+        for index, entry in self._pending.items():
+            if entry['step'] == step and entry['path'] == path and entry['file'] == filename:
+                return index
+        return None
+
+    def get(self, index:int, column:str):
+        """
+        One value from a row
+        """
+        if index in self._pending:
+            return self._pending[index][column]
+        return self._df.loc[index, column]
+
+    def set(self, index:int, **values):
+        """
+        Change values in a row, e.g. tracking.set(index, excl=True)
+        """
+        self._changes.setdefault(index, {}).update(values)
+        if index in self._pending:
+            self._pending[index].update(values)
+        else:
+            for column, value in values.items():
+                self._df.loc[index, column] = value
+            if self.INDEXED_COLUMNS & values.keys():
+                self._indexes = {}
+        if index not in self._new:
+            self._dirty.setdefault(index, set()).update(values)
+
+    def _rows(self, indexes:list[int])->pd.DataFrame:
+        """
+        The given rows, whether new or not, without adding the new entries to the data
+        """
+        new = [index for index in indexes if index in self._pending]
+        rows = self._df.loc[[index for index in indexes if index not in self._pending]]
+        if new:
+            new_rows = pd.DataFrame.from_records([self._pending[index] for index in new], index=new, columns=list(tracking_col_names))
+            rows = new_rows if len(rows) == 0 else pd.concat([rows, new_rows])
+        return rows
+
+    def checkpoint(self):
+        """
+        Append the rows added, and the values changed, since the last checkpoint to the journal, one JSON line for each row
+        """
+        if not self._changes:
+            return
+        with open(self.journal, 'a', encoding='utf-8') as f:
+            for index, values in self._changes.items():
+                # a row added since the last save, whether or not it has been flushed into the data yet
+                f.write(json.dumps({'index': int(index), 'new': index in self._new, 'values': values}, default=_json_value) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._changes = {}
+
+    def replay(self):
+        """
+        Make the changes recorded in the journal, left by a run that didn't save them
+        A line cut short by the run stopping part way through writing it is ignored.
+        """
+        replayed = 0
+        with open(self.journal, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    change = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f'Ignoring an incomplete change at the end of {self.journal}')
+                    continue
+                index = change['index']
+                if change['new'] and index not in self._pending and index not in self._df.index:
+                    # a new row keeps its index, which later changes refer to
+                    self._pending[index] = change['values']
+                    self._new.add(index)
+                    self._next = min(self._next, index - 1)
+                elif index in self._pending or index in self._df.index:
+                    self.set(index, **change['values'])
+                else:
+                    logging.warning(f'Ignoring a change in {self.journal} to row {index}, which is not in {self.name}')
+                    continue
+                replayed += 1
+        # these are already in the journal
+        self._changes = {}
+        logging.info(f'Replayed {replayed} changes to the tracking data from {self.journal}')
+
+    def _relabel(self, ids:dict):
+        """
+        Give the new rows their ids in the tracking file
+        """
+        self._pending = {ids.get(index, index): entry for index, entry in self._pending.items()}
+        if len(self._df) and self._df.index.min() < 0:
+            self._df = self._df.rename(index=ids)
+        self._indexes = {}
+
+    def _save_changes(self):
+        """
+        Write the changed values, and the new rows, to the tracking database, leaving the rest of each row as it is there
+        """
+        ids = {}
+        with _connect_tracking(self.name) as con:
+            for index, columns in self._dirty.items():
+                columns = sorted(columns)
+                assignments = ', '.join(f'"{col}" = ?' for col in columns)
+                values = [_plain_value(self.get(index, col)) for col in columns]
+                con.execute(f'UPDATE {TRACKING_TABLE} SET {assignments} WHERE id = ?', values + [int(index)])
+            if self._new:
+                # in the order they were added
+                rows = self._rows(sorted(self._new, reverse=True))
+                columns = ', '.join(f'"{col}"' for col in tracking_col_names)
+                placeholders = ', '.join('?' * len(tracking_col_names))
+                for row in _tracking_rows(rows):
+                    ids[row[0]] = con.execute(f'INSERT INTO {TRACKING_TABLE} ({columns}) VALUES ({placeholders})', row[1:]).lastrowid
+        con.close()
+        self._relabel(ids)
+
+    def _save_all(self):
+        """
+        Write all the tracking data to the tracking file, numbering the new rows after the others
+        """
+        if self._new:
+            first = int(max(self._df.index.max(), -1)) + 1 if len(self._df) else 0
+            self._relabel({index: first + n for n, index in enumerate(sorted(self._new, reverse=True))})
+        save_tracking(self.df, self.name)
+
+    def save(self):
+        """
+        Write the tracking data to the tracking file, taking turns with any other program writing to it: to a database,
+        just the values added or changed since the last save, otherwise all of it. 
+        The journal is no longer needed once this is done.
+        """
+        with tracking_lock(self.name):
+            if is_tracking_db(self.name) and os.path.exists(self.name) and not self._replace:
+                self._save_changes()
+            else:
+                self._save_all()
+        self._dirty = {}
+        self._new = set()
+        self._replace = False
+        self._changes = {}
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+
+def _plain_value(value):
+    """
+    The plain python value of a numpy value, for the database
+    """
+    return value.item() if hasattr(value, 'item') else value
+
+def _json_value(value):
+    """
+    The plain python value of a numpy value, for the journal
+    """
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'{type(value)} cannot be written to the tracking journal')
+
+def export_tracking_xlsx(name:str, xlsx:str=''):
+    """
+    Write the tracking database out as a spreadsheet, for viewing and editing by hand
+    """
+    xlsx = xlsx or tracking_xlsx_name(name)
+    df = load_tracking(name)
+    # keep the ids, so that the edited rows can be matched up when they are imported
+    save_tracking(df.rename_axis('id').reset_index(), xlsx)
+    with _connect_tracking(name) as con:
+        _record_xlsx(con, name)
+    con.close()
+    logging.info(f'Tracking data from {name} exported to {xlsx}')
+
+def import_tracking_xlsx(name:str, xlsx:str=''):
+    """
+    Replace the tracking database with the content of the spreadsheet, such as one exported and edited by hand
+    Rows with an id keep it, and any rows added in the spreadsheet are given new ones.
+    """
+    xlsx = xlsx or tracking_xlsx_name(name)
+    df = load_tracking(xlsx)
+    if 'id' in df.columns:
+        ids = pd.to_numeric(df['id'], errors='coerce')
+        if ids.notna().all() and ids.is_unique:
+            df = df.set_axis(ids.astype(int))
+        else:
+            # ids missing or repeated (rows added or copied by hand) - number everything again
+            df = df.reset_index(drop=True)
+        df = df.drop(columns=['id'])
+    save_tracking(df, name)
+    with _connect_tracking(name) as con:
+        _record_xlsx(con, name)
+    con.close()
+    logging.info(f'Tracking data imported to {name} from {xlsx}')
 
 
 if __name__ == "__main__":
-    supp_path = os.path.join('data','supp_data')
-    create_tracking(supp_path)
-    # df = load_tracking()
-    # print(df)
+    command_line_str = ' '.join(sys.argv)
+    parser = argparse.ArgumentParser(description='Create the tracking file or add new downloads to it, or export it to a spreadsheet for editing and import the edits')
+    parser.add_argument('-i','--input_dir', default='data', help='Top-level data directory, holding the tracking file')
+    parser.add_argument('-t','--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file is in the top-level directory.')
+    parser.add_argument('-x','--export-xlsx', nargs='?', const='', default=None, help="Write the tracking data to a spreadsheet, by default with the tracking file's name ending .xlsx")
+    parser.add_argument('-m','--import-xlsx', nargs='?', const='', default=None, help="Replace the tracking data with the content of the spreadsheet, by default the one written by --export-xlsx")
+    parser.add_argument('-l','--log', default='tracking.log', help='Log file name. This file is created in the top-level directory.')
+    config = vars(parser.parse_args())
+
+    main_dir = config['input_dir']
+    if not os.path.isdir(main_dir):
+        raise AKGException(f"tracking: data directory {main_dir} must exist")
+    akg_logging_config(os.path.join(main_dir, config['log']))
+    logging.info(f"Program executed with command: {command_line_str}")
+
+    tracking_file = os.path.join(main_dir, config['tracking_file'])
+    if config['import_xlsx'] is not None:
+        if not is_tracking_db(tracking_file):
+            raise AKGException(f"tracking: {tracking_file} must be a database ({', '.join(TRACKING_DB_EXTENSIONS)}) to import a spreadsheet")
+        xlsx = os.path.join(main_dir, config['import_xlsx']) if config['import_xlsx'] else ''
+        import_tracking_xlsx(tracking_file, xlsx)
+    elif config['export_xlsx'] is not None:
+        if not is_tracking_db(tracking_file):
+            raise AKGException(f"tracking: {tracking_file} must be a database ({', '.join(TRACKING_DB_EXTENSIONS)}) to export a spreadsheet")
+        xlsx = os.path.join(main_dir, config['export_xlsx']) if config['export_xlsx'] else ''
+        export_tracking_xlsx(tracking_file, xlsx)
+    elif tracking_exists(tracking_file):
+        update_tracking_downloads(os.path.join(main_dir, 'supp_data'), tracking_file)
+    else:
+        create_tracking(os.path.join(main_dir, 'supp_data'), tracking_file)
 
 def test_create_tracking():
     """
@@ -179,4 +855,209 @@ def test_tracking_to_df():
         # it should be a csv file that we can read into pandas
         df = load_tracking(track_file)
 
-        print(df)
\ No newline at end of file
+        print(df)
+def test_load_tracking_missing_columns():
+    """
+    A tracking file from an earlier version, without the newer columns, loads with default values in them
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        track_file = os.path.join(scratch_dir, "testtrack.xlsx")
+        df = tracking_entry(3, scratch_dir, '12345678', 'clean_expdata_a.csv', False, True, 'src', False, False, '', 0, 'padj', 'gene', 'lfc', '', 0, 0, False, '')
+        save_tracking(df.drop(columns=['graphhash']), track_file)
+
+        df = load_tracking(track_file)
+        assert list(df['graphhash']) == ['']
+        assert find_tracking_entry(df, 3, scratch_dir, 'clean_expdata_a.csv') == 0
+        assert find_tracking_entry(df, 4, scratch_dir, 'clean_expdata_a.csv') is None
+
+def test_tracking_db():
+    """
+    The tracking data survives a round trip through the database, a row at a time, and through an exported spreadsheet
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        track_file = os.path.join(scratch_dir, "testtrack.db")
+        df = create_empty_tracking_store()
+        for pmid, filename in (('22222222', 'b.csv'), ('11111111', 'a.csv')):
+            df = add_to_tracking(df, tracking_entry(3, scratch_dir, pmid, filename, False, True, 'src', True, False, '', 0, 'padj', 'gene', 'lfc', '', 0, 0, False, ''))
+        save_tracking(df, track_file)
+
+        df = load_tracking(track_file)
+        # in the order of the spreadsheet, but each row keeps its id
+        assert list(df['file']) == ['a.csv', 'b.csv']
+        assert list(df.index) == [1, 0]
+        df.loc[1, 'graphhash'] = 'abc'
+        df = add_to_tracking(df, tracking_entry(4, scratch_dir, '11111111', 'graph_a.nt', False, True, 'a.csv', False, False, '', 0, '', '', '', 'graph_a.nt', 5, 2, False, ''))
+        update_tracking(df, track_file, [1, 2])
+        df = load_tracking(track_file)
+        assert df.loc[1, 'graphhash'] == 'abc'
+        assert df.loc[2, 'matched'] == 5 and df.loc[2, 'pmid'] == 11111111 and not df.loc[2, 'excl']
+
+        # edit the exported spreadsheet and import it again
+        export_tracking_xlsx(track_file)
+        xlsx = tracking_xlsx_name(track_file)
+        edited = load_tracking(xlsx)
+        edited.loc[edited['file'] == 'b.csv', 'excl'] = True
+        save_tracking(edited, xlsx)
+        import_tracking_xlsx(track_file)
+        df = load_tracking(track_file)
+        assert df.loc[0, 'excl'] and not df.loc[1, 'excl']
+        assert len(df) == 3
+
+def test_migrate_tracking():
+    """
+    A tracking database is created from the spreadsheet of an earlier version
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        xlsx = os.path.join(scratch_dir, "testtrack.xlsx")
+        save_tracking(tracking_entry(0, scratch_dir, '12345678', 'a.xlsx', False, False, '', False, False, '', 0, '', '', '', '', 0, 0, False, ''), xlsx)
+        track_file = os.path.join(scratch_dir, "testtrack.db")
+        assert tracking_exists(track_file)
+        assert list(load_tracking(track_file)['file']) == ['a.xlsx']
+
+def test_tracking_class():
+    """
+    New entries can be found and changed before they are added to the data, and the selectors agree with a scan of the table
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        track_file = os.path.join(scratch_dir, "testtrack.db")
+        tracking = Tracking(track_file, create_empty_tracking_store())
+        for pmid in ('11111111', '22222222'):
+            for step in range(3):
+                tracking.add(tracking_record(step, scratch_dir, pmid, f'file{step}.csv', step == 1, step > 0, 'src.xlsx', False, False, '', 0, '', '', '', '', 0, 0, False, ''))
+        new = tracking.add(tracking_record(4, scratch_dir, '11111111', 'graph.nt', False, True, 'src.xlsx', False, False, '', 0, '', '', '', '', 0, 0, False, ''))[0]
+        assert tracking.find(4, scratch_dir, 'graph.nt') == new
+        tracking.set(new, matched=3)
+        assert tracking.get(new, 'matched') == 3
+        tracking.save()
+
+        tracking = Tracking(track_file)
+        df = tracking.df
+        assert len(tracking) == 7
+        assert list(tracking.rows_for_step(1).index) == list(df.index[df['step'] == 1])
+        assert list(tracking.rows_for_step(1, excluded=False).index) == []
+        assert len(tracking.rows_for_step(2, excluded=False)) == 2
+        assert len(tracking.rows_for_pmid('22222222')) == 3
+        assert len(tracking.rows_from_source('src.xlsx')) == 7
+        index = tracking.find(4, scratch_dir, 'graph.nt')
+        assert tracking.get(index, 'matched') == 3
+        # changing an indexed column is seen by the selectors
+        tracking.set(index, step=5)
+        assert tracking.find(4, scratch_dir, 'graph.nt') is None
+        assert list(tracking.rows_for_step(5).index) == [index]
+        tracking.save()
+        assert list(Tracking(track_file).rows_for_step(5)['file']) == ['graph.nt']
+
+def test_tracking_journal():
+    """
+    Changes checkpointed to the journal, but not saved, are replayed by the next Tracking, and saving removes the journal
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        track_file = os.path.join(scratch_dir, "testtrack.db")
+        tracking = Tracking(track_file, create_empty_tracking_store())
+        tracking.add(tracking_record(3, scratch_dir, '11111111', 'clean_a.csv', False, True, 'a.csv', False, False, '', 0, '', '', '', '', 0, 0, False, ''))
+        tracking.save()
+        # saving gives the new row its id in the database
+        source = tracking.find(3, scratch_dir, 'clean_a.csv')
+        assert source >= 0
+
+        # an interrupted run: two files done and checkpointed, the last one cut short while writing its change
+        tracking = Tracking(track_file)
+        tracking.set(source, graphfile='graph_clean_a.csv.nt', matched=3)
+        graph = tracking.add(tracking_record(4, scratch_dir, '11111111', 'graph_clean_a.csv.nt', False, True, 'clean_a.csv', False, False, '', 0, '', '', '', '', 0, 0, False, ''))[0]
+        tracking.checkpoint()
+        tracking.set(graph, matched=5)
+        tracking.checkpoint()
+        # a new row flushed into the data by a selector before its checkpoint is still new
+        flushed = tracking.add(tracking_record(3, scratch_dir, '11111111', 'clean_b.csv', False, True, 'b.csv', False, False, '', 0, '', '', '', '', 0, 0, False, ''))[0]
+        assert len(tracking.rows_for_step(3)) == 2
+        tracking.checkpoint()
+        with open(tracking_journal_name(track_file), 'a') as f:
+            f.write('{"index": 0, "new": fal')
+        assert list(load_tracking(track_file)['step']) == [3]
+
+        tracking = Tracking(track_file)
+        assert tracking.get(source, 'matched') == 3
+        assert tracking.find(4, scratch_dir, 'graph_clean_a.csv.nt') == graph
+        assert tracking.get(graph, 'matched') == 5
+        assert tracking.find(3, scratch_dir, 'clean_b.csv') == flushed
+        # the next new row doesn't take the index of a replayed one
+        assert tracking.add(tracking_record(0, scratch_dir, '11111111', 'b.csv', False, False, '', False, False, '', 0, '', '', '', '', 0, 0, False, ''))[0] == flushed - 1
+        tracking.save()
+        assert not os.path.exists(tracking_journal_name(track_file))
+        df = load_tracking(track_file)
+        assert sorted(df['step']) == [0, 3, 3, 4]
+        assert sorted(df['matched']) == [0, 0, 3, 5]
+
+def test_update_tracking_downloads():
+    """
+    Only new downloads, and changed ones that have been processed, are added, and the existing rows are left as they are
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        supp_data = os.path.join(scratch_dir, 'supp_data')
+        first = os.path.join(supp_data, '11111111')
+        os.makedirs(first)
+        for file in ('a.xlsx', 'b.csv'):
+            with open(os.path.join(first, file), 'w') as f:
+                f.write('x')
+        track_file = os.path.join(scratch_dir, 'testtrack.db')
+        create_tracking(supp_data, track_file)
+        assert sorted(load_tracking(track_file)['file']) == ['a.xlsx', 'b.csv']
+
+        # data_split has processed a.xlsx, and written a derived file alongside it
+        tracking = Tracking(track_file)
+        a = tracking.find(0, first, 'a.xlsx')
+        tracking.set(a, excl=True)
+        tracking.add(tracking_record(1, first, '11111111', 'split_a.csv', False, True, os.path.join(first, 'a.xlsx'), False, False, '', 0, '', '', '', '', 0, 0, False, ''))
+        tracking.save()
+        with open(os.path.join(first, 'split_a.csv'), 'w') as f:
+            f.write('x')
+        assert update_tracking_downloads(supp_data, track_file) == 0
+
+        # a new paper, and a changed download
+        second = os.path.join(supp_data, '22222222')
+        os.makedirs(second)
+        with open(os.path.join(second, 'c.xlsx'), 'w') as f:
+            f.write('x')
+        with open(os.path.join(first, 'a.xlsx'), 'w') as f:
+            f.write('changed')
+        assert update_tracking_downloads(supp_data, track_file) == 2
+        df = load_tracking(track_file)
+        step_0 = df[df['step'] == 0]
+        assert sorted(step_0['file']) == ['a.xlsx', 'a.xlsx', 'b.csv', 'c.xlsx']
+        assert list(step_0[step_0['file'] == 'a.xlsx']['excl']) == [True, False]
+        assert list(df[df['step'] == 0]['pmid'].unique()) == [11111111, 22222222]
+        assert update_tracking_downloads(supp_data, track_file) == 0
+
+def test_tracking_concurrent():
+    """
+    Two programs working on the same tracking database keep each other's changes, and only one at a time can own a step
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as scratch_dir:
+        track_file = os.path.join(scratch_dir, "testtrack.db")
+        tracking = Tracking(track_file, create_empty_tracking_store())
+        tracking.add([tracking_record(step, scratch_dir, '11111111', f'file{step}.csv', False, step > 0, '', False, False, '', 0, '', '', '', '', 0, 0, False, '') for step in (1, 3)])
+        tracking.save()
+
+        convert = Tracking(track_file, step=1)
+        triples = Tracking(track_file, step=3)
+        try:
+            Tracking(track_file, step=3)
+            assert False, 'step 3 is owned already'
+        except AKGException:
+            pass
+        # each changes a different column of the same row, and adds a row
+        both = convert.find(3, scratch_dir, 'file3.csv')
+        convert.set(both, lfc='log2fc')
+        convert.add(tracking_record(2, scratch_dir, '11111111', 'expdata_1.csv', False, True, 'file1.csv', False, False, '', 0, '', '', '', '', 0, 0, False, ''))
+        triples.set(both, matched=7)
+        triples.add(tracking_record(4, scratch_dir, '11111111', 'graph_file3.csv.nt', False, True, 'file3.csv', False, False, '', 0, '', '', '', '', 0, 0, False, ''))
+        triples.save()
+        convert.save()
+        triples.release()
+        Tracking(track_file, step=3).release()
+
+        df = load_tracking(track_file)
+        assert sorted(df['file']) == ['expdata_1.csv', 'file1.csv', 'file3.csv', 'graph_file3.csv.nt']
+        assert df.index.is_unique
+        row = df[df['file'] == 'file3.csv'].iloc[0]
+        assert (row['lfc'], row['matched']) == ('log2fc', 7)
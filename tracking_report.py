@@ -2,28 +2,208 @@
 # loads the tracking file and generates a report containing the contents of the AKG,
 # as described by the tracking file. Most useful here is the data for which PMIDs are in the graph,
 # which are not, and which tables are used by each PMID.
+# The report is written as text, and as JSON and HTML with the numbers of matched and unmatched genes for each PMID.
 import argparse
+import html
+import json
 import logging
 import os
+import tempfile
+from collections import Counter
 import pandas as pd
 from akg import AKGException, akg_logging_config
-from tracking import load_tracking
+from tracking import load_tracking, DEFAULT_TRACKING_FILE, tracking_exists, create_empty_tracking_store, tracking_record
 import sys
 
+# the last step in the lineage of a downloaded file, the graph files
+LAST_STEP = 4
+
+# for each level of the lineage below the downloaded files, the text report's heading for the files derived from a file,
+# and its note when there are none
+lineage_text = {1: ("\nSplit files derived from {}:\n", "\nNo split files found for downloaded file {}\n"),
+                2: ("\tData convert files derived from {}:\n", "\tNo data_convert files found for split file {}\n"),
+                3: ("\t\tCSV data cleaning files derived from {}:\n", "\t\tNo csv_data_cleaning files found for data_convert file {}\n"),
+                4: ("\t\t\tRDF triples files derived from {}:\n", "\t\t\tNo create_rdf_triples files found for csv_data_cleaning file {}\n"),
+                }
+
+def lineage_index(rows:list[dict])->tuple[dict,dict,dict]:
+    """
+    The rows derived from each file, for each PMID, the downloaded files for each source PMID, and the graph files made 
+    from all of a PMID's data files together, made in one pass over the tracking data
+    Parameters:
+        rows:   the rows of the tracking data, as dicts
+    Returns:
+        a dict of (pmid, full name of the source file) to the positions of the rows with that source, in tracking data order
+        a dict of pmid to the positions of its downloaded (step 0) rows, in tracking data order
+        a dict of pmid to the positions of its per PMID graph rows (create_rdf_triples -p), in tracking data order
+    """
+    children = {}
+    downloaded = {}
+    pmid_graphs = {}
+    for position, row in enumerate(rows):
+        if row['step'] == LAST_STEP and row['source'] == row['path']:
+            # a per PMID graph, whose source is the PMID's directory rather than one of the files in it
+            pmid_graphs.setdefault(row['pmid'], []).append(position)
+            continue
+        children.setdefault((row['pmid'], row['source']), []).append(position)
+        if row['step'] == 0:
+            downloaded.setdefault(row['pmid'], []).append(position)
+    return children, downloaded, pmid_graphs
+
+def lineage_node(row:dict)->dict:
+    """
+    The report's entry for one row of the tracking data, without the files derived from it
+    """
+    return {'file': os.path.join(row['path'], row['file']), 'step': int(row['step']), 'excl': bool(row['excl']),
+            'matched': int(row['matched']), 'unmatched': int(row['unmatched']),
+            'pval': row['pval'], 'lfc': row['lfc'], 'gene': row['gene'], 'children': []}
+
+def unique_rows(rows:list[dict], positions:list[int], what:str)->list[dict]:
+    """
+    The rows at the positions, in order, leaving out (with a warning) a file name found in more than one
+    """
+    counts = Counter(rows[position]['file'] for position in positions)
+    found = []
+    for position in positions:
+        file = rows[position]['file']
+        if counts[file] != 1:
+            if counts[file] > 1:
+                logging.warning(f"Tracking file row for {what} file {file} not found or ambiguous")
+                counts[file] = 0
+            continue
+        found.append(rows[position])
+    return found
+
+def build_report(tdf:pd.DataFrame)->list[dict]:
+    """
+    The lineage of each source PMID's downloaded files, from step 0 through to the graph files, with the numbers of
+    matched and unmatched genes in its data files (as recorded for them by create_rdf_triples)
+    Each row of the tracking data is visited once.
+    A graph made from all of a PMID's data files together (create_rdf_triples -p) is listed under the PMID, in 'pmid_graphs'.
+    Returns:
+        a list, in tracking data order, of a dict for each source PMID
+    """
+    rows = tdf.to_dict('records')
+    children, downloaded, pmid_graphs = lineage_index(rows)
+    what = {1: 'split', 2: 'data_convert', 3: 'csv_data_cleaning', 4: 'create_rdf_triples'}
+
+    def add_children(node:dict, pmid, level:int):
+        for row in unique_rows(rows, children.get((pmid, node['file']), []), what[level]):
+            child = lineage_node(row)
+            node['children'].append(child)
+            if level < LAST_STEP:
+                add_children(child, pmid, level + 1)
+
+    report = []
+    for pmid, positions in downloaded.items():
+        entry = {'pmid': int(pmid), 'matched': 0, 'unmatched': 0, 'graph_files': 0, 'downloaded': [], 'pmid_graphs': []}
+        for row in unique_rows(rows, positions, 'downloaded'):
+            node = lineage_node(row)
+            add_children(node, pmid, 1)
+            entry['downloaded'].append(node)
+        entry['pmid_graphs'] = [lineage_node(row) for row in unique_rows(rows, pmid_graphs.get(pmid, []), what[LAST_STEP])]
+        report.append(entry)
+
+    # the gene counts are recorded against the data files: the graph files for a PMID may include the same genes again
+    totals = {entry['pmid']: entry for entry in report}
+    for row in rows:
+        entry = totals.get(int(row['pmid']))
+        if entry is None:
+            continue
+        if row['step'] == 3 and not row['excl']:
+            entry['matched'] += int(row['matched'])
+            entry['unmatched'] += int(row['unmatched'])
+        elif row['step'] == LAST_STEP:
+            entry['graph_files'] += 1
+    return report
+
+def write_text_children(rf, node:dict, level:int):
+    heading, none_found = lineage_text[level]
+    if len(node['children']) == 0:
+        rf.write(none_found.format(node['file']))
+        return
+    rf.write(heading.format(node['file']))
+    indent = '\t' * level
+    for child in node['children']:
+        rf.write(f"{indent}{child['file']}\n")
+        if level == LAST_STEP:
+            rf.write(f"{indent}\tcolumn names: PVAL: '{child['pval']}', LFC: '{child['lfc']}', GENE: '{child['gene']}'\n")
+    if level < LAST_STEP:
+        for child in node['children']:
+            write_text_children(rf, child, level + 1)
+
+def write_text_report(report:list[dict], tracking_file:str, report_file:str):
+    with open(report_file, 'w', encoding='utf-8-sig') as rf:
+        rf.write(f"Tracking report generated from tracking file {tracking_file}\n")
+        rf.write(f"Number of source PMIDs (step=0): {len(report)}\n")
+        rf.write("Source PMIDs (step=0):\n")
+        for entry in report:
+            rf.write(f"{entry['pmid']}\n")
+
+        # the files with step=0 are the downloaded files, the first ones in the process
+        for entry in report:
+            rf.write(f"\nPMID: {entry['pmid']} downloaded files:\n")
+            for node in entry['downloaded']:
+                rf.write(f"\t{node['file']}\n")
+            for node in entry['downloaded']:
+                write_text_children(rf, node, 1)
+            if entry['pmid_graphs']:
+                rf.write(f"\nRDF triples files derived from all the data files of PMID {entry['pmid']}:\n")
+                for node in entry['pmid_graphs']:
+                    rf.write(f"\t{node['file']}\n")
+
+def write_json_report(report:list[dict], tracking_file:str, report_file:str):
+    # not indented: the encoder is much faster without, for a large tracking file
+    with open(report_file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'tracking_file': tracking_file, 'pmids': report}))
+
+def html_lineage(node:dict)->str:
+    """
+    A file and those derived from it, as a nested HTML list item
+    """
+    item = html.escape(node['file'])
+    if node['excl']:
+        item += ' (excluded)'
+    if node['step'] == LAST_STEP:
+        item += html.escape(f" column names: PVAL: '{node['pval']}', LFC: '{node['lfc']}', GENE: '{node['gene']}'")
+    if node['children']:
+        item += '<ul>' + ''.join(html_lineage(child) for child in node['children']) + '</ul>'
+    return f'<li>{item}</li>'
+
+def write_html_report(report:list[dict], tracking_file:str, report_file:str):
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>AKG tracking report</title></head><body>',
+             f'<h1>Tracking report</h1><p>Generated from tracking file {html.escape(tracking_file)}</p>',
+             f'<p>Number of source PMIDs (step=0): {len(report)}</p>',
+             '<table border="1"><tr><th>PMID</th><th>Downloaded files</th><th>Graph files</th><th>Matched genes</th><th>Unmatched genes</th></tr>']
+    for entry in report:
+        lines.append(f'<tr><td><a href="#{entry["pmid"]}">{entry["pmid"]}</a></td><td>{len(entry["downloaded"])}</td>'
+                     f'<td>{entry["graph_files"]}</td><td>{entry["matched"]}</td><td>{entry["unmatched"]}</td></tr>')
+    lines.append('</table>')
+    for entry in report:
+        lines.append(f'<h2 id="{entry["pmid"]}">PMID: {entry["pmid"]}</h2>')
+        lines.append('<ul>' + ''.join(html_lineage(node) for node in entry['downloaded']) + '</ul>')
+        if entry['pmid_graphs']:
+            lines.append('<p>RDF triples files derived from all the data files:</p><ul>' + 
+                         ''.join(f"<li>{html.escape(node['file'])}</li>" for node in entry['pmid_graphs']) + '</ul>')
+    lines.append('</body></html>')
+    with open(report_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
 def main():
     command_line_str = ' '.join(sys.argv)
     parser = argparse.ArgumentParser(description="Generate a report from the tracking file")
     # manage the command line options
     parser.add_argument('-i','--input_dir', default='data', help='Destination top-level directory for input data files (output files also written here)')
-    parser.add_argument('-t','--tracking_file', default='akg_tracking.xlsx', help='Tracking file name. This file is created in the top-level directory.')
+    parser.add_argument('-t','--tracking_file', default=DEFAULT_TRACKING_FILE, help='Tracking file name. This file is created in the top-level directory.')
     parser.add_argument('-m','--metadata', action='store_true', help="Process the article metadata file (default is to skip this step)")
     parser.add_argument('-l','--log', default='tracking_report.log', help='Log file name. This file is created in the top-level directory.')
-    parser.add_argument('-r','--report_file', default='tracking_report.txt', help='Report file name. This file is created in the top-level directory.')
+    parser.add_argument('-r','--report_file', default='tracking_report.txt', help='Report file name. This file is created in the top-level directory, '
+                        'with the JSON and HTML versions alongside it (tracking_report.json and tracking_report.html by default).')
     config = vars(parser.parse_args())
 
     metadata = config['metadata']
 
-    main_dir = config['input_dir']  
+    main_dir = config['input_dir']
 
     if not os.path.isdir(main_dir):
         raise AKGException(f"tracking_report: data directory {main_dir} must exist")
@@ -34,123 +214,65 @@ def main():
 
     tracking_file = config['tracking_file']
     tracking_file = os.path.join(main_dir, tracking_file)
-    if not os.path.isfile(tracking_file):
+    if not tracking_exists(tracking_file):
         raise AKGException(f"tracking_report: tracking file {tracking_file} must exist")
     logging.info(f"Loading tracking file {tracking_file}")
     tdf = load_tracking(tracking_file)
     logging.info(f"Tracking file loaded")
 
-# the pmids with step=0 are the source publications
-
-# print out the pmids with step=0
-    logging.info(f"Number of source PMIDs (step=0): {len(tdf[tdf['step']== 0]['pmid'].unique())}")
-    if len(tdf[tdf['step']== 0]) == 0:
+    # the pmids with step=0 are the source publications
+    report = build_report(tdf)
+    logging.info(f"Number of source PMIDs (step=0): {len(report)}")
+    if len(report) == 0:
         logging.warning(f"No source PMIDs found in tracking file")
         return
-    
-# open the report file
-    report_file = config['report_file'] 
-    report_file = os.path.join(main_dir, report_file)
-    with open(report_file, 'w', encoding='utf-8-sig') as rf:
-        rf.write(f"Tracking report generated from tracking file {tracking_file}\n")
-        rf.write(f"Number of source PMIDs (step=0): {len(tdf[tdf['step']== 0]['pmid'].unique())}\n")
-        rf.write("Source PMIDs (step=0):\n")
-        for pmid in tdf[tdf['step']== 0]['pmid'].unique():
-            rf.write(f"{pmid}\n")
-
-    # the files with step=0 are the downloaded files, the first ones in the process
-        for pmid in tdf[tdf['step']== 0]['pmid'].unique():
-            pmid_rows = tdf[tdf['pmid'] == pmid]
-            rf.write(f"\nPMID: {pmid} downloaded files:\n")
-            downloaded_files = pmid_rows[pmid_rows['step'] == 0]['file'].unique()
-
-            full_dofi_names = []
-            for dofi in downloaded_files:
-                # get the row of the tracking file for this downloaded file
-                trow = pmid_rows[(pmid_rows['step'] == 0) & (pmid_rows['file'] == dofi)]
-                if len(trow) != 1:
-                    logging.warning(f"Tracking file row for downloaded file {dofi} not found or ambiguous")
-                    continue
-                dofi_path = trow.iloc[0]['path']
-                # construct the name for comparison with the filenames in the source column
-                full_dofi_name = os.path.join(dofi_path, dofi)
-                rf.write(f"\t{full_dofi_name}\n")
-                full_dofi_names.append(full_dofi_name)
-
-    # step 1: split
-            for full_dofi_name in full_dofi_names:
-                # find the rows for which this file is the source
-                split_source_rows = pmid_rows[pmid_rows['source'] == full_dofi_name]
-                if len(split_source_rows) == 0:
-                    rf.write(f"\nNo split files found for downloaded file {full_dofi_name}\n")
-                    continue
-                rf.write(f"\nSplit files derived from {full_dofi_name}:\n")
-                full_ssf_names = []
-                for ssf in split_source_rows['file'].unique():
-                    ssf_row = split_source_rows[split_source_rows['file'] == ssf]
-                    if len(ssf_row) != 1:
-                        logging.warning(f"Tracking file row for split file {ssf} not found or ambiguous")
-                        continue
-                    ssf_path = ssf_row.iloc[0]['path']
-                    full_ssf_name = os.path.join(ssf_path, ssf)
-                    rf.write(f"\t{full_ssf_name}\n")
-                    full_ssf_names.append(full_ssf_name)
-
-    # step 2: data_convert
-                for full_ssf_name in full_ssf_names:
-                    data_convert_source_rows = pmid_rows[pmid_rows['source'] == full_ssf_name]
-                    if len(data_convert_source_rows) == 0:
-                        rf.write(f"\tNo data_convert files found for split file {full_ssf_name}\n")
-                        continue
-                    rf.write(f"\tData convert files derived from {full_ssf_name}:\n")
-                    full_dcf_names = []
-                    for dcf in data_convert_source_rows['file'].unique():
-                        dcf_row = data_convert_source_rows[data_convert_source_rows['file'] == dcf]
-                        if len(dcf_row) != 1:
-                            logging.warning(f"Tracking file row for data_convert file {dcf} not found or ambiguous")
-                            continue
-                        dcf_path = dcf_row.iloc[0]['path']
-                        full_dcf_name = os.path.join(dcf_path, dcf)
-                        rf.write(f"\t\t{full_dcf_name}\n")
-                        full_dcf_names.append(full_dcf_name)
-
-    # step 3: csv_data_cleaning
-                    for full_dcf_name in full_dcf_names:
-                        csv_data_cleaning_source_rows = pmid_rows[pmid_rows['source'] == full_dcf_name]
-                        if len(csv_data_cleaning_source_rows) == 0:
-                            rf.write(f"\t\tNo csv_data_cleaning files found for data_convert file {full_dcf_name}\n")
-                            continue
-                        rf.write(f"\t\tCSV data cleaning files derived from {full_dcf_name}:\n")
-                        full_cdcf_names = []
-                        for cdcf in csv_data_cleaning_source_rows['file'].unique():
-                            cdcf_row = csv_data_cleaning_source_rows[csv_data_cleaning_source_rows['file'] == cdcf]
-                            if len(cdcf_row) != 1:
-                                logging.warning(f"Tracking file row for csv_data_cleaning file {cdcf} not found or ambiguous")
-                                continue
-                            cdcf_path = cdcf_row.iloc[0]['path']
-                            full_cdcf_name = os.path.join(cdcf_path, cdcf)
-                            rf.write(f"\t\t\t{full_cdcf_name}\n")
-                            full_cdcf_names.append(full_cdcf_name)
-
-    # step 4: create_rdf_triples
-                            for full_cdcf_name in full_cdcf_names:
-                                create_rdf_triples_source_rows = pmid_rows[pmid_rows['source'] == full_cdcf_name]
-                                if len(create_rdf_triples_source_rows) == 0:
-                                    rf.write(f"\t\t\tNo create_rdf_triples files found for csv_data_cleaning file {full_cdcf_name}\n")
-                                    continue
-                                rf.write(f"\t\t\tRDF triples files derived from {full_cdcf_name}:\n")
-                                for crtf in create_rdf_triples_source_rows['file'].unique():
-                                    crtf_row = create_rdf_triples_source_rows[create_rdf_triples_source_rows['file'] == crtf]
-                                    if len(crtf_row) != 1:
-                                        logging.warning(f"Tracking file row for create_rdf_triples file {crtf} not found or ambiguous")
-                                        continue
-                                    crtf_path = crtf_row.iloc[0]['path']
-                                    crtf_pval = crtf_row.iloc[0]['pval']
-                                    crtf_lfc = crtf_row.iloc[0]['lfc']
-                                    crtf_gene = crtf_row.iloc[0]['gene']
-                                    full_crtf_name = os.path.join(crtf_path, crtf)
-                                    rf.write(f"\t\t\t\t{full_crtf_name}\n")
-                                    rf.write(f"\t\t\t\t\tcolumn names: PVAL: '{crtf_pval}', LFC: '{crtf_lfc}', GENE: '{crtf_gene}'\n")
+
+    report_file = os.path.join(main_dir, config['report_file'])
+    report_stem = os.path.splitext(report_file)[0]
+    write_text_report(report, tracking_file, report_file)
+    write_json_report(report, tracking_file, report_stem + '.json')
+    write_html_report(report, tracking_file, report_stem + '.html')
+    logging.info(f"Report written to {report_file}, {report_stem}.json and {report_stem}.html")
+
+def test_build_report():
+    """
+    Each file appears once, under the file it was derived from, and the gene counts come from the data files
+    """
+    with tempfile.TemporaryDirectory(prefix="scratch_") as d:
+        def record(step, file, source, excl=False, matched=0, unmatched=0):
+            return tracking_record(step, d, '12345678', file, excl, step > 0, source, False, False, '', 0, 'p', 'g', 'l', '', matched, unmatched, False, '')
+        records = [record(0, 'a.xlsx', ''),
+                   record(1, 'split_s1.csv', os.path.join(d, 'a.xlsx')),
+                   record(1, 'split_s2.csv', os.path.join(d, 'a.xlsx')),
+                   record(2, 'expdata_s1.csv', os.path.join(d, 'split_s1.csv')),
+                   record(3, 'clean_expdata_s1.csv', os.path.join(d, 'expdata_s1.csv'), matched=5, unmatched=2),
+                   record(3, 'clean_old.csv', os.path.join(d, 'expdata_s1.csv'), excl=True, matched=7, unmatched=7),
+                   record(4, 'graph_clean_expdata_s1.csv.nt', os.path.join(d, 'clean_expdata_s1.csv')),
+                   # a per PMID graph, made from the PMID's directory
+                   record(4, 'graph_12345678.nt', d)]
+        tdf = pd.DataFrame.from_records(records, columns=list(create_empty_tracking_store().columns))
+        tdf['pmid'] = tdf['pmid'].astype('int')
+        report = build_report(tdf)
+        assert len(report) == 1
+        assert (report[0]['matched'], report[0]['unmatched'], report[0]['graph_files']) == (5, 2, 2)
+        assert [os.path.basename(n['file']) for n in report[0]['pmid_graphs']] == ['graph_12345678.nt']
+        a = report[0]['downloaded'][0]
+        assert [os.path.basename(n['file']) for n in a['children']] == ['split_s1.csv', 'split_s2.csv']
+        cleaned = a['children'][0]['children'][0]['children']
+        assert [os.path.basename(n['file']) for n in cleaned] == ['clean_expdata_s1.csv', 'clean_old.csv']
+        assert [os.path.basename(n['file']) for n in cleaned[0]['children']] == ['graph_clean_expdata_s1.csv.nt']
+
+        report_file = os.path.join(d, 'report.txt')
+        write_text_report(report, 'track.db', report_file)
+        with open(report_file, encoding='utf-8-sig') as f:
+            text = f.read()
+        assert text.count('graph_clean_expdata_s1.csv.nt') == 1
+        assert text.count('graph_12345678.nt') == 1
+        write_html_report(report, 'track.db', os.path.join(d, 'report.html'))
+        with open(os.path.join(d, 'report.html'), encoding='utf-8') as f:
+            assert f.read().count('graph_12345678.nt') == 1
+        assert f"No split files found" not in text
+        assert f"No data_convert files found for split file {os.path.join(d, 'split_s2.csv')}" in text
 
 if __name__ == "__main__":
     main()